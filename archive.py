@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Creates, extracts and compares the tarballs used to distribute the toolchain."""
+
+import argparse
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+from typing import Any, IO, Iterator, NamedTuple, Optional
+
+from utils import hash_file, prepare_command
+
+
+ARCHIVE_CHUNK_SIZE: int = 1024 * 1024
+
+# Archive entries are written with fixed ownership and timestamps so that
+# identical package contents always produce identical archives.
+ARCHIVE_DIR_MODE:  int = 0o755
+ARCHIVE_EXEC_MODE: int = 0o755
+ARCHIVE_FILE_MODE: int = 0o644
+
+
+class ArchiveFormat(NamedTuple):
+    name:          str
+    extension:     str
+    default_level: Optional[int]
+
+    def compress_command(self, level: Optional[int]) -> Optional[list[str]]:
+        """Returns the command used to compress a tar stream read from stdin,
+        or None if the archive is stored uncompressed."""
+        level = level if level is not None else self.default_level
+        # gzip and pigz produce different bytes for the same input, so the
+        # compressor is chosen by the format rather than by what's installed.
+        if self.name == "gz":
+            return ["gzip", "-n", f"-{level}", "-c"]
+        elif self.name == "pigz":
+            if not shutil.which("pigz"):
+                sys.exit("The pigz archive format requires pigz")
+            return ["pigz", "-p", str(os.cpu_count() or 1), "-n", f"-{level}", "-c"]
+        elif self.name == "zst":
+            return ["zstd", "-T0", f"-{level}", "-q", "-c"]
+        else:
+            return None
+
+    def decompress_program(self) -> Optional[str]:
+        """Returns the program tar should use to decompress the archive."""
+        if self.name in ["gz", "pigz"]:
+            return "pigz" if shutil.which("pigz") else "gzip"
+        elif self.name == "zst":
+            return "zstd -T0"
+        else:
+            return None
+
+    def decompress_command(self) -> Optional[list[str]]:
+        """Returns a command that decompresses stdin to stdout."""
+        program = self.decompress_program()
+        return (program.split() + ["-d", "-c"]) if program else None
+
+
+ARCHIVE_FORMATS: dict[str, ArchiveFormat] = {
+    "gz":   ArchiveFormat("gz",   ".tar.gz",  6),
+    # Faster to create than gz, but not byte-identical to it
+    "pigz": ArchiveFormat("pigz", ".tar.gz",  6),
+    "zst":  ArchiveFormat("zst",  ".tar.zst", 10),
+    "none": ArchiveFormat("none", ".tar",     None),
+}
+
+# pigz is much faster than gzip on a build machine, but only use it when it's
+# installed so that the default works everywhere.
+DEFAULT_ARCHIVE_FORMAT: str = "pigz" if shutil.which("pigz") else "gz"
+
+
+class ArchiveStats(NamedTuple):
+    uncompressed_bytes: int
+    compressed_bytes:   int
+    seconds:            float
+
+    def report(self) -> str:
+        mib = 1024 * 1024
+        ratio = self.uncompressed_bytes / max(self.compressed_bytes, 1)
+        throughput = self.uncompressed_bytes / mib / max(self.seconds, 0.001)
+        return (f"{self.uncompressed_bytes / mib:.1f} MiB -> {self.compressed_bytes / mib:.1f} MiB "
+                f"(ratio {ratio:.2f}) in {self.seconds:.1f}s ({throughput:.1f} MiB/s)")
+
+
+def archive_format_for_path(path: Path) -> ArchiveFormat:
+    for archive_format in ARCHIVE_FORMATS.values():
+        if path.name.endswith(archive_format.extension):
+            return archive_format
+    sys.exit(f"Unrecognized archive format: {path}")
+
+
+class CountingWriter:
+    """Forwards writes to a binary stream while counting the bytes written."""
+
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data: bytes) -> int:
+        self.stream.write(data)
+        self.count += len(data)
+        return len(data)
+
+
+def source_date_epoch() -> int:
+    return int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+
+
+def sorted_tree(root: Path) -> Iterator[Path]:
+    """Yields every path below root in a stable, sorted order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            yield Path(dirpath) / name
+
+
+def normalize_tarinfo(info: tarfile.TarInfo, mtime: int) -> tarfile.TarInfo:
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    if info.isdir():
+        info.mode = ARCHIVE_DIR_MODE
+    elif info.issym():
+        info.mode = 0o777
+    elif info.mode & 0o111:
+        info.mode = ARCHIVE_EXEC_MODE
+    else:
+        info.mode = ARCHIVE_FILE_MODE
+    return info
+
+
+def write_tar_stream(source_dir: Path, stream: Any) -> None:
+    """Writes a reproducible tar stream of the contents of source_dir.
+
+    Entries are sorted and their timestamps, ownership and permissions are
+    normalized.  Timestamps are taken from SOURCE_DATE_EPOCH if it is set.
+    """
+    mtime = source_date_epoch()
+    with tarfile.open(fileobj=stream, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+        for path in sorted_tree(source_dir):
+            info = normalize_tarinfo(
+                tar.gettarinfo(path, path.relative_to(source_dir).as_posix()), mtime)
+            if info.isreg():
+                with open(path, "rb") as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+
+
+def create_archive(source_dir: Path, archive_path: Path, archive_format: ArchiveFormat,
+    level: Optional[int] = None) -> ArchiveStats:
+    """Creates a reproducible archive of the contents of source_dir.
+
+    The tar stream is written through a counter so that the uncompressed size
+    can be measured without a second pass over the files.  Compressors are
+    run with options that keep names and timestamps out of their headers.
+    """
+    start = time.monotonic()
+
+    compress_command = archive_format.compress_command(level)
+    with open(archive_path, "wb") as archive_file:
+        compressor = subprocess.Popen(prepare_command(compress_command),
+            stdin=subprocess.PIPE, stdout=archive_file) if compress_command else None
+
+        sink = compressor.stdin if compressor else archive_file
+        assert sink is not None
+        writer = CountingWriter(sink)
+        write_tar_stream(source_dir, writer)
+
+        if compressor:
+            sink.close()
+            if compressor.wait() != 0:
+                sys.exit(f"Failed to compress archive {archive_path}")
+
+    return ArchiveStats(writer.count, archive_path.stat().st_size, time.monotonic() - start)
+
+
+def extract_command(archive_path: Path) -> list[str]:
+    """Returns a tar command that extracts archive_path into the current
+    working directory."""
+    return stream_extract_command(archive_format_for_path(archive_path), archive_path.as_posix())
+
+
+def stream_extract_command(archive_format: ArchiveFormat, source: str = "-") -> list[str]:
+    """Returns a tar command that extracts an archive read from stdin into
+    the current working directory."""
+    program = archive_format.decompress_program()
+    command = ["tar", "-x", "-f", source]
+    if program:
+        command.append(f"--use-compress-program={program}")
+    return command
+
+
+#
+# Archive comparison
+#
+
+class MemberSummary(NamedTuple):
+    type:     bytes
+    mode:     int
+    uid:      int
+    gid:      int
+    mtime:    int
+    size:     int
+    linkname: str
+    digest:   str
+
+
+def summarize_archive(archive_path: Path) -> dict[str, MemberSummary]:
+    """Returns a summary of every member in an archive keyed by name."""
+    decompress_command = archive_format_for_path(archive_path).decompress_command()
+    with open(archive_path, "rb") as archive_file:
+        decompressor = subprocess.Popen(prepare_command(decompress_command),
+            stdin=archive_file, stdout=subprocess.PIPE) if decompress_command else None
+        stream = decompressor.stdout if decompressor else archive_file
+        assert stream is not None
+
+        members: dict[str, MemberSummary] = {}
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for info in tar:
+                digest = hashlib.sha256()
+                if info.isreg():
+                    contents = tar.extractfile(info)
+                    assert contents is not None
+                    while chunk := contents.read(ARCHIVE_CHUNK_SIZE):
+                        digest.update(chunk)
+                members[info.name.removeprefix("./")] = MemberSummary(
+                    info.type, info.mode, info.uid, info.gid, int(info.mtime),
+                    info.size, info.linkname, digest.hexdigest())
+
+        if decompressor and decompressor.wait() != 0:
+            sys.exit(f"Failed to decompress archive {archive_path}")
+
+    return members
+
+
+def compare_archives(lhs_path: Path, rhs_path: Path) -> bool:
+    """Compares two archives member by member, printing every difference.
+    Returns True if the archives have identical contents."""
+    if hash_file(lhs_path) == hash_file(rhs_path):
+        print("Archives are byte-identical")
+        return True
+
+    lhs = summarize_archive(lhs_path)
+    rhs = summarize_archive(rhs_path)
+    identical = list(lhs) == list(rhs)
+
+    for name in sorted(lhs.keys() | rhs.keys()):
+        if name not in rhs:
+            print(f"Only in {lhs_path.name}: {name}")
+        elif name not in lhs:
+            print(f"Only in {rhs_path.name}: {name}")
+        elif lhs[name] != rhs[name]:
+            fields = [field for field in MemberSummary._fields
+                      if getattr(lhs[name], field) != getattr(rhs[name], field)]
+            print(f"Differs: {name} ({', '.join(fields)})")
+        else:
+            continue
+        identical = False
+
+    if identical:
+        print("Archives have identical members but different bytes (compression differs)")
+    elif list(lhs) != list(rhs) and lhs.keys() == rhs.keys():
+        print("Archives list their members in a different order")
+
+    return identical
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two archives member by member")
+    compare_parser.add_argument("lhs", type=Path)
+    compare_parser.add_argument("rhs", type=Path)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.command == "compare":
+        sys.exit(0 if compare_archives(args.lhs, args.rhs) else 1)
+
+
+if __name__ == "__main__":
+    main()
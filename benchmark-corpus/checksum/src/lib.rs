@@ -0,0 +1,229 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! Checksums and hashes written as tight integer loops over byte slices, with
+//! their lookup tables computed at compile time.
+
+/// A streaming checksum over byte slices.
+pub trait Checksum: Default {
+    type Output: Copy + std::fmt::LowerHex;
+
+    fn update(&mut self, data: &[u8]);
+    fn finish(&self) -> Self::Output;
+
+    fn digest(data: &[u8]) -> Self::Output {
+        let mut state = Self::default();
+        state.update(data);
+        state.finish()
+    }
+}
+
+const fn crc32_table(polynomial: u32) -> [u32; 256] {
+    let mut table = [0u32; 256];
+    let mut i = 0;
+    while i < 256 {
+        let mut value = i as u32;
+        let mut bit = 0;
+        while bit < 8 {
+            value = if value & 1 != 0 { (value >> 1) ^ polynomial } else { value >> 1 };
+            bit += 1;
+        }
+        table[i] = value;
+        i += 1;
+    }
+    table
+}
+
+const fn crc32_slice_tables(polynomial: u32) -> [[u32; 256]; 4] {
+    let base = crc32_table(polynomial);
+    let mut tables = [base; 4];
+    let mut t = 1;
+    while t < 4 {
+        let mut i = 0;
+        while i < 256 {
+            let previous = tables[t - 1][i];
+            tables[t][i] = (previous >> 8) ^ base[(previous & 0xff) as usize];
+            i += 1;
+        }
+        t += 1;
+    }
+    tables
+}
+
+static CRC32_TABLES: [[u32; 256]; 4] = crc32_slice_tables(0xedb8_8320);
+static CRC32C_TABLES: [[u32; 256]; 4] = crc32_slice_tables(0x82f6_3b78);
+
+fn crc32_update(tables: &[[u32; 256]; 4], mut crc: u32, data: &[u8]) -> u32 {
+    let mut chunks = data.chunks_exact(4);
+    for chunk in &mut chunks {
+        let word = crc ^ u32::from_le_bytes([chunk[0], chunk[1], chunk[2], chunk[3]]);
+        crc = tables[3][(word & 0xff) as usize]
+            ^ tables[2][((word >> 8) & 0xff) as usize]
+            ^ tables[1][((word >> 16) & 0xff) as usize]
+            ^ tables[0][(word >> 24) as usize];
+    }
+    for &byte in chunks.remainder() {
+        crc = (crc >> 8) ^ tables[0][((crc ^ byte as u32) & 0xff) as usize];
+    }
+    crc
+}
+
+macro_rules! crc32_variant {
+    ($name:ident, $tables:expr) => {
+        pub struct $name(u32);
+
+        impl Default for $name {
+            fn default() -> Self {
+                $name(!0)
+            }
+        }
+
+        impl Checksum for $name {
+            type Output = u32;
+
+            fn update(&mut self, data: &[u8]) {
+                self.0 = crc32_update(&$tables, self.0, data);
+            }
+
+            fn finish(&self) -> u32 {
+                !self.0
+            }
+        }
+    };
+}
+
+crc32_variant!(Crc32, CRC32_TABLES);
+crc32_variant!(Crc32c, CRC32C_TABLES);
+
+pub struct Adler32 {
+    a: u32,
+    b: u32,
+}
+
+impl Default for Adler32 {
+    fn default() -> Self {
+        Adler32 { a: 1, b: 0 }
+    }
+}
+
+impl Checksum for Adler32 {
+    type Output = u32;
+
+    fn update(&mut self, data: &[u8]) {
+        const MOD: u32 = 65521;
+        // The largest block that can't overflow the sums before reducing
+        for block in data.chunks(5552) {
+            for &byte in block {
+                self.a += byte as u32;
+                self.b += self.a;
+            }
+            self.a %= MOD;
+            self.b %= MOD;
+        }
+    }
+
+    fn finish(&self) -> u32 {
+        (self.b << 16) | self.a
+    }
+}
+
+#[derive(Default)]
+pub struct Fnv1a64 {
+    state: Option<u64>,
+}
+
+impl Checksum for Fnv1a64 {
+    type Output = u64;
+
+    fn update(&mut self, data: &[u8]) {
+        let mut hash = self.state.unwrap_or(0xcbf2_9ce4_8422_2325);
+        for &byte in data {
+            hash ^= byte as u64;
+            hash = hash.wrapping_mul(0x0100_0000_01b3);
+        }
+        self.state = Some(hash);
+    }
+
+    fn finish(&self) -> u64 {
+        self.state.unwrap_or(0xcbf2_9ce4_8422_2325)
+    }
+}
+
+/// The 64-bit finalizer of MurmurHash3, applied to each little-endian word.
+#[derive(Default)]
+pub struct MixHash {
+    state: u64,
+    length: u64,
+}
+
+fn fmix64(mut k: u64) -> u64 {
+    k ^= k >> 33;
+    k = k.wrapping_mul(0xff51_afd7_ed55_8ccd);
+    k ^= k >> 33;
+    k = k.wrapping_mul(0xc4ce_b9fe_1a85_ec53);
+    k ^ (k >> 33)
+}
+
+impl Checksum for MixHash {
+    type Output = u64;
+
+    fn update(&mut self, data: &[u8]) {
+        let mut chunks = data.chunks_exact(8);
+        for chunk in &mut chunks {
+            let mut word = [0u8; 8];
+            word.copy_from_slice(chunk);
+            self.state = fmix64(self.state ^ u64::from_le_bytes(word)).rotate_left(27);
+        }
+        for &byte in chunks.remainder() {
+            self.state = fmix64(self.state ^ byte as u64);
+        }
+        self.length += data.len() as u64;
+    }
+
+    fn finish(&self) -> u64 {
+        fmix64(self.state ^ self.length)
+    }
+}
+
+fn hex_digest<C: Checksum>(data: &[u8]) -> String {
+    format!("{:x}", C::digest(data))
+}
+
+/// Generates pseudo-random input with xorshift and digests it with every
+/// checksum in both one piece and in uneven pieces.
+pub fn workload(size: usize) -> Vec<String> {
+    let mut seed = 0x2545_f491_4f6c_dd1du64;
+    let data: Vec<u8> = (0..size)
+        .map(|_| {
+            seed ^= seed << 13;
+            seed ^= seed >> 7;
+            seed ^= seed << 17;
+            (seed >> 24) as u8
+        })
+        .collect();
+
+    let mut pieces = Crc32::default();
+    for piece in data.chunks(37) {
+        pieces.update(piece);
+    }
+
+    vec![
+        hex_digest::<Crc32>(&data),
+        format!("{:x}", pieces.finish()),
+        hex_digest::<Crc32c>(&data),
+        hex_digest::<Adler32>(&data),
+        hex_digest::<Fnv1a64>(&data),
+        hex_digest::<MixHash>(&data),
+    ]
+}
@@ -0,0 +1,542 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! A small expression language: a recursive-descent parser producing an AST,
+//! a compiler from the AST to bytecode and a stack machine that runs it.
+
+use std::collections::HashMap;
+use std::fmt;
+use std::rc::Rc;
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum BinaryOp {
+    Add,
+    Sub,
+    Mul,
+    Div,
+    Rem,
+    Less,
+    LessEqual,
+    Equal,
+    NotEqual,
+    And,
+    Or,
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum UnaryOp {
+    Negate,
+    Not,
+}
+
+#[derive(Debug, Clone, PartialEq)]
+pub enum Expr {
+    Int(i64),
+    Bool(bool),
+    Var(Rc<str>),
+    Unary(UnaryOp, Box<Expr>),
+    Binary(BinaryOp, Box<Expr>, Box<Expr>),
+    If(Box<Expr>, Box<Expr>, Box<Expr>),
+    Let(Rc<str>, Box<Expr>, Box<Expr>),
+    Loop { counter: Rc<str>, count: Box<Expr>, acc: Rc<str>, init: Box<Expr>, body: Box<Expr> },
+}
+
+#[derive(Debug, Clone, PartialEq)]
+pub enum Error {
+    Syntax { offset: usize, message: String },
+    UnknownVariable(Rc<str>),
+    Type(&'static str),
+    DivideByZero,
+}
+
+impl fmt::Display for Error {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        match self {
+            Error::Syntax { offset, message } => write!(f, "syntax error at {}: {}", offset, message),
+            Error::UnknownVariable(name) => write!(f, "unknown variable {}", name),
+            Error::Type(expected) => write!(f, "expected {}", expected),
+            Error::DivideByZero => f.write_str("division by zero"),
+        }
+    }
+}
+
+impl std::error::Error for Error {}
+
+#[derive(Debug, Clone, PartialEq)]
+enum Token {
+    Int(i64),
+    Ident(Rc<str>),
+    Symbol(&'static str),
+}
+
+const SYMBOLS: &[&str] = &["<=", "==", "!=", "&&", "||", "+", "-", "*", "/", "%", "<", "!", "(", ")", "="];
+
+fn tokenize(source: &str) -> Result<Vec<(usize, Token)>, Error> {
+    let bytes = source.as_bytes();
+    let mut tokens = Vec::new();
+    let mut offset = 0;
+    while offset < bytes.len() {
+        let c = bytes[offset];
+        if c.is_ascii_whitespace() {
+            offset += 1;
+        } else if c.is_ascii_digit() {
+            let start = offset;
+            while offset < bytes.len() && bytes[offset].is_ascii_digit() {
+                offset += 1;
+            }
+            let value = source[start..offset].parse().map_err(|_| Error::Syntax {
+                offset: start,
+                message: "integer too large".into(),
+            })?;
+            tokens.push((start, Token::Int(value)));
+        } else if c.is_ascii_alphabetic() || c == b'_' {
+            let start = offset;
+            while offset < bytes.len() && (bytes[offset].is_ascii_alphanumeric() || bytes[offset] == b'_') {
+                offset += 1;
+            }
+            tokens.push((start, Token::Ident(source[start..offset].into())));
+        } else if let Some(symbol) = SYMBOLS.iter().find(|symbol| source[offset..].starts_with(**symbol)) {
+            tokens.push((offset, Token::Symbol(symbol)));
+            offset += symbol.len();
+        } else {
+            return Err(Error::Syntax { offset, message: format!("unexpected {:?}", c as char) });
+        }
+    }
+    Ok(tokens)
+}
+
+struct Parser {
+    tokens: Vec<(usize, Token)>,
+    position: usize,
+    end: usize,
+}
+
+impl Parser {
+    fn peek(&self) -> Option<&Token> {
+        self.tokens.get(self.position).map(|(_, token)| token)
+    }
+
+    fn offset(&self) -> usize {
+        self.tokens.get(self.position).map_or(self.end, |(offset, _)| *offset)
+    }
+
+    fn error<T>(&self, message: &str) -> Result<T, Error> {
+        Err(Error::Syntax { offset: self.offset(), message: message.into() })
+    }
+
+    fn next(&mut self) -> Option<Token> {
+        let token = self.tokens.get(self.position).map(|(_, token)| token.clone());
+        self.position += 1;
+        token
+    }
+
+    fn eat_symbol(&mut self, symbol: &str) -> bool {
+        if matches!(self.peek(), Some(Token::Symbol(s)) if *s == symbol) {
+            self.position += 1;
+            true
+        } else {
+            false
+        }
+    }
+
+    fn eat_keyword(&mut self, keyword: &str) -> bool {
+        match self.peek() {
+            Some(Token::Ident(name)) if &**name == keyword => {
+                self.position += 1;
+                true
+            }
+            _ => false,
+        }
+    }
+
+    fn expect_symbol(&mut self, symbol: &str) -> Result<(), Error> {
+        if self.eat_symbol(symbol) {
+            Ok(())
+        } else {
+            self.error(&format!("expected {}", symbol))
+        }
+    }
+
+    fn expect_keyword(&mut self, keyword: &str) -> Result<(), Error> {
+        if self.eat_keyword(keyword) {
+            Ok(())
+        } else {
+            self.error(&format!("expected {}", keyword))
+        }
+    }
+
+    fn ident(&mut self) -> Result<Rc<str>, Error> {
+        match self.next() {
+            Some(Token::Ident(name)) => Ok(name),
+            _ => {
+                self.position -= 1;
+                self.error("expected an identifier")
+            }
+        }
+    }
+
+    fn expr(&mut self) -> Result<Expr, Error> {
+        if self.eat_keyword("let") {
+            let name = self.ident()?;
+            self.expect_symbol("=")?;
+            let value = self.expr()?;
+            self.expect_keyword("in")?;
+            let body = self.expr()?;
+            return Ok(Expr::Let(name, Box::new(value), Box::new(body)));
+        }
+        if self.eat_keyword("if") {
+            let condition = self.expr()?;
+            self.expect_keyword("then")?;
+            let then = self.expr()?;
+            self.expect_keyword("else")?;
+            let otherwise = self.expr()?;
+            return Ok(Expr::If(Box::new(condition), Box::new(then), Box::new(otherwise)));
+        }
+        if self.eat_keyword("loop") {
+            // loop i < count with acc = init do body
+            let counter = self.ident()?;
+            self.expect_symbol("<")?;
+            let count = self.expr()?;
+            self.expect_keyword("with")?;
+            let acc = self.ident()?;
+            self.expect_symbol("=")?;
+            let init = self.expr()?;
+            self.expect_keyword("do")?;
+            let body = self.expr()?;
+            return Ok(Expr::Loop { counter, count: Box::new(count), acc, init: Box::new(init), body: Box::new(body) });
+        }
+        self.binary(0)
+    }
+
+    fn binary(&mut self, min_precedence: u8) -> Result<Expr, Error> {
+        let mut lhs = self.unary()?;
+        loop {
+            let (op, precedence) = match self.peek() {
+                Some(Token::Symbol("||")) => (BinaryOp::Or, 1),
+                Some(Token::Symbol("&&")) => (BinaryOp::And, 2),
+                Some(Token::Symbol("==")) => (BinaryOp::Equal, 3),
+                Some(Token::Symbol("!=")) => (BinaryOp::NotEqual, 3),
+                Some(Token::Symbol("<")) => (BinaryOp::Less, 4),
+                Some(Token::Symbol("<=")) => (BinaryOp::LessEqual, 4),
+                Some(Token::Symbol("+")) => (BinaryOp::Add, 5),
+                Some(Token::Symbol("-")) => (BinaryOp::Sub, 5),
+                Some(Token::Symbol("*")) => (BinaryOp::Mul, 6),
+                Some(Token::Symbol("/")) => (BinaryOp::Div, 6),
+                Some(Token::Symbol("%")) => (BinaryOp::Rem, 6),
+                _ => return Ok(lhs),
+            };
+            if precedence < min_precedence {
+                return Ok(lhs);
+            }
+            self.position += 1;
+            let rhs = self.binary(precedence + 1)?;
+            lhs = Expr::Binary(op, Box::new(lhs), Box::new(rhs));
+        }
+    }
+
+    fn unary(&mut self) -> Result<Expr, Error> {
+        if self.eat_symbol("-") {
+            return Ok(Expr::Unary(UnaryOp::Negate, Box::new(self.unary()?)));
+        }
+        if self.eat_symbol("!") {
+            return Ok(Expr::Unary(UnaryOp::Not, Box::new(self.unary()?)));
+        }
+        match self.next() {
+            Some(Token::Int(value)) => Ok(Expr::Int(value)),
+            Some(Token::Ident(name)) => Ok(match &*name {
+                "true" => Expr::Bool(true),
+                "false" => Expr::Bool(false),
+                _ => Expr::Var(name),
+            }),
+            Some(Token::Symbol("(")) => {
+                let inner = self.expr()?;
+                self.expect_symbol(")")?;
+                Ok(inner)
+            }
+            _ => {
+                self.position -= 1;
+                self.error("expected an expression")
+            }
+        }
+    }
+}
+
+pub fn parse(source: &str) -> Result<Expr, Error> {
+    let mut parser = Parser { tokens: tokenize(source)?, position: 0, end: source.len() };
+    let expr = parser.expr()?;
+    if parser.peek().is_some() {
+        return parser.error("trailing input");
+    }
+    Ok(expr)
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Value {
+    Int(i64),
+    Bool(bool),
+}
+
+impl Value {
+    fn int(self) -> Result<i64, Error> {
+        match self {
+            Value::Int(value) => Ok(value),
+            Value::Bool(_) => Err(Error::Type("an integer")),
+        }
+    }
+
+    fn bool(self) -> Result<bool, Error> {
+        match self {
+            Value::Bool(value) => Ok(value),
+            Value::Int(_) => Err(Error::Type("a boolean")),
+        }
+    }
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Op {
+    Push(Value),
+    Load(usize),
+    Store(usize),
+    Unary(UnaryOp),
+    Binary(BinaryOp),
+    Jump(usize),
+    JumpIfFalse(usize),
+}
+
+#[derive(Default)]
+struct Compiler {
+    code: Vec<Op>,
+    scopes: Vec<Rc<str>>,
+    slots: usize,
+}
+
+impl Compiler {
+    fn slot(&self, name: &Rc<str>) -> Result<usize, Error> {
+        self.scopes.iter().rposition(|scope| scope == name).ok_or_else(|| Error::UnknownVariable(name.clone()))
+    }
+
+    fn bind(&mut self, name: &Rc<str>) -> usize {
+        self.scopes.push(name.clone());
+        self.slots = self.slots.max(self.scopes.len());
+        self.scopes.len() - 1
+    }
+
+    fn placeholder(&mut self) -> usize {
+        self.code.push(Op::Jump(usize::MAX));
+        self.code.len() - 1
+    }
+
+    fn compile(&mut self, expr: &Expr) -> Result<(), Error> {
+        match expr {
+            Expr::Int(value) => self.code.push(Op::Push(Value::Int(*value))),
+            Expr::Bool(value) => self.code.push(Op::Push(Value::Bool(*value))),
+            Expr::Var(name) => {
+                let slot = self.slot(name)?;
+                self.code.push(Op::Load(slot));
+            }
+            Expr::Unary(op, operand) => {
+                self.compile(operand)?;
+                self.code.push(Op::Unary(*op));
+            }
+            Expr::Binary(op, lhs, rhs) => {
+                self.compile(lhs)?;
+                self.compile(rhs)?;
+                self.code.push(Op::Binary(*op));
+            }
+            Expr::If(condition, then, otherwise) => {
+                self.compile(condition)?;
+                let branch = self.placeholder();
+                self.compile(then)?;
+                let skip = self.placeholder();
+                self.code[branch] = Op::JumpIfFalse(self.code.len());
+                self.compile(otherwise)?;
+                self.code[skip] = Op::Jump(self.code.len());
+            }
+            Expr::Let(name, value, body) => {
+                self.compile(value)?;
+                let slot = self.bind(name);
+                self.code.push(Op::Store(slot));
+                self.compile(body)?;
+                self.scopes.pop();
+            }
+            Expr::Loop { counter, count, acc, init, body } => {
+                self.compile(count)?;
+                let limit = self.bind(&Rc::from("$limit"));
+                self.code.push(Op::Store(limit));
+                self.compile(init)?;
+                let acc_slot = self.bind(acc);
+                self.code.push(Op::Store(acc_slot));
+                self.code.push(Op::Push(Value::Int(0)));
+                let counter_slot = self.bind(counter);
+                self.code.push(Op::Store(counter_slot));
+
+                let head = self.code.len();
+                self.code.push(Op::Load(counter_slot));
+                self.code.push(Op::Load(limit));
+                self.code.push(Op::Binary(BinaryOp::Less));
+                let exit = self.placeholder();
+                self.compile(body)?;
+                self.code.push(Op::Store(acc_slot));
+                self.code.push(Op::Load(counter_slot));
+                self.code.push(Op::Push(Value::Int(1)));
+                self.code.push(Op::Binary(BinaryOp::Add));
+                self.code.push(Op::Store(counter_slot));
+                self.code.push(Op::Jump(head));
+                self.code[exit] = Op::JumpIfFalse(self.code.len());
+                self.code.push(Op::Load(acc_slot));
+
+                self.scopes.truncate(self.scopes.len() - 3);
+            }
+        }
+        Ok(())
+    }
+}
+
+pub struct Program {
+    pub code: Vec<Op>,
+    pub slots: usize,
+}
+
+pub fn compile(expr: &Expr) -> Result<Program, Error> {
+    let mut compiler = Compiler::default();
+    compiler.compile(expr)?;
+    Ok(Program { code: compiler.code, slots: compiler.slots })
+}
+
+fn apply(op: BinaryOp, lhs: Value, rhs: Value) -> Result<Value, Error> {
+    Ok(match op {
+        BinaryOp::Add => Value::Int(lhs.int()?.wrapping_add(rhs.int()?)),
+        BinaryOp::Sub => Value::Int(lhs.int()?.wrapping_sub(rhs.int()?)),
+        BinaryOp::Mul => Value::Int(lhs.int()?.wrapping_mul(rhs.int()?)),
+        BinaryOp::Div | BinaryOp::Rem => {
+            let (lhs, rhs) = (lhs.int()?, rhs.int()?);
+            if rhs == 0 {
+                return Err(Error::DivideByZero);
+            }
+            Value::Int(if op == BinaryOp::Div { lhs.wrapping_div(rhs) } else { lhs.wrapping_rem(rhs) })
+        }
+        BinaryOp::Less => Value::Bool(lhs.int()? < rhs.int()?),
+        BinaryOp::LessEqual => Value::Bool(lhs.int()? <= rhs.int()?),
+        BinaryOp::Equal => Value::Bool(lhs == rhs),
+        BinaryOp::NotEqual => Value::Bool(lhs != rhs),
+        BinaryOp::And => Value::Bool(lhs.bool()? && rhs.bool()?),
+        BinaryOp::Or => Value::Bool(lhs.bool()? || rhs.bool()?),
+    })
+}
+
+pub fn run(program: &Program) -> Result<Value, Error> {
+    let mut stack: Vec<Value> = Vec::with_capacity(16);
+    let mut slots = vec![Value::Int(0); program.slots];
+    let mut pc = 0;
+    while let Some(&op) = program.code.get(pc) {
+        pc += 1;
+        match op {
+            Op::Push(value) => stack.push(value),
+            Op::Load(slot) => stack.push(slots[slot]),
+            Op::Store(slot) => slots[slot] = stack.pop().expect("stack underflow"),
+            Op::Unary(op) => {
+                let operand = stack.pop().expect("stack underflow");
+                stack.push(match op {
+                    UnaryOp::Negate => Value::Int(operand.int()?.wrapping_neg()),
+                    UnaryOp::Not => Value::Bool(!operand.bool()?),
+                });
+            }
+            Op::Binary(op) => {
+                let rhs = stack.pop().expect("stack underflow");
+                let lhs = stack.pop().expect("stack underflow");
+                stack.push(apply(op, lhs, rhs)?);
+            }
+            Op::Jump(target) => pc = target,
+            Op::JumpIfFalse(target) => {
+                if !stack.pop().expect("stack underflow").bool()? {
+                    pc = target;
+                }
+            }
+        }
+    }
+    Ok(stack.pop().expect("empty program"))
+}
+
+/// Evaluates the AST directly, as a reference for the bytecode machine.
+pub fn evaluate(expr: &Expr, env: &mut HashMap<Rc<str>, Value>) -> Result<Value, Error> {
+    fn scoped<T>(
+        env: &mut HashMap<Rc<str>, Value>,
+        name: &Rc<str>,
+        value: Value,
+        f: impl FnOnce(&mut HashMap<Rc<str>, Value>) -> T,
+    ) -> T {
+        let previous = env.insert(name.clone(), value);
+        let result = f(env);
+        match previous {
+            Some(previous) => env.insert(name.clone(), previous),
+            None => env.remove(name),
+        };
+        result
+    }
+
+    match expr {
+        Expr::Int(value) => Ok(Value::Int(*value)),
+        Expr::Bool(value) => Ok(Value::Bool(*value)),
+        Expr::Var(name) => env.get(name).copied().ok_or_else(|| Error::UnknownVariable(name.clone())),
+        Expr::Unary(UnaryOp::Negate, operand) => Ok(Value::Int(evaluate(operand, env)?.int()?.wrapping_neg())),
+        Expr::Unary(UnaryOp::Not, operand) => Ok(Value::Bool(!evaluate(operand, env)?.bool()?)),
+        Expr::Binary(op, lhs, rhs) => {
+            let lhs = evaluate(lhs, env)?;
+            let rhs = evaluate(rhs, env)?;
+            apply(*op, lhs, rhs)
+        }
+        Expr::If(condition, then, otherwise) => {
+            if evaluate(condition, env)?.bool()? {
+                evaluate(then, env)
+            } else {
+                evaluate(otherwise, env)
+            }
+        }
+        Expr::Let(name, value, body) => {
+            let value = evaluate(value, env)?;
+            scoped(env, name, value, |env| evaluate(body, env))
+        }
+        Expr::Loop { counter, count, acc, init, body } => {
+            let count = evaluate(count, env)?.int()?;
+            let mut value = evaluate(init, env)?;
+            for i in 0..count {
+                value = scoped(env, acc, value, |env| {
+                    scoped(env, counter, Value::Int(i), |env| evaluate(body, env))
+                })?;
+            }
+            Ok(value)
+        }
+    }
+}
+
+pub const EXAMPLES: &[&str] = &[
+    "let n = 30 in loop i < n with acc = 0 do acc + i * i",
+    "loop i < 20 with acc = 1 do if i % 3 == 0 then acc * 2 % 1000003 else acc + i",
+    "let a = 7 in let b = 12 in if a <= b && !(a == b) then b - a else a - b",
+    "loop i < 50 with acc = 0 do if acc < 100 || i == 49 then acc + i else acc - 1",
+    "-(3 + 4 * 5) / 2",
+];
+
+/// Runs every example through both the bytecode machine and the reference
+/// evaluator and checks that they agree.
+pub fn workload() -> Result<Vec<Value>, Error> {
+    let mut results = Vec::new();
+    for source in EXAMPLES {
+        let expr = parse(source)?;
+        let value = run(&compile(&expr)?)?;
+        assert_eq!(value, evaluate(&expr, &mut HashMap::new())?, "{}", source);
+        results.push(value);
+    }
+    Ok(results)
+}
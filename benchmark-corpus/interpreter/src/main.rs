@@ -0,0 +1,39 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+use bench_interpreter::{compile, parse, run, workload};
+use std::process::exit;
+
+fn main() {
+    let args: Vec<String> = std::env::args().skip(1).collect();
+    if args.is_empty() {
+        match workload() {
+            Ok(values) => println!("{:?}", values),
+            Err(error) => {
+                eprintln!("{}", error);
+                exit(1);
+            }
+        }
+        return;
+    }
+
+    let source = args.join(" ");
+    match parse(&source).and_then(|expr| compile(&expr)).and_then(|program| run(&program)) {
+        Ok(value) => println!("{:?}", value),
+        Err(error) => {
+            eprintln!("{}", error);
+            exit(1);
+        }
+    }
+}
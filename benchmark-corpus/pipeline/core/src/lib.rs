@@ -0,0 +1,188 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! Generic building blocks for record-processing pipelines.  Everything here
+//! is generic, so the code is only generated in the crates that use it.
+
+use std::collections::BTreeMap;
+use std::fmt::Debug;
+
+/// A step of a pipeline that maps each input record to zero or more outputs.
+pub trait Stage<In> {
+    type Out;
+
+    fn process(&mut self, input: In, emit: &mut dyn FnMut(Self::Out));
+
+    /// Called once after the last input so that buffering stages can flush.
+    fn finish(&mut self, _emit: &mut dyn FnMut(Self::Out)) {}
+
+    fn then<S: Stage<Self::Out>>(self, next: S) -> Chain<Self, S>
+    where
+        Self: Sized,
+    {
+        Chain { first: self, second: next }
+    }
+}
+
+pub struct Chain<A, B> {
+    first: A,
+    second: B,
+}
+
+impl<In, A: Stage<In>, B: Stage<A::Out>> Stage<In> for Chain<A, B> {
+    type Out = B::Out;
+
+    fn process(&mut self, input: In, emit: &mut dyn FnMut(B::Out)) {
+        let second = &mut self.second;
+        self.first.process(input, &mut |middle| second.process(middle, emit));
+    }
+
+    fn finish(&mut self, emit: &mut dyn FnMut(B::Out)) {
+        let second = &mut self.second;
+        self.first.finish(&mut |middle| second.process(middle, emit));
+        self.second.finish(emit);
+    }
+}
+
+pub struct Map<F>(pub F);
+
+impl<In, Out, F: FnMut(In) -> Out> Stage<In> for Map<F> {
+    type Out = Out;
+
+    fn process(&mut self, input: In, emit: &mut dyn FnMut(Out)) {
+        emit((self.0)(input));
+    }
+}
+
+pub struct Filter<F>(pub F);
+
+impl<In, F: FnMut(&In) -> bool> Stage<In> for Filter<F> {
+    type Out = In;
+
+    fn process(&mut self, input: In, emit: &mut dyn FnMut(In)) {
+        if (self.0)(&input) {
+            emit(input);
+        }
+    }
+}
+
+/// Emits records in groups of a fixed size, and any remainder at the end.
+pub struct Batch<T> {
+    size: usize,
+    pending: Vec<T>,
+}
+
+impl<T> Batch<T> {
+    pub fn new(size: usize) -> Self {
+        assert!(size > 0);
+        Batch { size, pending: Vec::with_capacity(size) }
+    }
+}
+
+impl<T> Stage<T> for Batch<T> {
+    type Out = Vec<T>;
+
+    fn process(&mut self, input: T, emit: &mut dyn FnMut(Vec<T>)) {
+        self.pending.push(input);
+        if self.pending.len() == self.size {
+            emit(std::mem::replace(&mut self.pending, Vec::with_capacity(self.size)));
+        }
+    }
+
+    fn finish(&mut self, emit: &mut dyn FnMut(Vec<T>)) {
+        if !self.pending.is_empty() {
+            emit(std::mem::take(&mut self.pending));
+        }
+    }
+}
+
+/// Folds records into per-key accumulators and emits them in key order.
+pub struct GroupFold<K, A, KF, FF> {
+    key: KF,
+    fold: FF,
+    groups: BTreeMap<K, A>,
+}
+
+impl<K, A, KF, FF> GroupFold<K, A, KF, FF> {
+    pub fn new(key: KF, fold: FF) -> Self {
+        GroupFold { key, fold, groups: BTreeMap::new() }
+    }
+}
+
+impl<In, K, A, KF, FF> Stage<In> for GroupFold<K, A, KF, FF>
+where
+    K: Ord + Clone,
+    A: Default,
+    KF: FnMut(&In) -> K,
+    FF: FnMut(&mut A, In),
+{
+    type Out = (K, A);
+
+    fn process(&mut self, input: In, _emit: &mut dyn FnMut((K, A))) {
+        let key = (self.key)(&input);
+        (self.fold)(self.groups.entry(key).or_default(), input);
+    }
+
+    fn finish(&mut self, emit: &mut dyn FnMut((K, A))) {
+        for group in std::mem::take(&mut self.groups) {
+            emit(group);
+        }
+    }
+}
+
+/// Runs every input through a stage and collects the outputs.
+pub fn run<In, S: Stage<In>>(stage: &mut S, inputs: impl IntoIterator<Item = In>) -> Vec<S::Out> {
+    let mut outputs = Vec::new();
+    for input in inputs {
+        stage.process(input, &mut |output| outputs.push(output));
+    }
+    stage.finish(&mut |output| outputs.push(output));
+    outputs
+}
+
+/// Summary statistics over a numeric field.
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub struct Stats {
+    pub count: u64,
+    pub sum: f64,
+    pub min: f64,
+    pub max: f64,
+}
+
+impl Default for Stats {
+    fn default() -> Self {
+        Stats { count: 0, sum: 0.0, min: f64::INFINITY, max: f64::NEG_INFINITY }
+    }
+}
+
+impl Stats {
+    pub fn add(&mut self, value: f64) {
+        self.count += 1;
+        self.sum += value;
+        self.min = self.min.min(value);
+        self.max = self.max.max(value);
+    }
+
+    pub fn mean(&self) -> Option<f64> {
+        if self.count == 0 {
+            None
+        } else {
+            Some(self.sum / self.count as f64)
+        }
+    }
+}
+
+pub fn describe<T: Debug>(items: &[T]) -> String {
+    items.iter().map(|item| format!("{:?}", item)).collect::<Vec<_>>().join("\n")
+}
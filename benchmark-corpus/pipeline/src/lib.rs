@@ -0,0 +1,125 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! Log processing pipelines built from the generic stages in the core crate,
+//! which are instantiated here with concrete record types.
+
+use bench_pipeline_core::{run, Batch, Filter, GroupFold, Map, Stage, Stats};
+use std::str::FromStr;
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq, PartialOrd, Ord)]
+pub enum Level {
+    Verbose,
+    Debug,
+    Info,
+    Warn,
+    Error,
+}
+
+impl FromStr for Level {
+    type Err = String;
+
+    fn from_str(s: &str) -> Result<Self, String> {
+        match s {
+            "V" => Ok(Level::Verbose),
+            "D" => Ok(Level::Debug),
+            "I" => Ok(Level::Info),
+            "W" => Ok(Level::Warn),
+            "E" => Ok(Level::Error),
+            _ => Err(format!("unknown level {}", s)),
+        }
+    }
+}
+
+#[derive(Debug, Clone, PartialEq)]
+pub struct LogLine {
+    pub millis: u64,
+    pub level: Level,
+    pub tag: String,
+    pub latency_ms: Option<f64>,
+    pub message: String,
+}
+
+/// Parses lines of the form "<millis> <level> <tag>: <message>", where the
+/// message may contain "latency=<ms>".
+pub fn parse_line(line: &str) -> Result<LogLine, String> {
+    let mut fields = line.splitn(3, ' ');
+    let millis = fields.next().ok_or("missing time")?.parse().map_err(|_| "bad time")?;
+    let level = fields.next().ok_or("missing level")?.parse()?;
+    let rest = fields.next().ok_or("missing tag")?;
+    let (tag, message) = rest.split_once(": ").ok_or("missing message")?;
+    let latency_ms = message
+        .split_whitespace()
+        .find_map(|word| word.strip_prefix("latency="))
+        .and_then(|value| value.parse().ok());
+    Ok(LogLine { millis, level, tag: tag.to_string(), latency_ms, message: message.to_string() })
+}
+
+pub fn synthetic_log(lines: usize) -> Vec<String> {
+    const TAGS: &[&str] = &["ActivityManager", "netd", "vold", "SurfaceFlinger", "installd"];
+    const LEVELS: &[&str] = &["V", "D", "I", "W", "E"];
+    (0..lines)
+        .map(|i| {
+            format!(
+                "{} {} {}: request {} latency={}.{} status={}",
+                1_000 + i * 17,
+                LEVELS[(i * 7) % LEVELS.len()],
+                TAGS[(i * 3) % TAGS.len()],
+                i,
+                (i * 37) % 250,
+                i % 10,
+                if i % 13 == 0 { "bad" } else { "ok" }
+            )
+        })
+        .collect()
+}
+
+/// Latency statistics per tag for lines at or above min_level.
+pub fn latency_by_tag(log: &[String], min_level: Level) -> Vec<(String, Stats)> {
+    let mut pipeline = Map(|line: &String| parse_line(line))
+        .then(Filter(|parsed: &Result<LogLine, String>| parsed.is_ok()))
+        .then(Map(|parsed: Result<LogLine, String>| parsed.unwrap()))
+        .then(Filter(move |line: &LogLine| line.level >= min_level))
+        .then(GroupFold::new(
+            |line: &LogLine| line.tag.clone(),
+            |stats: &mut Stats, line: LogLine| {
+                if let Some(latency) = line.latency_ms {
+                    stats.add(latency)
+                }
+            },
+        ));
+    run(&mut pipeline, log)
+}
+
+/// Counts of failed requests in fixed-size windows of the log.
+pub fn failures_per_window(log: &[String], window: usize) -> Vec<usize> {
+    let mut pipeline = Map(|line: &String| line.ends_with("status=bad"))
+        .then(Batch::new(window))
+        .then(Map(|batch: Vec<bool>| batch.into_iter().filter(|failed| *failed).count()));
+    run(&mut pipeline, log)
+}
+
+/// The longest gap between consecutive error lines, in milliseconds.
+pub fn longest_error_gap(log: &[String]) -> Option<u64> {
+    let mut last: Option<u64> = None;
+    let mut pipeline = Map(|line: &String| parse_line(line).ok())
+        .then(Filter(|line: &Option<LogLine>| matches!(line, Some(LogLine { level: Level::Error, .. }))))
+        .then(Map(move |line: Option<LogLine>| {
+            let millis = line.map_or(0, |line| line.millis);
+            let gap = last.map(|last| millis - last);
+            last = Some(millis);
+            gap
+        }));
+    run(&mut pipeline, log).into_iter().flatten().max()
+}
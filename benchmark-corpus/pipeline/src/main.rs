@@ -0,0 +1,29 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+use bench_pipeline::{failures_per_window, latency_by_tag, longest_error_gap, synthetic_log, Level};
+use bench_pipeline_core::describe;
+
+fn main() {
+    let lines = std::env::args().nth(1).and_then(|arg| arg.parse().ok()).unwrap_or(1000);
+    let log = synthetic_log(lines);
+
+    let by_tag = latency_by_tag(&log, Level::Info);
+    println!("{}", describe(&by_tag));
+    for (tag, stats) in &by_tag {
+        println!("{}: mean {:.1} ms", tag, stats.mean().unwrap_or(0.0));
+    }
+    println!("failures: {:?}", failures_per_window(&log, 100));
+    println!("longest error gap: {:?} ms", longest_error_gap(&log));
+}
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the compile times of a newly built toolchain against a prebuilt.
+
+Each crate in the benchmark corpus is checked, built in debug and release
+mode, and cross-compiled for each device target, several times with each
+toolchain.  Runs of the two toolchains are interleaved so that slow drift in
+the machine's performance affects both equally.  Wall time, instructions
+retired (if perf is available) and peak RSS are compared with Welch's t-test.
+"""
+
+import argparse
+import json
+import math
+import os
+from pathlib import Path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import NamedTuple, Optional, Union
+
+import build_platform
+from config import DEVICE_TARGETS
+from paths import *
+from utils import prepare_command, version_key
+
+
+DEFAULT_ITERATIONS: int = 5
+
+# Differences with a p-value below this are reported as significant
+SIGNIFICANCE_LEVEL: float = 0.05
+
+METRICS: list[str] = ["wall_s", "instructions", "peak_rss"]
+
+
+class Scenario(NamedTuple):
+    crate: Path
+    name:  str
+    args:  list[str]
+
+
+class Measurement(NamedTuple):
+    wall_s:       float
+    instructions: Optional[int]
+    peak_rss:     int
+
+
+#
+# Statistics
+#
+
+def incomplete_beta(a: float, b: float, x: float) -> float:
+    """Returns the regularized incomplete beta function I_x(a, b), evaluated
+    with the continued fraction from Numerical Recipes."""
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+
+    # The continued fraction converges quickly only below this point.
+    if x > (a + 1.0) / (a + b + 2.0):
+        return 1.0 - incomplete_beta(b, a, 1.0 - x)
+
+    log_front = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                 a * math.log(x) + b * math.log(1.0 - x))
+
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    fraction = d
+    for m in range(1, 300):
+        for numerator in [m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))]:
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+        if abs(c * d - 1.0) < 1e-12:
+            break
+
+    return math.exp(log_front) * fraction / a
+
+
+def welch_t_test(lhs: list[float], rhs: list[float]) -> float:
+    """Returns the two-sided p-value of Welch's t-test for the hypothesis that
+    both samples have the same mean."""
+    if len(lhs) < 2 or len(rhs) < 2:
+        return 1.0
+
+    lhs_var = statistics.variance(lhs) / len(lhs)
+    rhs_var = statistics.variance(rhs) / len(rhs)
+    if lhs_var + rhs_var == 0.0:
+        return 1.0 if statistics.mean(lhs) == statistics.mean(rhs) else 0.0
+
+    t = (statistics.mean(lhs) - statistics.mean(rhs)) / math.sqrt(lhs_var + rhs_var)
+    dof = (lhs_var + rhs_var) ** 2 / (
+        lhs_var ** 2 / (len(lhs) - 1) + rhs_var ** 2 / (len(rhs) - 1))
+    return incomplete_beta(dof / 2.0, 0.5, dof / (dof + t * t))
+
+#
+# Measurement
+#
+
+def scenarios(corpus_path: Path) -> list[Scenario]:
+    crates = sorted(path.parent for path in corpus_path.glob("*/Cargo.toml"))
+    if not crates:
+        sys.exit(f"No crates found in the benchmark corpus at {corpus_path}")
+
+    result: list[Scenario] = []
+    for crate in crates:
+        result.append(Scenario(crate, "check",   ["check"]))
+        result.append(Scenario(crate, "debug",   ["build"]))
+        result.append(Scenario(crate, "release", ["build", "--release"]))
+        # Only libraries are cross-compiled so that no target linker is needed.
+        for target in DEVICE_TARGETS:
+            result.append(Scenario(crate, f"release-{target}",
+                ["build", "--release", "--lib", "--target", target]))
+    return result
+
+
+def measure(toolchain: Path, scenario: Scenario, target_dir: Path) -> Measurement:
+    """Runs one clean build of a scenario with the given toolchain."""
+    if target_dir.exists():
+        shutil.rmtree(target_dir)
+
+    env = dict(os.environ)
+    env["RUSTC"] = (toolchain / "bin" / "rustc").as_posix()
+    env["CARGO_TARGET_DIR"] = target_dir.as_posix()
+    env.pop("RUSTFLAGS", None)
+
+    command: list[Union[str, Path]] = [
+        toolchain / "bin" / "cargo", *scenario.args, "--offline", "--locked", "--quiet"]
+    perf_output = target_dir.parent / "perf.csv"
+    use_perf = shutil.which("perf") is not None
+    if use_perf:
+        command = ["perf", "stat", "-x", ",", "-e", "instructions:u", "-o", perf_output, *command]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(prepare_command(command), cwd=scenario.crate, env=env,
+        stdout=subprocess.DEVNULL)
+    # wait4 reports the largest RSS of cargo and every process it waited for,
+    # which includes each rustc invocation.
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_s = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        sys.exit(f"Benchmark {scenario.crate.name}/{scenario.name} failed with {toolchain}")
+
+    instructions: Optional[int] = None
+    if use_perf:
+        for line in perf_output.read_text().splitlines():
+            fields = line.split(",")
+            if len(fields) > 2 and fields[2].startswith("instructions") and fields[0].isdigit():
+                instructions = int(fields[0])
+
+    # ru_maxrss is in KiB on Linux and bytes on Darwin.
+    peak_rss = rusage.ru_maxrss * (1024 if build_platform.is_linux() else 1)
+    return Measurement(wall_s, instructions, peak_rss)
+
+
+def compare(baseline: list[Measurement], candidate: list[Measurement]) -> dict[str, dict[str, float]]:
+    result: dict[str, dict[str, float]] = {}
+    for metric in METRICS:
+        lhs = [float(getattr(m, metric)) for m in baseline if getattr(m, metric) is not None]
+        rhs = [float(getattr(m, metric)) for m in candidate if getattr(m, metric) is not None]
+        if not lhs or not rhs:
+            continue
+        result[metric] = {
+            "baseline_mean":  statistics.mean(lhs),
+            "candidate_mean": statistics.mean(rhs),
+            "change":         statistics.mean(rhs) / statistics.mean(lhs) - 1.0,
+            "p_value":        welch_t_test(lhs, rhs),
+        }
+    return result
+
+
+def format_metric(metric: str, value: float) -> str:
+    if metric == "wall_s":
+        return f"{value:.2f}s"
+    elif metric == "instructions":
+        return f"{value / 1e9:.2f}G"
+    else:
+        return f"{value / 2**20:.0f}MiB"
+
+
+def print_report(results: dict[str, dict[str, dict[str, float]]]) -> bool:
+    """Prints the comparison and returns True if any metric got significantly
+    worse."""
+    regressed = False
+    for name, metrics in results.items():
+        for metric, values in metrics.items():
+            significant = values["p_value"] < SIGNIFICANCE_LEVEL
+            marker = ""
+            if significant:
+                marker = " REGRESSION" if values["change"] > 0 else " improvement"
+                regressed = regressed or values["change"] > 0
+            print("{:<48} {:<13} {:>10} -> {:>10} {:+7.2%} (p={:.3f}){}".format(
+                name, metric,
+                format_metric(metric, values["baseline_mean"]),
+                format_metric(metric, values["candidate_mean"]),
+                values["change"], values["p_value"], marker))
+    return regressed
+
+
+def latest_prebuilt_version() -> str:
+    versions = [path.name for path in (RUST_PREBUILT_PATH / build_platform.prebuilt()).iterdir()
+                if (path / "bin" / "rustc").exists()]
+    if not versions:
+        sys.exit("No prebuilt toolchains found")
+    return max(versions, key=version_key)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--package", type=Path, default=OUT_PATH_PACKAGE,
+                        help="Toolchain to evaluate")
+    parser.add_argument("--baseline-version",
+                        help="Version of the prebuilt toolchain to compare against. \
+                        Defaults to the newest checked-in version.")
+    parser.add_argument("--corpus", type=Path, default=BENCHMARK_CORPUS_PATH,
+                        help="Directory of crates to compile. Each crate must \
+                        build offline from its Cargo.lock, i.e. with its \
+                        dependencies vendored. Defaults to the checked-in \
+                        benchmark corpus.")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="Runs per toolchain and scenario")
+    parser.add_argument("--output", type=Path, default=DIST_PATH / "benchmark.json",
+                        help="File to write the results to as JSON")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    baseline_version = args.baseline_version or latest_prebuilt_version()
+    baseline = RUST_PREBUILT_PATH / build_platform.prebuilt() / baseline_version
+    candidate = args.package.resolve()
+    print(f"Comparing {candidate} against {baseline_version}")
+
+    results: dict[str, dict[str, dict[str, float]]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        target_dir = Path(tmp) / "target"
+        for scenario in scenarios(args.corpus):
+            name = f"{scenario.crate.name}/{scenario.name}"
+            print(f"Running {name}")
+
+            baseline_runs: list[Measurement] = []
+            candidate_runs: list[Measurement] = []
+            for _ in range(args.iterations):
+                baseline_runs.append(measure(baseline, scenario, target_dir))
+                candidate_runs.append(measure(candidate, scenario, target_dir))
+            results[name] = compare(baseline_runs, candidate_runs)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"baseline": baseline_version, "results": results}, f, indent=2)
+
+    print()
+    sys.exit(1 if print_report(results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Post-link optimization of the compiler's shared library with BOLT.
+
+librustc_driver is instrumented in place, the PGO training workload is run
+with the packaged compiler, and the library is then rewritten using the
+collected profiles.  LLVM is linked statically into librustc_driver, so its
+code is optimized along with the rest of the compiler.
+
+BOLT needs the relocations that the linker keeps when the build is configured
+with --bolt.  Every host binary is linked that way, so the relocations are
+removed from the whole package once BOLT has run.
+"""
+
+from pathlib import Path
+import shutil
+import struct
+import sys
+from typing import NamedTuple
+
+import pgo
+from paths import *
+from strip_binaries import ELF_MAGIC, find_strippable_files
+from utils import run_and_exit_on_failure, run_quiet_and_exit_on_failure
+
+
+BOLT_PATH:        Path = LLVM_PREBUILT_PATH / 'bin' / 'llvm-bolt'
+MERGE_FDATA_PATH: Path = LLVM_PREBUILT_PATH / 'bin' / 'merge-fdata'
+OBJCOPY_PATH:     Path = LLVM_PREBUILT_PATH / 'bin' / 'llvm-objcopy'
+
+BOLT_PROFILE_PATH: Path = OUT_PATH / 'bolt'
+
+# Linker flag that keeps relocations in the output for BOLT to use
+BOLT_LINKER_FLAG: str = "-Wl,-q"
+
+SHT_RELA:  int = 4
+SHT_REL:   int = 9
+SHF_ALLOC: int = 0x2
+
+BOLT_OPTIMIZE_FLAGS: list[str] = [
+    "-reorder-blocks=ext-tsp",
+    "-reorder-functions=hfsort+",
+    "-split-functions",
+    "-split-all-cold",
+    "-icf=1",
+    "-use-gnu-stack",
+    "-dyno-stats",
+]
+
+
+class BoltResult(NamedTuple):
+    path:        Path
+    size_before: int
+    size_after:  int
+
+
+def find_bolt_targets(package_dir: Path) -> list[Path]:
+    """Returns the rustc driver libraries in the package."""
+    libraries = sorted((package_dir / "lib").glob("librustc_driver-*.so"))
+    return [library for library in libraries if not library.is_symlink()]
+
+
+def static_relocation_sections(path: Path) -> list[str]:
+    """Returns the names of the relocation sections of an ELF file that are
+    only present because of BOLT_LINKER_FLAG.  The dynamic relocations used
+    by the loader are allocated and aren't included."""
+    data = path.read_bytes()
+    if data[:4] != ELF_MAGIC:
+        return []
+
+    endian = "<" if data[5] == 1 else ">"
+    if data[4] == 2:
+        shoff, = struct.unpack_from(endian + "Q", data, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x3A)
+        header_format = endian + "IIQQQQ"
+    else:
+        shoff, = struct.unpack_from(endian + "I", data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x2E)
+        header_format = endian + "IIIIII"
+
+    headers = [struct.unpack_from(header_format, data, shoff + index * shentsize)
+               for index in range(shnum)]
+    if not headers:
+        return []
+    strtab_offset = headers[shstrndx][4]
+
+    names: list[str] = []
+    for name_offset, section_type, flags, _, _, _ in headers:
+        if section_type in [SHT_RELA, SHT_REL] and not flags & SHF_ALLOC:
+            name_start = strtab_offset + name_offset
+            names.append(data[name_start:data.index(b"\0", name_start)].decode())
+    return names
+
+
+def remove_static_relocations(package_dir: Path) -> int:
+    """Removes the relocations kept for BOLT from every binary in the package
+    and returns the number of bytes saved."""
+    saved = 0
+    for path in find_strippable_files(package_dir):
+        sections = static_relocation_sections(path)
+        if not sections:
+            continue
+
+        size_before = path.stat().st_size
+        run_quiet_and_exit_on_failure(
+            [OBJCOPY_PATH] + [f"--remove-section={section}" for section in sections] + [path],
+            f"Failed to remove relocations from {path}")
+        saved += size_before - path.stat().st_size
+    return saved
+
+
+def backup_path(library: Path) -> Path:
+    return BOLT_PROFILE_PATH / (library.name + ".orig")
+
+
+def instrument(library: Path) -> None:
+    shutil.copy2(library, backup_path(library))
+    run_quiet_and_exit_on_failure(
+        [BOLT_PATH, backup_path(library), "-instrument",
+         f"-instrumentation-file={BOLT_PROFILE_PATH / library.name}.fdata",
+         "-instrumentation-file-append-pid",
+         "-o", library],
+        f"Failed to instrument {library.name}")
+
+
+def optimize(library: Path) -> BoltResult:
+    profiles = sorted(BOLT_PROFILE_PATH.glob(f"{library.name}.*.fdata"))
+    if not profiles:
+        sys.exit(f"No BOLT profiles were written for {library.name}")
+
+    merged_profile = BOLT_PROFILE_PATH / f"{library.name}.merged.fdata"
+    with open(merged_profile, "w") as merged_file:
+        run_and_exit_on_failure(
+            [MERGE_FDATA_PATH] + profiles,
+            f"Failed to merge BOLT profiles for {library.name}",
+            stdout=merged_file)
+
+    original = backup_path(library)
+    run_quiet_and_exit_on_failure(
+        [BOLT_PATH, original, f"-data={merged_profile}", "-o", library] + BOLT_OPTIMIZE_FLAGS,
+        f"Failed to optimize {library.name}")
+
+    return BoltResult(library, original.stat().st_size, library.stat().st_size)
+
+
+def check_tools() -> None:
+    """Exits if the clang prebuilt lacks any of the tools BOLT needs.  Called
+    before the build so that a missing tool doesn't waste one."""
+    missing = [tool for tool in [BOLT_PATH, MERGE_FDATA_PATH, OBJCOPY_PATH] if not tool.exists()]
+    if missing:
+        sys.exit("BOLT tools not found in the clang prebuilt {}: {}".format(
+            LLVM_PREBUILT_PATH, ", ".join(tool.name for tool in missing)))
+
+
+def optimize_package(package_dir: Path, env: dict[str, str], targets: list[str],
+    report_path: Path) -> None:
+    """Optimizes the compiler libraries in package_dir with BOLT and writes
+    their sizes and the measured speedup of the training workload to
+    report_path."""
+    check_tools()
+
+    libraries = find_bolt_targets(package_dir)
+    if not libraries:
+        sys.exit(f"No libraries to optimize with BOLT in {package_dir / 'lib'}")
+
+    if BOLT_PROFILE_PATH.exists():
+        shutil.rmtree(BOLT_PROFILE_PATH)
+    BOLT_PROFILE_PATH.mkdir(parents=True)
+
+    rustc = package_dir / "bin" / "rustc"
+    print("Timing the training workload before optimization")
+    seconds_before = pgo.run_training_workload(rustc, env, targets)
+
+    for library in libraries:
+        instrument(library)
+    print("Collecting BOLT profiles")
+    pgo.run_training_workload(rustc, env, targets)
+
+    results = [optimize(library) for library in libraries]
+    for library in libraries:
+        backup_path(library).unlink()
+
+    print("Timing the training workload after optimization")
+    seconds_after = pgo.run_training_workload(rustc, env, targets)
+    speedup = seconds_before / max(seconds_after, 0.001)
+
+    with open(report_path, "w") as report:
+        report.write("before\tafter\tpath\n")
+        for result in results:
+            report.write(f"{result.size_before}\t{result.size_after}\t"
+                         f"{result.path.relative_to(package_dir)}\n")
+        report.write(f"# workload {seconds_before:.1f}s -> {seconds_after:.1f}s ({speedup:.3f}x)\n")
+
+    for result in results:
+        print("{}: {:.1f} MiB -> {:.1f} MiB".format(
+            result.path.name, result.size_before / 2**20, result.size_after / 2**20))
+    print(f"Training workload: {seconds_before:.1f}s -> {seconds_after:.1f}s ({speedup:.3f}x)")
+
+    saved = remove_static_relocations(package_dir)
+    print(f"Removed {saved / 2**20:.1f} MiB of relocations kept for BOLT")
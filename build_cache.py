@@ -0,0 +1,110 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed cache of the dist archives produced by do_build.py."""
+
+import argparse
+import hashlib
+import json
+from pathlib import Path
+import shutil
+from typing import Optional
+
+import archive
+import build_platform
+import config
+from paths import *
+from source_manager import source_tree_hash
+from utils import hash_directory, hash_file
+
+
+CACHE_ARCHIVE_NAME: str = "archive"
+CACHE_INPUTS_NAME:  str = "inputs.json"
+
+
+def hash_file_list(paths: list[Path]) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.name.encode())
+        digest.update(hash_file(path).encode())
+    return digest.hexdigest()
+
+
+def compute_build_inputs(args: argparse.Namespace) -> dict[str, str]:
+    """Returns a description of every input that determines the dist archive.
+
+    The build scripts are hashed along with the templates since they control
+    how config.toml and the compiler wrappers are rendered.
+    """
+    # An unset compression level and the format's default produce identical
+    # archives.
+    compression_level = args.compression_level
+    if compression_level is None:
+        compression_level = archive.ARCHIVE_FORMATS[args.dist_format].default_level
+
+    return {
+        "source":         source_tree_hash(RUST_SOURCE_PATH),
+        "patches":        hash_file_list(sorted(PATCHES_PATH.glob("rustc-*"))),
+        "templates":      hash_file_list(sorted(TEMPLATES_PATH.glob("*.template"))),
+        "scripts":        hash_file_list(sorted(TOOLCHAIN_PATH.glob("*.py"))),
+        "host":           build_platform.triple(),
+        "targets":        ",".join(config.select_targets(args.targets)),
+        "lto":            args.lto,
+        "bolt":           str(args.bolt),
+        "pgo":            hash_directory(PGO_CORPUS_PATH) if args.pgo else "",
+        "wrapper_mode":   args.wrapper_mode,
+        "std_workers":    str(args.std_workers),
+        "std_runner":     args.std_runner or "",
+        "dist_format":    args.dist_format,
+        "compression":    str(compression_level),
+        "rust_stage0":    RUST_VERSION_STAGE0,
+        "clang_revision": CLANG_REVISION,
+        "glibc_version":  GLIBC_VERSION,
+    }
+
+
+def compute_build_key(inputs: dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def entry_path(key: str) -> Path:
+    return ARTIFACT_CACHE_PATH / key[:2] / key
+
+
+def lookup(key: str) -> Optional[Path]:
+    """Returns the path of the cached archive for key, if there is one."""
+    archive_path = entry_path(key) / CACHE_ARCHIVE_NAME
+    return archive_path if archive_path.exists() else None
+
+
+def store(key: str, inputs: dict[str, str], archive_path: Path) -> None:
+    """Adds an archive to the cache.
+
+    The entry is assembled in a temporary directory and renamed into place so
+    that an interrupted store never produces a partial entry.
+    """
+    dest_path = entry_path(key)
+    if dest_path.exists():
+        return
+
+    tmp_path = dest_path.parent / (dest_path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    shutil.copyfile(archive_path, tmp_path / CACHE_ARCHIVE_NAME)
+    with open(tmp_path / CACHE_INPUTS_NAME, "w") as f:
+        json.dump(inputs, f, indent=2, sort_keys=True)
+
+    tmp_path.rename(dest_path)
@@ -0,0 +1,155 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Records a timeline of the build in the Chrome trace-event format.
+
+The resulting file can be loaded into chrome://tracing or Perfetto.
+"""
+
+from contextlib import contextmanager
+import functools
+import json
+import os
+from pathlib import Path
+import re
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+# Progress messages printed by the Rust bootstrap system when it starts a step,
+# e.g. "Building stage1 std artifacts (x86_64-unknown-linux-gnu -> ...)".
+BOOTSTRAP_STEP_PATTERN:  re.Pattern[str] = re.compile(
+    r"^(Building|Assembling|Copying|Uplifting|Installing|Install|Dist|Documenting) .*")
+BOOTSTRAP_STAGE_PATTERN: re.Pattern[str] = re.compile(r"\bstage(\d+)\b")
+
+
+class Tracer:
+    """Collects complete ("X") trace events for the spans of a build."""
+
+    def __init__(self) -> None:
+        self.events: list[dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.thread_ids: dict[int, int] = {}
+
+    def now(self) -> float:
+        """Returns the current time in microseconds since the trace started."""
+        return (time.monotonic() - self.origin) * 1e6
+
+    def thread_id(self) -> int:
+        # Thread idents are large and arbitrary; number threads in order of
+        # appearance instead so that the main thread is always 1.
+        ident = threading.get_ident()
+        with self.lock:
+            return self.thread_ids.setdefault(ident, len(self.thread_ids) + 1)
+
+    def add_span(self, name: str, start: float, end: float, tid: Optional[int] = None,
+        **args: Any) -> None:
+
+        event = {
+            "name": name,
+            "cat":  "build",
+            "ph":   "X",
+            "ts":   round(start),
+            "dur":  round(end - start),
+            "pid":  os.getpid(),
+            "tid":  tid if tid is not None else self.thread_id(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, self.now(), **args)
+
+    def save(self, path: Path) -> None:
+        with self.lock:
+            events = sorted(self.events, key=lambda event: (event["ts"], -event["dur"]))
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
+
+
+def span(name: str, **args: Any) -> Any:
+    """Context manager that records the enclosed code as a span."""
+    return TRACER.span(name, **args)
+
+
+def traced(name: str, func: Callable[..., T]) -> Callable[..., T]:
+    """Wraps func so that each call is recorded as a span."""
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        with TRACER.span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def save(path: Path) -> None:
+    TRACER.save(path)
+
+
+class BootstrapSteps:
+    """Turns the progress messages of an x.py invocation into nested spans.
+
+    Each step message starts a span that lasts until the next message.  Steps
+    that name a stage are grouped under a span for that stage.
+    """
+
+    def __init__(self, tracer: Tracer = TRACER) -> None:
+        self.tracer = tracer
+        self.tid = tracer.thread_id()
+        self.step: Optional[tuple[str, float]] = None
+        self.stage: Optional[tuple[str, float]] = None
+
+    def finish_step(self, now: float) -> None:
+        if self.step:
+            self.tracer.add_span(self.step[0], self.step[1], now, self.tid)
+            self.step = None
+
+    def finish_stage(self, now: float) -> None:
+        if self.stage:
+            self.tracer.add_span(self.stage[0], self.stage[1], now, self.tid)
+            self.stage = None
+
+    def feed(self, line: str) -> None:
+        line = line.strip()
+        if not BOOTSTRAP_STEP_PATTERN.match(line):
+            return
+
+        now = self.tracer.now()
+        self.finish_step(now)
+
+        stage_match = BOOTSTRAP_STAGE_PATTERN.search(line)
+        stage_name  = f"stage {stage_match.group(1)}" if stage_match else None
+        if self.stage and self.stage[0] != stage_name:
+            self.finish_stage(now)
+        if stage_name and not self.stage:
+            self.stage = (stage_name, now)
+
+        self.step = (line, now)
+
+    def finish(self) -> None:
+        now = self.tracer.now()
+        self.finish_step(now)
+        self.finish_stage(now)
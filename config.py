@@ -16,12 +16,16 @@
 import argparse
 import os
 from pathlib import Path
+import shutil
 import subprocess
 import stat
+import sys
 from string import Template
-from typing import Any
+from typing import Any, Optional
 
+import bolt
 import build_platform
+import llvm_cache
 from paths import *
 
 
@@ -44,6 +48,12 @@ HOST_CXX_WRAPPER_TEMPLATE:      Path = TEMPLATES_PATH / "host_cxx_wrapper.templa
 HOST_LINKER_WRAPPER_TEMPLATE:   Path = TEMPLATES_PATH / "host_linker_wrapper.template"
 HOST_TARGET_TEMPLATE:           Path = TEMPLATES_PATH / "host_target.template"
 
+WRAPPER_MODES: list[str] = ["script", "config"]
+
+# An empty archive that satisfies -lgcc, which NDK r23+ no longer provides.
+# The script wrappers filter the flag out instead.
+EMPTY_ARCHIVE: bytes = b"!<arch>\n"
+
 LINKER_PIC_FLAG:     str = "-Wl,-mllvm,-relocation-model=pic"
 MACOSX_VERSION_FLAG: str = "-mmacosx-version-min=10.14"
 
@@ -60,14 +70,120 @@ def instantiate_template_file(template_path: Path, output_path: Path, make_exec:
         output_path.chmod(output_path.stat().st_mode | stat.S_IEXEC)
 
 
-def host_config(target: str, macosx_flags: str, linker_flags: str) -> str:
-    cc_wrapper_name     = OUT_PATH_WRAPPERS / f"clang-{target}"
-    cxx_wrapper_name    = OUT_PATH_WRAPPERS / f"clang++-{target}"
-    linker_wrapper_name = OUT_PATH_WRAPPERS / f"linker-{target}"
+def compiler_launcher(args: argparse.Namespace, env: dict[str, str]) -> str:
+    """Returns the prefix used to route compiler invocations through ccache,
+    or the empty string if the compiler cache is disabled.
+
+    ccache hashes the full command line, so the flags injected by the
+    wrappers are part of every cache key.  The cache directory is bounded by
+    ccache's own size limit, which evicts the least recently used entries.
+    """
+    if not args.ccache:
+        return ""
+
+    ccache_path = shutil.which("ccache")
+    if not ccache_path:
+        sys.exit("The compiler cache was requested but ccache could not be found")
+
+    env["CCACHE_DIR"]     = Path(args.ccache_dir).resolve().as_posix()
+    env["CCACHE_MAXSIZE"] = args.ccache_max_size
+    # Rewrite absolute paths inside the workspace so that checkouts in
+    # different locations can share cache entries.
+    env["CCACHE_BASEDIR"] = WORKSPACE_PATH.as_posix()
+
+    return ccache_path + " "
+
+
+class ClangDriverConfigs:
+    """Creates compiler wrappers that don't need a shell.
+
+    Each wrapper is a hardlink to the clang driver.  When clang is invoked
+    through a name of the form <prefix>-clang or <prefix>-clang++ it loads the
+    configuration file <prefix>-clang[++].cfg from the directory it was run
+    from, which holds the flags that the script wrappers would have added.
+
+    As the driver runs from the wrappers directory, the resource directory is
+    passed explicitly and ld.lld is made available next to it.
+    """
+
+    def __init__(self, wrappers_path: Path) -> None:
+        self.path = wrappers_path
+        self.driver = wrappers_path / ".clang-driver"
+        self.libgcc_stub_path = wrappers_path / "libgcc-stub"
+
+        real_clang = CC_PATH.resolve()
+        if self.driver.exists():
+            self.driver.unlink()
+        try:
+            os.link(real_clang, self.driver)
+        except OSError:
+            # The prebuilts are on a different file system; links to a single
+            # private copy still avoid one copy per wrapper.
+            shutil.copy2(real_clang, self.driver)
+
+        lld_link = wrappers_path / "ld.lld"
+        if lld_link.is_symlink() or lld_link.exists():
+            lld_link.unlink()
+        lld_link.symlink_to(LLVM_PREBUILT_PATH / "bin" / "ld.lld")
+
+        self.libgcc_stub_path.mkdir(exist_ok=True)
+        (self.libgcc_stub_path / "libgcc.a").write_bytes(EMPTY_ARCHIVE)
+
+        self.resource_dir = subprocess.check_output(
+            [CC_PATH, "-print-resource-dir"], text=True).strip()
+
+    def create(self, name: str, flags: list[str]) -> Path:
+        wrapper_path = self.path / name
+        if wrapper_path.exists():
+            wrapper_path.unlink()
+        os.link(self.driver, wrapper_path)
+
+        with open(self.path / (name + ".cfg"), "w") as config_file:
+            for flag in [f"-resource-dir={self.resource_dir}"] + flags:
+                if flag:
+                    config_file.write(flag + "\n")
+
+        return wrapper_path
+
+
+def host_config(target: str, macosx_flags: str, linker_flags: str, launcher: str = "",
+    driver_configs: Optional[ClangDriverConfigs] = None, wrappers_path: Path = OUT_PATH_WRAPPERS,
+    llvm_config: Optional[Path] = None) -> str:
+
+    cc_wrapper_name     = wrappers_path / f"clang-{target}"
+    cxx_wrapper_name    = wrappers_path / f"clang++-{target}"
+    linker_wrapper_name = wrappers_path / f"linker-{target}"
+
+    if driver_configs:
+        cc_wrapper_name = driver_configs.create(f"{target}-clang",
+            [f"--target={target}", *macosx_flags.split(), "-fPIC"])
+        cxx_wrapper_name = driver_configs.create(f"{target}-clang++",
+            [f"--target={target}", "-stdlib=libc++", *macosx_flags.split(), f"-I{CXXSTD_PATH}", "-fPIC"])
+        linker_wrapper_name = driver_configs.create(f"{target}-link-clang++",
+            [f"--target={target}", "-stdlib=libc++", *macosx_flags.split(), *linker_flags.split()])
+
+    else:
+        instantiate_host_wrappers(target, macosx_flags, linker_flags, launcher,
+            cc_wrapper_name, cxx_wrapper_name, linker_wrapper_name)
+
+    with open(HOST_TARGET_TEMPLATE, "r") as template_file:
+        return Template(template_file.read()).substitute(
+            target=target,
+            cc=cc_wrapper_name,
+            cxx=cxx_wrapper_name,
+            linker=linker_wrapper_name,
+            ar=AR_PATH,
+            ranlib=RANLIB_PATH,
+            llvm_config=f'llvm-config = "{llvm_config}"' if llvm_config else "")
+
+
+def instantiate_host_wrappers(target: str, macosx_flags: str, linker_flags: str, launcher: str,
+    cc_wrapper_name: Path, cxx_wrapper_name: Path, linker_wrapper_name: Path) -> None:
 
     instantiate_template_exec(
         HOST_CC_WRAPPER_TEMPLATE,
         cc_wrapper_name,
+        launcher=launcher,
         real_cc=CC_PATH,
         target=target,
         macosx_flags=macosx_flags)
@@ -75,6 +191,7 @@ def host_config(target: str, macosx_flags: str, linker_flags: str) -> str:
     instantiate_template_exec(
         HOST_CXX_WRAPPER_TEMPLATE,
         cxx_wrapper_name,
+        launcher=launcher,
         real_cxx=CXX_PATH,
         target=target,
         macosx_flags=macosx_flags,
@@ -88,17 +205,10 @@ def host_config(target: str, macosx_flags: str, linker_flags: str) -> str:
         macosx_flags=macosx_flags,
         linker_flags=linker_flags)
 
-    with open(HOST_TARGET_TEMPLATE, "r") as template_file:
-        return Template(template_file.read()).substitute(
-            target=target,
-            cc=cc_wrapper_name,
-            cxx=cxx_wrapper_name,
-            linker=linker_wrapper_name,
-            ar=AR_PATH,
-            ranlib=RANLIB_PATH)
 
+def device_config(target: str, lto_flag: str, linker_flags: str, launcher: str = "",
+    driver_configs: Optional[ClangDriverConfigs] = None) -> str:
 
-def device_config(target: str, lto_flag: str, linker_flags: str) -> str:
     cc_wrapper_name     = OUT_PATH_WRAPPERS / f"clang-{target}"
     linker_wrapper_name = OUT_PATH_WRAPPERS / f"linker-{target}"
 
@@ -107,9 +217,32 @@ def device_config(target: str, lto_flag: str, linker_flags: str) -> str:
     if target in LTO_DENYLIST_TARGETS:
         lto_flag = ""
 
+    if driver_configs:
+        cc_wrapper_name = driver_configs.create(f"{target}-clang",
+            [f"--target={clang_target}", f"--sysroot={NDK_SYSROOT_PATH}", "-fPIC", lto_flag])
+        linker_wrapper_name = driver_configs.create(f"{target}-link-clang",
+            ["-fuse-ld=lld", f"--target={clang_target}", f"--sysroot={NDK_SYSROOT_PATH}",
+             *linker_flags.split(), lto_flag, f"-L{driver_configs.libgcc_stub_path}"])
+
+    else:
+        instantiate_device_wrappers(clang_target, lto_flag, linker_flags, launcher,
+            cc_wrapper_name, linker_wrapper_name)
+
+    with open(DEVICE_TARGET_TEMPLATE, "r") as template_file:
+        return Template(template_file.read()).substitute(
+            target=target,
+            cc=cc_wrapper_name,
+            linker=linker_wrapper_name,
+            ar=AR_PATH)
+
+
+def instantiate_device_wrappers(clang_target: str, lto_flag: str, linker_flags: str, launcher: str,
+    cc_wrapper_name: Path, linker_wrapper_name: Path) -> None:
+
     instantiate_template_exec(
         DEVICE_CC_WRAPPER_TEMPLATE,
         cc_wrapper_name,
+        launcher=launcher,
         real_cc=CC_PATH,
         target=clang_target,
         sysroot=NDK_SYSROOT_PATH,
@@ -124,16 +257,46 @@ def device_config(target: str, lto_flag: str, linker_flags: str) -> str:
         linker_flags=linker_flags,
         lto_flag=lto_flag)
 
-    with open(DEVICE_TARGET_TEMPLATE, "r") as template_file:
-        return Template(template_file.read()).substitute(
-            target=target,
-            cc=cc_wrapper_name,
-            linker=linker_wrapper_name,
-            ar=AR_PATH)
+
+def select_targets(targets_arg: Optional[str]) -> list[str]:
+    """Returns the targets to build given a comma-separated list of target
+    names, or all targets if the list is None.  The build platform's own triple
+    is always included as the compiler itself is built for it."""
+    if targets_arg is None:
+        return ALL_TARGETS
+
+    requested = {target.strip() for target in targets_arg.split(",") if target.strip()}
+    unknown = requested - set(ALL_TARGETS)
+    if unknown:
+        sys.exit("Unknown target(s): {}. Valid targets are: {}".format(
+            ", ".join(sorted(unknown)), ", ".join(ALL_TARGETS)))
+
+    requested.add(build_platform.triple())
+    return [target for target in ALL_TARGETS if target in requested]
+
+
+def is_partial_build(targets: list[str]) -> bool:
+    return set(targets) != set(ALL_TARGETS)
 
 
-def configure(args: argparse.Namespace, env: dict[str, str]) -> None:
-    """Generates config.toml and compiler wrapers for the rustc build."""
+def split_std_targets(args: argparse.Namespace) -> tuple[list[str], list[str]]:
+    """Returns the targets built by the main x.py invocation and the device
+    targets whose standard libraries are built separately by std_fanout."""
+    targets = select_targets(args.targets)
+    if not args.std_workers:
+        return (targets, [])
+    return ([target for target in targets if target not in DEVICE_TARGETS],
+            [target for target in targets if target in DEVICE_TARGETS])
+
+
+def std_config_path(target: str) -> Path:
+    return OUT_PATH_STD_BUILDS / target / "config.toml"
+
+
+def configure(args: argparse.Namespace, env: dict[str, str]) -> dict[str, str]:
+    """Generates config.toml and compiler wrapers for the rustc build.
+    Returns the inputs that determine the LLVM build, as used to key the LLVM
+    cache."""
 
     #
     # Compute compiler/linker flags
@@ -145,6 +308,7 @@ def configure(args: argparse.Namespace, env: dict[str, str]) -> None:
     host_bin_search:    str = ("-B" + GCC_TOOLCHAIN_PATH.as_posix()) if build_platform.is_linux() else ""
     host_llvm_libpath:  str = f"-L{LLVM_CXX_RUNTIME_PATH.as_posix()}"
     host_rpath_runtime: str = f"-Wl,-rpath,{build_platform.rpath_origin()}/../lib64"
+    host_bolt_flag:     str = bolt.BOLT_LINKER_FLAG if args.bolt else ""
 
     if build_platform.is_darwin():
         # Apple removed the normal sysroot at / on Mojave+, so we need
@@ -238,13 +402,45 @@ def configure(args: argparse.Namespace, env: dict[str, str]) -> None:
     # Intantiate wrappers
     #
 
+    targets = select_targets(args.targets)
+    main_targets, fanout_targets = split_std_targets(args)
+    launcher = compiler_launcher(args, env)
+
+    # Configuration files aren't interpreted by a shell, so they take the
+    # unescaped linker flags.
+    driver_configs: Optional[ClangDriverConfigs] = None
+    if args.wrapper_mode == "config":
+        if launcher:
+            sys.exit("The compiler cache can't be used with configuration file wrappers")
+        if build_platform.is_linux():
+            driver_configs = ClangDriverConfigs(OUT_PATH_WRAPPERS)
+            host_linker_flags_escaped = host_linker_flags
+        else:
+            print("Configuration file wrappers are only supported on Linux; using scripts")
+
+    # A cached LLVM build replaces the one for the build platform.  PGO builds
+    # need to build LLVM themselves, first instrumented and then optimized.
+    llvm_inputs = llvm_cache.compute_llvm_inputs(lto_flag, lto_flag, host_linker_flags, args.lto)
+    llvm_config = None
+    if not args.no_llvm_cache and not args.pgo:
+        llvm_config = llvm_cache.lookup(llvm_cache.compute_key(llvm_inputs))
+        if llvm_config:
+            print(f"Using cached LLVM build {llvm_config}")
+
+    # Only the Rust build links librustc_driver, so LLVM is built without the
+    # BOLT flag.
+    host_wrapper_linker_flags = " ".join([host_linker_flags_escaped, host_bolt_flag]).rstrip()
+
     host_configs = "\n".join(
-        [host_config(target, macosx_flags, host_linker_flags_escaped) for target in HOST_TARGETS])
+        [host_config(target, macosx_flags, host_wrapper_linker_flags, launcher, driver_configs,
+                     llvm_config=llvm_config if target == build_platform.triple() else None)
+         for target in HOST_TARGETS if target in targets])
     device_configs = "\n".join(
-        [device_config(target, lto_flag, device_linker_flags) for target in DEVICE_TARGETS])
+        [device_config(target, lto_flag, device_linker_flags, launcher, driver_configs)
+         for target in DEVICE_TARGETS if target in targets])
 
-    all_targets = "[" + ",".join(
-        ['"' + target + '"' for target in ALL_TARGETS]) + ']'
+    def target_list(targets: list[str]) -> str:
+        return "[" + ",".join(['"' + target + '"' for target in targets]) + ']'
 
     instantiate_template_file(
         CONFIG_TOML_TEMPLATE,
@@ -252,9 +448,31 @@ def configure(args: argparse.Namespace, env: dict[str, str]) -> None:
         llvm_cflags=lto_flag,
         llvm_cxxflags=lto_flag,
         llvm_ldflags=host_linker_flags,
-        all_targets=all_targets,
+        all_targets=target_list(main_targets),
         cargo=CARGO_PATH,
         rustc=RUSTC_PATH,
         python=PYTHON_PATH,
+        local_rebuild="false",
         host_configs=host_configs,
         device_configs=device_configs)
+
+    # The standard libraries built by std_fanout are compiled by the
+    # toolchain in the package, which is a local rebuild as far as the
+    # bootstrap system is concerned.
+    for target in fanout_targets:
+        std_config_path(target).parent.mkdir(parents=True, exist_ok=True)
+        instantiate_template_file(
+            CONFIG_TOML_TEMPLATE,
+            std_config_path(target),
+            llvm_cflags=lto_flag,
+            llvm_cxxflags=lto_flag,
+            llvm_ldflags=host_linker_flags,
+            all_targets=target_list([target]),
+            cargo=OUT_PATH_PACKAGE / "bin" / "cargo",
+            rustc=OUT_PATH_PACKAGE / "bin" / "rustc",
+            python=PYTHON_PATH,
+            local_rebuild="true",
+            host_configs=host_configs,
+            device_configs=device_configs)
+
+    return llvm_inputs
@@ -17,6 +17,8 @@
 """Creates a tarball suitable for use as a Rust prebuilt for Android."""
 
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import os
 import os.path
 from pathlib import Path
@@ -25,8 +27,18 @@ import source_manager
 import subprocess
 import sys
 
+import archive
+import bolt
+import build_cache
 import build_platform
+import build_trace
 import config
+import llvm_cache
+import pgo
+import resource_sampler
+import std_fanout
+import stdlib_sources
+import strip_binaries
 from paths import *
 from utils import run_and_exit_on_failure, run_quiet, run_quiet_and_exit_on_failure
 
@@ -79,9 +91,89 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--no-patch-abort",
                         help="Don't abort on patch failure. \
                         Useful for local development.")
+    parser.add_argument("--pgo", action="store_true",
+                        help="Optimize rustc and LLVM with profiles collected \
+                        by compiling the training corpus")
+    parser.add_argument("--bolt", action="store_true",
+                        help="Optimize librustc_driver, including the LLVM \
+                        linked into it, with BOLT using the PGO training \
+                        corpus (Linux only)")
+    parser.add_argument("--dist-format", default=archive.DEFAULT_ARCHIVE_FORMAT,
+                        choices=list(archive.ARCHIVE_FORMATS),
+                        help="Compression format of the dist archive. \
+                        Defaults to pigz if it is installed and gz otherwise.")
+    parser.add_argument("--compression-level", type=int,
+                        help="Compression level for the dist archive. \
+                        Defaults to a per-format level.")
+    parser.add_argument("--ccache", action="store_true",
+                        help="Route C/C++ compilations through ccache")
+    parser.add_argument("--ccache-dir", default=COMPILER_CACHE_PATH,
+                        help="Directory holding the compiler cache")
+    parser.add_argument("--ccache-max-size", default="50G",
+                        help="Size limit of the compiler cache (e.g. 50G)")
+    parser.add_argument("--targets", metavar="TARGET[,TARGET...]",
+                        help="Only build the standard library for these \
+                        targets.  The package is marked as partial and \
+                        can't be used to update the prebuilts.")
+    parser.add_argument("--std-workers", type=int, default=0,
+                        help="Build the device standard libraries separately \
+                        from the host toolchain, this many at a time")
+    parser.add_argument("--std-runner", metavar="COMMAND",
+                        help="Launcher used to run the standard library builds \
+                        on other machines.  It is passed the working directory \
+                        followed by the command.  Builds run locally by default.")
+    parser.add_argument("--wrapper-mode", default="script",
+                        choices=config.WRAPPER_MODES,
+                        help="Wrap the compilers with shell scripts, or with \
+                        links to clang that read configuration files (Linux only)")
+    parser.add_argument("--sample-interval", type=float, default=2.0,
+                        help="Seconds between resource usage samples of the \
+                        x.py build. Use 0 to disable sampling.")
+    parser.add_argument("--link-farm", action="store_true",
+                        help="Build the patched source tree as a hardlink farm \
+                        when the file system doesn't support reflinks, \
+                        copying only the files touched by patches")
+    parser.add_argument("--validate-patches", action="store_true",
+                        help="Dry-run every patch against the Rust source in \
+                        parallel, report all failures and exit")
+    parser.add_argument("--no-llvm-cache", action="store_true",
+                        help="Always build LLVM rather than using a cached build")
+    parser.add_argument("--llvm-cache-size", type=float,
+                        default=llvm_cache.DEFAULT_CACHE_SIZE_GIB,
+                        help="Size limit of the LLVM cache in GiB")
+    parser.add_argument("--no-build-cache", action="store_true",
+                        help="Always rebuild and don't store the result in the \
+                        artifact cache")
     return parser.parse_args()
 
 
+def run_x_py(x_py_args: list[str], env: dict[str, str], sample_interval: float = 0) -> int:
+    """Runs x.py, echoing its output and recording its steps in the build
+    trace.  If sample_interval is positive the resource usage of the build is
+    sampled and written to DIST_PATH.  Returns the exit code."""
+    steps = build_trace.BootstrapSteps()
+    process = subprocess.Popen(
+        [str(PYTHON_PATH), str(OUT_PATH_RUST_SOURCE / "x.py")] + x_py_args,
+        cwd=OUT_PATH_RUST_SOURCE, env=env, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, text=True, errors="replace", bufsize=1)
+
+    sampler = resource_sampler.start_sampler(process.pid, sample_interval)
+
+    assert process.stdout is not None
+    for line in process.stdout:
+        sys.stdout.write(line)
+        steps.feed(line)
+
+    returncode = process.wait()
+    steps.finish()
+
+    if sampler:
+        sampler.stop()
+        sampler.save(DIST_PATH / "build-resources.csv", DIST_PATH / "build-resources-summary.json")
+
+    return returncode
+
+
 def main() -> None:
     """Runs the configure-build-fixup-dist pipeline."""
     args = parse_args()
@@ -90,6 +182,19 @@ def main() -> None:
     # Add some output padding to make the messages easier to read
     print()
 
+    if args.validate_patches:
+        sys.exit(0 if source_manager.validate_patches(RUST_SOURCE_PATH, PATCHES_PATH) else 1)
+
+    if args.bolt:
+        if not build_platform.is_linux():
+            sys.exit("BOLT is only supported on Linux")
+        bolt.check_tools()
+
+    # The instrumented compiler is trained by compiling for the device
+    # targets, whose standard libraries the fan-out leaves out of its build.
+    if args.pgo and args.std_workers:
+        sys.exit("--pgo can't be combined with --std-workers")
+
     #
     # Initialize directories
     #
@@ -100,75 +205,148 @@ def main() -> None:
 
     DIST_PATH.mkdir(exist_ok=True)
 
+    atexit.register(build_trace.save, DIST_PATH / "build-trace.json")
+
+    dist_format  = archive.ARCHIVE_FORMATS[args.dist_format]
+    tarball_path = DIST_PATH / "rust-{0}{1}".format(build_name, dist_format.extension)
+
+    #
+    # Check the artifact cache
+    #
+
+    # Computing the inputs hashes the source tree, so it's skipped entirely
+    # when the cache is disabled.
+    if not args.no_build_cache:
+        build_inputs = build_cache.compute_build_inputs(args)
+        build_key    = build_cache.compute_build_key(build_inputs)
+        cached_archive = build_cache.lookup(build_key)
+        if cached_archive:
+            print(f"Reusing cached build {build_key}")
+            shutil.copyfile(cached_archive, tarball_path)
+            return
+
     #
     # Setup source files
     #
 
-    source_manager.setup_files(
-      RUST_SOURCE_PATH, OUT_PATH_RUST_SOURCE, PATCHES_PATH,
-      no_patch_abort=args.no_patch_abort)
+    with build_trace.span("source setup"):
+        source_manager.setup_files(
+          RUST_SOURCE_PATH, OUT_PATH_RUST_SOURCE, PATCHES_PATH,
+          no_patch_abort=args.no_patch_abort, link_farm=args.link_farm)
 
     #
     # Configure Rust
     #
 
     env = dict(os.environ)
-    config.configure(args, env)
+    with build_trace.span("configure"):
+        llvm_inputs = config.configure(args, env)
 
     # Trigger bootstrap to trigger vendoring
     #
     # Call is not checked because this is *expected* to fail - there isn't a
     # user facing way to directly trigger the bootstrap, so we give it a
     # no-op to perform that will require it to write out the cargo config.
-    run_quiet([PYTHON_PATH, OUT_PATH_RUST_SOURCE / "x.py", "--help"], cwd=OUT_PATH_RUST_SOURCE)
+    with build_trace.span("bootstrap"):
+        run_quiet([PYTHON_PATH, OUT_PATH_RUST_SOURCE / "x.py", "--help"], cwd=OUT_PATH_RUST_SOURCE)
 
     # Offline fetch to regenerate lockfile
     #
     # Because some patches may have touched vendored source we will rebuild
     # Cargo.lock
-    run_and_exit_on_failure(
-        [CARGO_PATH, "fetch", "--offline"],
-        "Failed to rebuilt Cargo.lock via cargo-fetch operation",
-        cwd=OUT_PATH_RUST_SOURCE, env=env)
+    with build_trace.span("cargo fetch"):
+        run_and_exit_on_failure(
+            [CARGO_PATH, "fetch", "--offline"],
+            "Failed to rebuilt Cargo.lock via cargo-fetch operation",
+            cwd=OUT_PATH_RUST_SOURCE, env=env)
 
     #
     # Build
     #
 
-    result = subprocess.run(
-        [PYTHON_PATH, OUT_PATH_RUST_SOURCE / "x.py", "--stage", "3", "install"],
-        cwd=OUT_PATH_RUST_SOURCE, env=env)
+    if args.ccache:
+        run_quiet_and_exit_on_failure(["ccache", "--zero-stats"],
+            "Failed to reset compiler cache statistics", env=env)
+
+    device_targets = [target for target in config.select_targets(args.targets)
+                      if target in config.DEVICE_TARGETS]
+
+    profile_flags: list[str] = []
+    if args.pgo:
+        pgo.prepare()
+        for phase in pgo.PGO_PHASES:
+            with build_trace.span(f"pgo {phase.name} instrumented build"):
+                returncode = run_x_py(["--stage", "2", "build", "library/std"] + phase.instrument_flags, env)
+            if returncode != 0:
+                sys.exit(f"Instrumented {phase.name} build failed with error {returncode}")
+
+            with build_trace.span(f"pgo {phase.name} training"):
+                pgo.train(phase, env, device_targets)
+            with build_trace.span(f"pgo {phase.name} merge"):
+                pgo.merge_profiles(phase)
+
+            pgo.clean_instrumented_build()
+        profile_flags = pgo.profile_use_flags()
+
+    with build_trace.span("x.py install"):
+        returncode = run_x_py(["--stage", "3", "install"] + profile_flags, env, args.sample_interval)
 
-    if result.returncode != 0:
-        print(f"Build stage failed with error {result.returncode}")
+    if args.ccache:
+        ccache_stats = run_and_exit_on_failure(["ccache", "--show-stats"],
+            "Failed to read compiler cache statistics",
+            env=env, stdout=subprocess.PIPE, text=True).stdout
+        print(ccache_stats)
+        with open(DIST_PATH / "ccache-stats.txt", "w") as f:
+            f.write(ccache_stats)
+
+    if returncode != 0:
+        print(f"Build stage failed with error {returncode}")
         tarball_path = DIST_PATH / "llvm-build-config.tar.gz"
         run_quiet_and_exit_on_failure(
             ["tar", "czf", tarball_path.as_posix()] + LLVM_BUILD_PATHS_OF_INTEREST,
             "Could not generate logs/artifacts archive upon build failure",
             cwd=LLVM_BUILD_PATH)
-        sys.exit(result.returncode)
+        sys.exit(returncode)
+
+    if not args.no_llvm_cache and not args.pgo:
+        with build_trace.span("llvm cache store"):
+            llvm_cache.store(llvm_cache.compute_key(llvm_inputs), llvm_inputs,
+                llvm_cache.llvm_install_path(), args.llvm_cache_size)
+
+    _, fanout_targets = config.split_std_targets(args)
+    if fanout_targets:
+        with build_trace.span("std fan-out"):
+            std_fanout.build_std_targets(fanout_targets, env, args.std_workers, args.std_runner)
+
+    if args.bolt:
+        with build_trace.span("bolt"):
+            bolt.optimize_package(OUT_PATH_PACKAGE, env, device_targets, DIST_PATH / "bolt-report.tsv")
+
+    # Mark packages that lack some of the targets so that they can't be
+    # mistaken for a release build.
+    targets = config.select_targets(args.targets)
+    partial_marker_path = OUT_PATH_PACKAGE / PARTIAL_PACKAGE_MARKER
+    if config.is_partial_build(targets):
+        print(f"Built a partial package for: {', '.join(targets)}")
+        partial_marker_path.write_text("\n".join(targets) + "\n")
+    elif partial_marker_path.exists():
+        partial_marker_path.unlink()
 
     # Install sources
+    #
+    # This is pure I/O, so it runs in the background while the binaries are
+    # being stripped.
+    background = ThreadPoolExecutor(max_workers=1)
     if build_platform.is_linux():
-        shutil.rmtree(OUT_PATH_STDLIB_SRCS, ignore_errors=True)
-        for stdlib in STDLIB_SOURCES:
-            shutil.copytree(OUT_PATH_RUST_SOURCE / stdlib, OUT_PATH_STDLIB_SRCS / stdlib)
+        stdlib_install = background.submit(
+            build_trace.traced("stdlib source install", stdlib_sources.install_sources),
+            OUT_PATH_RUST_SOURCE, OUT_PATH_STDLIB_SRCS, STDLIB_SOURCES)
 
     # Fixup
     # The Rust build doesn't have an option to auto-strip binaries, so we do
-    # it here.
-    # We don't attempt to strip .rlibs since it prevents building Rust binaries.
-    # We don't attempt to strip anything under rustlib/ since these include
-    # both debug symbols which we may want to link into user code and Rust
-    # metadata needed at build time.
-    binaries = [path.as_posix() for path in list(
-            (OUT_PATH_PACKAGE / "lib").glob("*.so")) + [
-            OUT_PATH_PACKAGE / "bin" / "rustc",
-            OUT_PATH_PACKAGE / "bin" / "cargo",
-            OUT_PATH_PACKAGE / "bin" / "rustdoc"]]
-    run_quiet_and_exit_on_failure(
-        ["strip", "-S"] + binaries,
-        "Failed to strip debugging info from generated binaries")
+    # it here.  See strip_binaries for the files that are left intact.
+    with build_trace.span("strip"):
+        strip_binaries.strip_package(OUT_PATH_PACKAGE, DIST_PATH / "strip-sizes.tsv")
 
     # Install the libc++ library to out/package/lib64/
     if build_platform.is_darwin():
@@ -178,20 +356,25 @@ def main() -> None:
 
     lib64_path = OUT_PATH_PACKAGE / "lib64"
     lib64_path.mkdir(exist_ok=True)
-    shutil.copy2(LLVM_CXX_RUNTIME_PATH / libcxx_name,
-                 lib64_path / libcxx_name)
+    with build_trace.span("libc++ copy"):
+        shutil.copy2(LLVM_CXX_RUNTIME_PATH / libcxx_name,
+                     lib64_path / libcxx_name)
 
-    # Some stdlib crates might include Android.mk or Android.bp files.
-    # If they do, filter them out.
     if build_platform.is_linux():
-        for f in OUT_PATH_STDLIB_SRCS.glob("**/Android.{mk,bp}"):
-            f.unlink()
+        print(f"Installed stdlib sources: {stdlib_install.result().report()}")
+    background.shutdown()
 
     # Dist
     print("Creating distribution archive")
-    tarball_path = DIST_PATH / "rust-{0}.tar.gz".format(build_name)
-    subprocess.check_call(["tar", "czf", tarball_path, "."],
-        cwd=OUT_PATH_PACKAGE)
+    with build_trace.span("dist archive", format=dist_format.name):
+        archive_stats = archive.create_archive(
+            OUT_PATH_PACKAGE, tarball_path, dist_format, args.compression_level)
+    print(f"Created {tarball_path.name}: {archive_stats.report()}")
+
+    # Builds that skipped failing patches are not representative of their
+    # inputs and are kept out of the cache.
+    if not args.no_patch_abort and not args.no_build_cache:
+        build_cache.store(build_key, build_inputs, tarball_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Manages the cache of artifacts downloaded from the build server.
+
+Every cached file is recorded in an index with its SHA-256 digest, size, the
+build it came from and when it was last used.  Files are verified against the
+index before they are reused, downloads are written to temporary files that
+are only renamed into the cache once complete, and the least recently used
+files are evicted to keep the cache below a size limit.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from paths import DOWNLOADS_PATH
+from utils import hash_file
+
+
+DEFAULT_CACHE_SIZE_GIB: float = 20.0
+
+INDEX_NAME: str = "index.json"
+PARTIAL_SUFFIX: str = ".part"
+
+# Partial downloads modified more recently than this may still be written to
+PARTIAL_MAX_AGE_S: float = 24 * 60 * 60
+
+
+class CacheEntry(NamedTuple):
+    sha256:      str
+    size:        int
+    build_id:    Optional[int]
+    last_access: float
+
+
+class DownloadCache:
+    """A directory of downloaded files and the index describing them.
+
+    Methods may be called from multiple threads.
+    """
+
+    def __init__(self, root: Path = DOWNLOADS_PATH, max_size_gib: float = DEFAULT_CACHE_SIZE_GIB) -> None:
+        self.root = root
+        self.max_size_gib = max_size_gib
+        self.lock = threading.Lock()
+        self.entries: dict[str, CacheEntry] = {}
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(self.root / INDEX_NAME) as f:
+                self.entries = {name: CacheEntry(**entry) for name, entry in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            self.entries = {}
+
+    def save(self) -> None:
+        # Callers hold the lock.
+        tmp_path = self.root / (INDEX_NAME + PARTIAL_SUFFIX)
+        with open(tmp_path, "w") as f:
+            json.dump({name: entry._asdict() for name, entry in sorted(self.entries.items())},
+                f, indent=2)
+        tmp_path.rename(self.root / INDEX_NAME)
+
+    def path(self, name: str) -> Path:
+        return self.root / name
+
+    def partial_path(self, name: str) -> Path:
+        """Returns the temporary file a download of name should be written to."""
+        return self.root / (name + PARTIAL_SUFFIX)
+
+    def verify(self, name: str) -> bool:
+        entry = self.entries.get(name)
+        path = self.path(name)
+        return (entry is not None and path.exists() and
+                path.stat().st_size == entry.size and hash_file(path) == entry.sha256)
+
+    def remove(self, name: str) -> None:
+        # Callers hold the lock.
+        self.entries.pop(name, None)
+        self.path(name).unlink(missing_ok=True)
+
+    def lookup(self, name: str) -> Optional[Path]:
+        """Returns the path of a cached file if it is present and intact.
+        Files that fail verification, or that aren't in the index, are
+        removed."""
+        path = self.path(name)
+        if not self.verify(name):
+            if path.exists() or name in self.entries:
+                print(f"Discarding unverified download {name}")
+                with self.lock:
+                    self.remove(name)
+                    self.save()
+            return None
+
+        with self.lock:
+            self.entries[name] = self.entries[name]._replace(last_access=time.time())
+            self.save()
+        return path
+
+    def add(self, name: str, build_id: Optional[int] = None) -> Path:
+        """Moves a completed download from its partial path into the cache,
+        records it and evicts old files if the cache is over its limit."""
+        partial_path = self.partial_path(name)
+        entry = CacheEntry(hash_file(partial_path), partial_path.stat().st_size, build_id, time.time())
+        partial_path.rename(self.path(name))
+
+        with self.lock:
+            self.entries[name] = entry
+            self.evict(keep=name)
+            self.save()
+        return self.path(name)
+
+    def discard_partial(self, name: str) -> None:
+        self.partial_path(name).unlink(missing_ok=True)
+
+    def total_size(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    def evict(self, keep: Optional[str] = None) -> list[str]:
+        """Removes the least recently used files until the cache is within its
+        size limit and returns their names.  Callers hold the lock."""
+        evicted: list[str] = []
+        total_size = self.total_size()
+        for name, entry in sorted(self.entries.items(), key=lambda item: item[1].last_access):
+            if total_size <= self.max_size_gib * 2**30:
+                break
+            if name == keep:
+                continue
+            self.remove(name)
+            total_size -= entry.size
+            evicted.append(name)
+        return evicted
+
+    def prune(self) -> list[str]:
+        """Removes files and index entries that don't belong to the cache, then
+        evicts files above the size limit.
+
+        Directories are left alone, as are partial downloads that another run
+        may still be writing.
+        """
+        removed: list[str] = []
+        with self.lock:
+            for name in list(self.entries):
+                if not self.path(name).exists():
+                    self.entries.pop(name)
+                    removed.append(name)
+            for path in self.root.iterdir():
+                if path.name == INDEX_NAME or path.name in self.entries or path.is_dir():
+                    continue
+                if (path.name.endswith(PARTIAL_SUFFIX) and
+                    time.time() - path.stat().st_mtime < PARTIAL_MAX_AGE_S):
+                    continue
+                path.unlink()
+                removed.append(path.name)
+            removed.extend(self.evict())
+            self.save()
+        return removed
+
+
+#
+# Command line interface
+#
+
+def list_entries(cache: DownloadCache) -> None:
+    for name, entry in sorted(cache.entries.items(), key=lambda item: item[1].last_access, reverse=True):
+        print("{:>10.1f} MiB  {}  build {:<10} {}".format(
+            entry.size / 2**20,
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_access)),
+            entry.build_id if entry.build_id is not None else "-", name))
+    print("{:>10.1f} MiB  total (limit {:g} GiB)".format(cache.total_size() / 2**20, cache.max_size_gib))
+
+
+def verify_entries(cache: DownloadCache) -> bool:
+    bad = [name for name in sorted(cache.entries) if not cache.verify(name)]
+    for name in bad:
+        print(f"Corrupt: {name}")
+    print(f"Verified {len(cache.entries) - len(bad)} of {len(cache.entries)} files")
+    return not bad
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cache-dir", type=Path, default=DOWNLOADS_PATH,
+                        help="Download cache directory")
+    parser.add_argument("--max-size", type=float, default=DEFAULT_CACHE_SIZE_GIB,
+                        help="Size limit of the cache in GiB")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List cached files, most recently used first")
+    subparsers.add_parser("verify", help="Check every cached file against the index")
+    subparsers.add_parser("prune", help="Remove unindexed files and evict files above the size limit")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    cache = DownloadCache(args.cache_dir, args.max_size)
+    if args.command == "list":
+        list_entries(cache)
+    elif args.command == "verify":
+        sys.exit(0 if verify_entries(cache) else 1)
+    elif args.command == "prune":
+        for name in cache.prune():
+            print(f"Removed {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,33 +16,47 @@
 
 
 import argparse
-
-from paths import RUST_SOURCE_PATH
+import http.client
+from pathlib import Path
+import subprocess
+import sys
+import time
+from typing import Optional
+import urllib.error
+import urllib.request
+
+import archive
+from paths import RUST_SOURCE_PATH, SOURCE_DOWNLOADS_PATH
 import utils
 
 BRANCH_NAME_TEMPLATE: str = "rust-update-source-%s"
 
-COMMAND_FETCH: str = "curl --proto '=https' --tlsv1.2 -f %s | tar xz --strip-components=1"
-
 COMMIT_MESSAGE: str = "Importing rustc-%s"
 
 RUST_REPO = utils.GitRepo(RUST_SOURCE_PATH)
 
-RUST_SOURCE_URL_VERSION_TEMPLATE: str = "https://static.rust-lang.org/dist/rustc-%s-src.tar.gz"
-RUST_SOURCE_URL_BETA            : str = "https://static.rust-lang.org/dist/rustc-beta-src.tar.gz"
-RUST_SOURCE_URL_NIGHTLY         : str = "https://static.rust-lang.org/dist/rustc-nightly-src.tar.gz"
+RUST_DIST_URL: str = "https://static.rust-lang.org/dist"
+
+RUST_SOURCE_ARCHIVE_VERSION_TEMPLATE: str = "rustc-%s-src.tar.gz"
+RUST_SOURCE_ARCHIVE_BETA            : str = "rustc-beta-src.tar.gz"
+RUST_SOURCE_ARCHIVE_NIGHTLY         : str = "rustc-nightly-src.tar.gz"
+
+DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024
+DOWNLOAD_ATTEMPTS:   int = 5
+DOWNLOAD_TIMEOUT:    int = 60
 
 #
 # String operations
 #
 
-def construct_archive_url(build_type: str, rust_version: str) -> str:
+def construct_archive_url(build_type: str, rust_version: str, dist_url: str = RUST_DIST_URL) -> str:
     if build_type == 'nightly':
-        return RUST_SOURCE_URL_NIGHTLY
+        archive_name = RUST_SOURCE_ARCHIVE_NIGHTLY
     elif build_type == 'beta':
-        return RUST_SOURCE_URL_BETA
+        archive_name = RUST_SOURCE_ARCHIVE_BETA
     else:
-        return RUST_SOURCE_URL_VERSION_TEMPLATE % rust_version
+        archive_name = RUST_SOURCE_ARCHIVE_VERSION_TEMPLATE % rust_version
+    return f"{dist_url.rstrip('/')}/{archive_name}"
 
 
 def get_extra_tag(build_type: str) -> str:
@@ -85,28 +99,116 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "-o", "--overwrite", dest="overwrite", action="store_true",
         help="Overwrite the target branch if it exists")
+    parser.add_argument(
+        "--dist-url", metavar="URL", dest="dist_url", default=RUST_DIST_URL,
+        help="Server to fetch the source archive and its checksum from")
 
     parser.add_argument("rust_version", action="store", type=utils.version_string_type)
 
     return parser.parse_args()
 
 
-def clean_repository() -> None:
-    print("Deleting old files")
-    RUST_REPO.rm('*')
-
+def fetch_text(url: str) -> str:
+    try:
+        with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+            text: str = response.read().decode()
+            return text
+    except (urllib.error.URLError, http.client.HTTPException, OSError, UnicodeDecodeError) as e:
+        sys.exit(f"Failed to fetch {url}: {e}")
+
+
+def download_file(url: str, dest: Path) -> None:
+    """Downloads url to dest, resuming from the bytes already present in a
+    previous partial download.  Interrupted transfers are retried and resumed
+    with HTTP range requests."""
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        offset = dest.stat().st_size if dest.exists() else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+
+        try:
+            with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                # A server that ignores the range sends the whole file again.
+                resumed = bool(offset) and response.status == 206
+                if offset and not resumed:
+                    print("Server doesn't support resuming; restarting the download")
+                elif resumed:
+                    print(f"Resuming download at {offset / 2**20:.1f} MiB")
+
+                with open(dest, "ab" if resumed else "wb") as f:
+                    while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+
+                length = response.headers.get("Content-Length")
+                if length is not None and dest.stat().st_size != (offset if resumed else 0) + int(length):
+                    raise http.client.IncompleteRead(b"")
+                return
+
+        except urllib.error.HTTPError as e:
+            # The partial file is already complete.
+            if e.code == 416 and offset:
+                return
+            sys.exit(f"Failed to download {url}: {e}")
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                sys.exit(f"Failed to download {url} after {attempt} attempts: {e}")
+            print(f"Download interrupted ({e}); retrying")
+            time.sleep(attempt)
+
+
+def parse_digest(checksum_text: str) -> str:
+    # The .sha256 files hold "<digest>  <file name>".
+    return checksum_text.split()[0].lower()
+
+
+def fetch_archive(build_type: str, rust_version: str, dist_url: str = RUST_DIST_URL) -> Path:
+    """Returns the path of the verified source archive for rust_version in
+    the source cache, downloading it if necessary."""
+    archive_url   = construct_archive_url(build_type, rust_version, dist_url)
+    # Archives are kept per version so that re-importing a version, or
+    # switching between versions, doesn't download them again.
+    cache_dir     = SOURCE_DOWNLOADS_PATH / rust_version
+    archive_path  = cache_dir / archive_url.rsplit("/", 1)[1]
+    partial_path  = archive_path.parent / (archive_path.name + ".part")
+
+    # The checksum is fetched every time since the beta and nightly archives
+    # are replaced under the same name, which a cached checksum wouldn't see.
+    digest = parse_digest(fetch_text(archive_url + ".sha256"))
+
+    if archive_path.exists():
+        if utils.hash_file(archive_path) == digest:
+            print(f"Using cached archive {archive_path}")
+            return archive_path
+        print(f"Cached archive {archive_path} doesn't match the published checksum; downloading it again")
+        archive_path.unlink()
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
 
-def fetch_and_extract_archive(build_type: str, rust_version: str) -> None:
-    archive_url = construct_archive_url(build_type, rust_version)
     print("Fetching archive %s\n" % archive_url)
-    utils.run_and_exit_on_failure(
-        COMMAND_FETCH % archive_url,
-        "Error fetching source for Rust version %s" % rust_version,
-        cwd=RUST_SOURCE_PATH,
-        shell=True)
-    # Add newline padding to the output
-    print()
-    RUST_REPO.add('.')
+    download_file(archive_url, partial_path)
+
+    if utils.hash_file(partial_path) != digest:
+        partial_path.unlink()
+        sys.exit(f"Checksum mismatch for {archive_url}")
+
+    partial_path.rename(archive_path)
+    return archive_path
+
+
+def import_archive(archive_path: Path, rust_version: str, commit_message: str) -> None:
+    decompress_command = archive.archive_format_for_path(archive_path).decompress_command()
+    with open(archive_path, "rb") as archive_file:
+        decompressor = subprocess.Popen(utils.prepare_command(decompress_command),
+            stdin=archive_file, stdout=subprocess.PIPE) if decompress_command else None
+        stream = decompressor.stdout if decompressor else archive_file
+        assert stream is not None
+
+        print("Importing source for Rust version %s" % rust_version)
+        RUST_REPO.import_tar(stream, commit_message, strip_components=1)
+
+        if decompressor and decompressor.wait() != 0:
+            sys.exit("Error extracting source for Rust version %s" % rust_version)
 
 
 def main() -> None:
@@ -115,10 +217,10 @@ def main() -> None:
     branch_name:  str = args.branch or (BRANCH_NAME_TEMPLATE % rust_version)
 
     print('')
+    # Fetch first so that a failed download leaves the repository untouched.
+    archive_path = fetch_archive(args.build_type, rust_version, args.dist_url)
     RUST_REPO.create_or_checkout(branch_name, args.overwrite)
-    clean_repository()
-    fetch_and_extract_archive(args.build_type, rust_version)
-    RUST_REPO.amend_or_commit(make_commit_message(rust_version, args.issue))
+    import_archive(archive_path, rust_version, make_commit_message(rust_version, args.issue))
     print("Done")
 
     exit(0)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of the LLVM install trees built by the Rust bootstrap system.
+
+Entries are keyed by everything that determines how LLVM is built: the
+llvm-project source, the patches that modify it, the flags LLVM is built with
+and the compiler used to build it.  Each entry records the digest of every
+file it contains.  A lookup checks the size and modification time of every
+file against the manifest, and the verify command rehashes every entry.  The
+cache is kept below a size limit by evicting the entries that were used least
+recently.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import sys
+import time
+from typing import Any, Optional
+
+import build_platform
+from paths import *
+from source_manager import patch_touched_files, source_tree_hash
+from utils import hash_file
+
+
+LLVM_SOURCE_DIR: str = "src/llvm-project"
+
+# The bootstrap system's LLVM build logic, which chooses the CMake options
+BOOTSTRAP_LLVM_BUILDER: str = "src/bootstrap/native.rs"
+
+CACHE_INSTALL_NAME:  str = "install"
+CACHE_INPUTS_NAME:   str = "inputs.json"
+CACHE_MANIFEST_NAME: str = "manifest.json"
+CACHE_LAST_USED_NAME: str = "last-used"
+
+DEFAULT_CACHE_SIZE_GIB: float = 50.0
+
+
+def llvm_install_path() -> Path:
+    """Returns the directory the bootstrap system installs LLVM into."""
+    return OUT_PATH_RUST_SOURCE / "build" / build_platform.triple() / "llvm"
+
+
+def compute_llvm_inputs(cflags: str, cxxflags: str, ldflags: str, lto: str) -> dict[str, str]:
+    llvm_patches = [
+        patch for patch in sorted(PATCHES_PATH.glob("rustc-*"))
+        if any(path.startswith(LLVM_SOURCE_DIR + "/") for path in patch_touched_files(patch))]
+
+    patches_digest = hashlib.sha256()
+    for patch in llvm_patches:
+        patches_digest.update(patch.name.encode())
+        patches_digest.update(hash_file(patch).encode())
+
+    return {
+        # Reading the tree object of the superproject avoids hashing all of
+        # llvm-project when the checkout is clean.
+        "source":         source_tree_hash(RUST_SOURCE_PATH, LLVM_SOURCE_DIR),
+        "patches":        patches_digest.hexdigest(),
+        # The patched copy, since patches to the builder don't touch
+        # llvm-project and aren't covered above.
+        "builder":        hash_file(OUT_PATH_RUST_SOURCE / BOOTSTRAP_LLVM_BUILDER),
+        "config":         hash_file(TEMPLATES_PATH / "config.toml.template"),
+        "cflags":         cflags,
+        "cxxflags":       cxxflags,
+        "ldflags":        ldflags,
+        "lto":            lto,
+        "host":           build_platform.triple(),
+        "clang_revision": CLANG_REVISION,
+    }
+
+
+def compute_key(inputs: dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def entry_path(key: str) -> Path:
+    return LLVM_CACHE_PATH / key
+
+
+def file_stat(path: Path) -> list[int]:
+    st = path.lstat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def build_manifest(install_path: Path) -> dict[str, Any]:
+    files: dict[str, str] = {}
+    stats: dict[str, list[int]] = {}
+    total_size = 0
+    for root, dirs, names in os.walk(install_path):
+        dirs.sort()
+        for name in sorted(names):
+            path = Path(root) / name
+            rel_path = path.relative_to(install_path).as_posix()
+            files[rel_path] = hash_file(path)
+            stats[rel_path] = file_stat(path)
+            if not path.is_symlink():
+                total_size += path.stat().st_size
+    return {"size": total_size, "files": files, "stats": stats}
+
+
+def read_manifest(entry: Path) -> dict[str, Any]:
+    with open(entry / CACHE_MANIFEST_NAME) as f:
+        manifest: dict[str, Any] = json.load(f)
+    return manifest
+
+
+def verify_entry(entry: Path, full: bool = False) -> bool:
+    """Returns True if the entry matches its manifest.  By default only the
+    set of files and their sizes and modification times are compared; if
+    full is set every file is rehashed."""
+    try:
+        manifest = read_manifest(entry)
+    except (OSError, ValueError):
+        return False
+
+    install_path = entry / CACHE_INSTALL_NAME
+    if full:
+        return bool(build_manifest(install_path)["files"] == manifest["files"])
+
+    expected: dict[str, list[int]] = manifest.get("stats", {})
+    found: dict[str, list[int]] = {}
+    for root, dirs, names in os.walk(install_path):
+        for name in names:
+            path = Path(root) / name
+            found[path.relative_to(install_path).as_posix()] = file_stat(path)
+    return found == expected
+
+
+def remove_entry(entry: Path) -> None:
+    # Renaming first means a concurrent lookup never sees half an entry.
+    doomed = entry.parent / (entry.name + ".remove")
+    entry.rename(doomed)
+    shutil.rmtree(doomed)
+
+
+def lookup(key: str) -> Optional[Path]:
+    """Returns the path of the cached llvm-config for key, if there is a valid
+    entry.  Entries that fail verification are removed."""
+    entry = entry_path(key)
+    if not entry.exists():
+        return None
+
+    if not verify_entry(entry):
+        print(f"LLVM cache entry {key} is corrupt; removing it")
+        remove_entry(entry)
+        return None
+
+    (entry / CACHE_LAST_USED_NAME).write_text(str(time.time()))
+    return entry / CACHE_INSTALL_NAME / "bin" / "llvm-config"
+
+
+def store(key: str, inputs: dict[str, str], install_path: Path, max_size_gib: float) -> None:
+    """Adds an LLVM install tree to the cache and evicts old entries to keep
+    the cache below max_size_gib."""
+    dest_path = entry_path(key)
+    if dest_path.exists() or not (install_path / "bin" / "llvm-config").exists():
+        return
+
+    tmp_path = dest_path.parent / (dest_path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    # The install prefix also holds the LLVM build tree, which isn't needed to
+    # use the installed libraries.
+    shutil.copytree(install_path, tmp_path / CACHE_INSTALL_NAME, symlinks=True,
+        ignore=lambda root, names: ["build"] if Path(root) == install_path else [])
+
+    manifest = build_manifest(tmp_path / CACHE_INSTALL_NAME)
+    with open(tmp_path / CACHE_MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    with open(tmp_path / CACHE_INPUTS_NAME, "w") as f:
+        json.dump(inputs, f, indent=2, sort_keys=True)
+    (tmp_path / CACHE_LAST_USED_NAME).write_text(str(time.time()))
+
+    tmp_path.rename(dest_path)
+    print(f"Stored LLVM build {key} ({manifest['size'] / 2**30:.1f} GiB)")
+
+    evict(max_size_gib, keep=key)
+
+
+def evict(max_size_gib: float, keep: Optional[str] = None) -> None:
+    """Removes the least recently used entries until the cache is no larger
+    than max_size_gib."""
+    entries: list[tuple[float, int, Path]] = []
+    for entry in LLVM_CACHE_PATH.iterdir():
+        if not (entry / CACHE_MANIFEST_NAME).exists():
+            continue
+        try:
+            last_used = float((entry / CACHE_LAST_USED_NAME).read_text())
+        except (OSError, ValueError):
+            last_used = 0.0
+        entries.append((last_used, read_manifest(entry)["size"], entry))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_size <= max_size_gib * 2**30:
+            break
+        if entry.name == keep:
+            continue
+        print(f"Evicting LLVM build {entry.name}")
+        remove_entry(entry)
+        total_size -= size
+
+
+def verify_entries() -> bool:
+    entries: list[Path] = []
+    if LLVM_CACHE_PATH.exists():
+        entries = sorted(entry for entry in LLVM_CACHE_PATH.iterdir()
+                         if (entry / CACHE_MANIFEST_NAME).exists())
+    bad = [entry for entry in entries if not verify_entry(entry, full=True)]
+    for entry in bad:
+        print(f"Corrupt: {entry.name}")
+    print(f"Verified {len(entries) - len(bad)} of {len(entries)} LLVM builds")
+    return not bad
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("verify", help="Rehash every file of every cached LLVM build")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.command == "verify":
+        sys.exit(0 if verify_entries() else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -36,14 +36,37 @@ DIST_PATH: Path = (
 PATCHES_PATH:   Path = TOOLCHAIN_PATH / 'patches'
 TEMPLATES_PATH: Path = TOOLCHAIN_PATH / 'templates'
 
+# Crates compiled to train the compiler for profile-guided optimization
+PGO_CORPUS_PATH: Path = TOOLCHAIN_PATH / 'pgo-corpus'
+BENCHMARK_CORPUS_PATH: Path = TOOLCHAIN_PATH / 'benchmark-corpus'
+
 OUT_PATH:             Path = WORKSPACE_PATH / 'out'
 OUT_PATH_RUST_SOURCE: Path = OUT_PATH / 'rustc'
 OUT_PATH_PACKAGE:     Path = OUT_PATH / 'package'
 OUT_PATH_STDLIB_SRCS: Path = OUT_PATH_PACKAGE / 'src' / 'stdlibs'
 OUT_PATH_WRAPPERS:    Path = OUT_PATH / 'wrappers'
+OUT_PATH_SNAPSHOTS:   Path = OUT_PATH / 'patch-snapshots'
+OUT_PATH_STD_BUILDS:  Path = OUT_PATH / 'std-builds'
+
+# Packages built for a subset of the targets contain a file with this name
+# listing the targets that were built.
+PARTIAL_PACKAGE_MARKER: str = 'PARTIAL_TARGETS'
+
+COMPILER_CACHE_PATH: Path = WORKSPACE_PATH / '.ccache'
 
 DOWNLOADS_PATH: Path = WORKSPACE_PATH / '.downloads'
 
+# Rust source archives are kept apart from DOWNLOADS_PATH, which is pruned by
+# download_cache.
+SOURCE_DOWNLOADS_PATH: Path = WORKSPACE_PATH / '.source-downloads'
+
+# Finished builds are cached outside of out/ so that they survive a clean.
+# The location can be shared between checkouts through the environment.
+ARTIFACT_CACHE_PATH: Path = (
+    Path(os.environ["RUST_ARTIFACT_CACHE_DIR"]).resolve() if "RUST_ARTIFACT_CACHE_DIR" in os.environ else
+    (WORKSPACE_PATH / '.artifact-cache'))
+LLVM_CACHE_PATH: Path = ARTIFACT_CACHE_PATH / 'llvm'
+
 LLVM_BUILD_PATH: Path = OUT_PATH_RUST_SOURCE / 'build' / build_platform.triple() / 'llvm' / 'build'
 
 PREBUILT_PATH:         Path = WORKSPACE_PATH / 'prebuilts'
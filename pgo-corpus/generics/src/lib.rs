@@ -0,0 +1,356 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! Generic containers and algorithms, instantiated with several types so that
+//! trait selection, monomorphization and inlining all have work to do.
+
+use std::cmp::Ordering;
+use std::collections::{BTreeMap, HashMap};
+use std::fmt::{self, Debug, Display};
+use std::hash::Hash;
+use std::ops::{Add, Mul};
+
+/// A binary min-heap ordered by a key extracted from each element.
+pub struct KeyedHeap<T, K, F>
+where
+    F: Fn(&T) -> K,
+    K: Ord,
+{
+    items: Vec<T>,
+    key: F,
+}
+
+impl<T, K, F> KeyedHeap<T, K, F>
+where
+    F: Fn(&T) -> K,
+    K: Ord,
+{
+    pub fn new(key: F) -> Self {
+        KeyedHeap { items: Vec::new(), key }
+    }
+
+    pub fn len(&self) -> usize {
+        self.items.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.items.is_empty()
+    }
+
+    fn less(&self, a: usize, b: usize) -> bool {
+        (self.key)(&self.items[a]) < (self.key)(&self.items[b])
+    }
+
+    pub fn push(&mut self, item: T) {
+        self.items.push(item);
+        let mut child = self.items.len() - 1;
+        while child > 0 {
+            let parent = (child - 1) / 2;
+            if !self.less(child, parent) {
+                break;
+            }
+            self.items.swap(child, parent);
+            child = parent;
+        }
+    }
+
+    pub fn pop(&mut self) -> Option<T> {
+        if self.items.is_empty() {
+            return None;
+        }
+        let last = self.items.len() - 1;
+        self.items.swap(0, last);
+        let result = self.items.pop();
+
+        let mut parent = 0;
+        loop {
+            let left = 2 * parent + 1;
+            let right = left + 1;
+            let mut smallest = parent;
+            if left < self.items.len() && self.less(left, smallest) {
+                smallest = left;
+            }
+            if right < self.items.len() && self.less(right, smallest) {
+                smallest = right;
+            }
+            if smallest == parent {
+                break;
+            }
+            self.items.swap(parent, smallest);
+            parent = smallest;
+        }
+        result
+    }
+
+    pub fn into_sorted_vec(mut self) -> Vec<T> {
+        let mut sorted = Vec::with_capacity(self.items.len());
+        while let Some(item) = self.pop() {
+            sorted.push(item);
+        }
+        sorted
+    }
+}
+
+/// A map from non-overlapping half-open intervals to values.
+#[derive(Debug, Default, Clone)]
+pub struct IntervalMap<K: Ord + Copy, V> {
+    starts: BTreeMap<K, (K, V)>,
+}
+
+impl<K: Ord + Copy + Debug, V: Clone> IntervalMap<K, V> {
+    pub fn new() -> Self {
+        IntervalMap { starts: BTreeMap::new() }
+    }
+
+    /// Inserts [start, end) -> value, replacing any overlapping intervals.
+    pub fn insert(&mut self, start: K, end: K, value: V) {
+        assert!(start < end, "empty interval {:?}..{:?}", start, end);
+        let overlapping: Vec<K> = self
+            .starts
+            .range(..end)
+            .filter(|(_, (e, _))| *e > start)
+            .map(|(s, _)| *s)
+            .collect();
+
+        for s in overlapping {
+            let (e, v) = self.starts.remove(&s).unwrap();
+            if s < start {
+                self.starts.insert(s, (start, v.clone()));
+            }
+            if e > end {
+                self.starts.insert(end, (e, v));
+            }
+        }
+        self.starts.insert(start, (end, value));
+    }
+
+    pub fn get(&self, point: K) -> Option<&V> {
+        self.starts
+            .range(..=point)
+            .next_back()
+            .filter(|(_, (end, _))| point < *end)
+            .map(|(_, (_, value))| value)
+    }
+
+    pub fn len(&self) -> usize {
+        self.starts.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.starts.is_empty()
+    }
+}
+
+/// A small dense matrix over any numeric-like type.
+#[derive(Clone, PartialEq, Debug)]
+pub struct Matrix<T> {
+    rows: usize,
+    cols: usize,
+    data: Vec<T>,
+}
+
+impl<T> Matrix<T>
+where
+    T: Copy + Default + Add<Output = T> + Mul<Output = T>,
+{
+    pub fn from_fn(rows: usize, cols: usize, f: impl Fn(usize, usize) -> T) -> Self {
+        let data = (0..rows * cols).map(|i| f(i / cols, i % cols)).collect();
+        Matrix { rows, cols, data }
+    }
+
+    pub fn get(&self, row: usize, col: usize) -> T {
+        self.data[row * self.cols + col]
+    }
+
+    pub fn multiply(&self, other: &Matrix<T>) -> Option<Matrix<T>> {
+        if self.cols != other.rows {
+            return None;
+        }
+        Some(Matrix::from_fn(self.rows, other.cols, |r, c| {
+            (0..self.cols).fold(T::default(), |acc, k| acc + self.get(r, k) * other.get(k, c))
+        }))
+    }
+
+    pub fn transpose(&self) -> Matrix<T> {
+        Matrix::from_fn(self.cols, self.rows, |r, c| self.get(c, r))
+    }
+}
+
+impl<T: Display> Display for Matrix<T> {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        for row in self.data.chunks(self.cols.max(1)) {
+            let cells: Vec<String> = row.iter().map(|cell| cell.to_string()).collect();
+            writeln!(f, "[{}]", cells.join(", "))?;
+        }
+        Ok(())
+    }
+}
+
+/// Something that can be drawn and measured, used through trait objects.
+pub trait Shape: Debug {
+    fn area(&self) -> f64;
+    fn perimeter(&self) -> f64;
+    fn name(&self) -> &'static str;
+
+    fn describe(&self) -> String {
+        format!("{} with area {:.2} and perimeter {:.2}", self.name(), self.area(), self.perimeter())
+    }
+}
+
+#[derive(Debug, Clone, Copy)]
+pub struct Circle {
+    pub radius: f64,
+}
+
+#[derive(Debug, Clone, Copy)]
+pub struct Rectangle {
+    pub width: f64,
+    pub height: f64,
+}
+
+#[derive(Debug, Clone)]
+pub struct Polygon {
+    pub points: Vec<(f64, f64)>,
+}
+
+impl Shape for Circle {
+    fn area(&self) -> f64 {
+        std::f64::consts::PI * self.radius * self.radius
+    }
+    fn perimeter(&self) -> f64 {
+        2.0 * std::f64::consts::PI * self.radius
+    }
+    fn name(&self) -> &'static str {
+        "circle"
+    }
+}
+
+impl Shape for Rectangle {
+    fn area(&self) -> f64 {
+        self.width * self.height
+    }
+    fn perimeter(&self) -> f64 {
+        2.0 * (self.width + self.height)
+    }
+    fn name(&self) -> &'static str {
+        "rectangle"
+    }
+}
+
+impl Shape for Polygon {
+    fn area(&self) -> f64 {
+        let n = self.points.len();
+        let twice_area: f64 = (0..n)
+            .map(|i| {
+                let (x1, y1) = self.points[i];
+                let (x2, y2) = self.points[(i + 1) % n];
+                x1 * y2 - x2 * y1
+            })
+            .sum();
+        twice_area.abs() / 2.0
+    }
+    fn perimeter(&self) -> f64 {
+        let n = self.points.len();
+        (0..n)
+            .map(|i| {
+                let (x1, y1) = self.points[i];
+                let (x2, y2) = self.points[(i + 1) % n];
+                ((x2 - x1).powi(2) + (y2 - y1).powi(2)).sqrt()
+            })
+            .sum()
+    }
+    fn name(&self) -> &'static str {
+        "polygon"
+    }
+}
+
+pub fn largest_shape(shapes: &[Box<dyn Shape>]) -> Option<&dyn Shape> {
+    shapes
+        .iter()
+        .map(|shape| shape.as_ref())
+        .max_by(|a, b| a.area().partial_cmp(&b.area()).unwrap_or(Ordering::Equal))
+}
+
+/// Counts the occurrences of each item, returning them most frequent first.
+pub fn frequencies<T, I>(items: I) -> Vec<(T, usize)>
+where
+    T: Hash + Eq + Ord + Clone,
+    I: IntoIterator<Item = T>,
+{
+    let mut counts: HashMap<T, usize> = HashMap::new();
+    for item in items {
+        *counts.entry(item).or_insert(0) += 1;
+    }
+    let mut result: Vec<(T, usize)> = counts.into_iter().collect();
+    result.sort_by(|(a, a_count), (b, b_count)| b_count.cmp(a_count).then_with(|| a.cmp(b)));
+    result
+}
+
+/// Groups items by a key while preserving their order within each group.
+pub fn group_by<T, K, F>(items: impl IntoIterator<Item = T>, key: F) -> BTreeMap<K, Vec<T>>
+where
+    K: Ord,
+    F: Fn(&T) -> K,
+{
+    let mut groups: BTreeMap<K, Vec<T>> = BTreeMap::new();
+    for item in items {
+        groups.entry(key(&item)).or_insert_with(Vec::new).push(item);
+    }
+    groups
+}
+
+/// Exercises the generic code above with several instantiations.
+pub fn workload(size: usize) -> String {
+    let mut heap = KeyedHeap::new(|pair: &(u32, String)| pair.0);
+    for i in 0..size as u32 {
+        heap.push(((i * 7919) % 1000, format!("item{}", i)));
+    }
+    let sorted = heap.into_sorted_vec();
+
+    let mut by_len = KeyedHeap::new(|s: &String| std::cmp::Reverse(s.len()));
+    for (_, name) in &sorted {
+        by_len.push(name.clone());
+    }
+
+    let mut intervals = IntervalMap::new();
+    for i in 0..size as i64 {
+        intervals.insert(i * 3, i * 3 + 5, i);
+    }
+
+    let ints = Matrix::from_fn(8, 8, |r, c| (r * c) as i64);
+    let floats = Matrix::from_fn(8, 8, |r, c| r as f64 - c as f64 / 2.0);
+    let ints_squared = ints.multiply(&ints.transpose()).unwrap();
+    let floats_squared = floats.multiply(&floats.transpose()).unwrap();
+
+    let shapes: Vec<Box<dyn Shape>> = vec![
+        Box::new(Circle { radius: 2.0 }),
+        Box::new(Rectangle { width: 3.0, height: 4.5 }),
+        Box::new(Polygon { points: vec![(0.0, 0.0), (4.0, 0.0), (4.0, 3.0)] }),
+    ];
+
+    let words = sorted.iter().map(|(_, name)| name.chars().last().unwrap_or('0'));
+    let groups = group_by(0..size, |i| i % 7);
+
+    format!(
+        "{} {:?} {:?}\n{}{}{} {:?} {}",
+        by_len.len(),
+        intervals.get(10),
+        largest_shape(&shapes).map(|shape| shape.describe()),
+        ints_squared,
+        floats_squared,
+        frequencies(words).len(),
+        groups.get(&3).map(Vec::len),
+        sorted.len(),
+    )
+}
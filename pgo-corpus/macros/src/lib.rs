@@ -0,0 +1,273 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! Declarative macros that generate many types and trait implementations,
+//! along with the derives commonly found in platform code.
+
+use std::collections::HashSet;
+use std::convert::TryFrom;
+use std::fmt;
+use std::str::FromStr;
+
+/// Defines a set of bit flags with set operations and a Debug listing.
+macro_rules! flags {
+    ($name:ident: $repr:ty { $($flag:ident = $value:expr,)* }) => {
+        #[derive(Clone, Copy, PartialEq, Eq, Hash, PartialOrd, Ord, Default)]
+        pub struct $name($repr);
+
+        #[allow(non_upper_case_globals)]
+        impl $name {
+            $(pub const $flag: $name = $name($value);)*
+
+            pub const fn empty() -> Self {
+                $name(0)
+            }
+
+            pub const fn all() -> Self {
+                $name(0 $(| $value)*)
+            }
+
+            pub const fn bits(self) -> $repr {
+                self.0
+            }
+
+            pub fn contains(self, other: Self) -> bool {
+                self.0 & other.0 == other.0
+            }
+
+            pub fn insert(&mut self, other: Self) {
+                self.0 |= other.0;
+            }
+
+            pub fn remove(&mut self, other: Self) {
+                self.0 &= !other.0;
+            }
+        }
+
+        impl std::ops::BitOr for $name {
+            type Output = Self;
+            fn bitor(self, other: Self) -> Self {
+                $name(self.0 | other.0)
+            }
+        }
+
+        impl std::ops::BitAnd for $name {
+            type Output = Self;
+            fn bitand(self, other: Self) -> Self {
+                $name(self.0 & other.0)
+            }
+        }
+
+        impl fmt::Debug for $name {
+            fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+                let mut names = Vec::new();
+                $(if self.contains($name::$flag) && $name::$flag.0 != 0 {
+                    names.push(stringify!($flag));
+                })*
+                write!(f, "{}({})", stringify!($name), names.join(" | "))
+            }
+        }
+    };
+}
+
+/// Defines a field-less enum that converts to and from strings and integers.
+macro_rules! string_enum {
+    ($name:ident { $($variant:ident => $text:expr,)* }) => {
+        #[derive(Clone, Copy, PartialEq, Eq, Hash, PartialOrd, Ord, Debug)]
+        pub enum $name {
+            $($variant,)*
+        }
+
+        impl $name {
+            pub const ALL: &'static [$name] = &[$($name::$variant,)*];
+
+            pub fn as_str(self) -> &'static str {
+                match self {
+                    $($name::$variant => $text,)*
+                }
+            }
+        }
+
+        impl fmt::Display for $name {
+            fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+                f.write_str(self.as_str())
+            }
+        }
+
+        impl FromStr for $name {
+            type Err = String;
+            fn from_str(s: &str) -> Result<Self, String> {
+                match s {
+                    $($text => Ok($name::$variant),)*
+                    _ => Err(format!("unknown {}: {}", stringify!($name), s)),
+                }
+            }
+        }
+
+        impl TryFrom<usize> for $name {
+            type Error = usize;
+            fn try_from(index: usize) -> Result<Self, usize> {
+                $name::ALL.get(index).copied().ok_or(index)
+            }
+        }
+    };
+}
+
+/// Defines a plain struct with a builder whose setters are generated.
+macro_rules! builder {
+    ($name:ident, $builder:ident { $($field:ident: $ty:ty = $default:expr,)* }) => {
+        #[derive(Clone, Debug, PartialEq)]
+        pub struct $name {
+            $(pub $field: $ty,)*
+        }
+
+        #[derive(Clone, Debug)]
+        pub struct $builder {
+            $($field: $ty,)*
+        }
+
+        impl Default for $builder {
+            fn default() -> Self {
+                $builder { $($field: $default,)* }
+            }
+        }
+
+        impl $builder {
+            $(pub fn $field(mut self, value: impl Into<$ty>) -> Self {
+                self.$field = value.into();
+                self
+            })*
+
+            pub fn build(self) -> $name {
+                $name { $($field: self.$field,)* }
+            }
+        }
+    };
+}
+
+/// Counts its arguments at compile time.
+macro_rules! count {
+    () => { 0usize };
+    ($head:tt $($tail:tt)*) => { 1usize + count!($($tail)*) };
+}
+
+/// Builds a HashSet from a list of expressions.
+macro_rules! set {
+    ($($item:expr),* $(,)?) => {{
+        let mut set = HashSet::with_capacity(count!($($item)*));
+        $(set.insert($item);)*
+        set
+    }};
+}
+
+flags!(Permissions: u32 {
+    Read = 1 << 0,
+    Write = 1 << 1,
+    Execute = 1 << 2,
+    Setuid = 1 << 11,
+    Sticky = 1 << 9,
+});
+
+flags!(CpuFeatures: u64 {
+    Neon = 1 << 0,
+    Crc = 1 << 1,
+    Aes = 1 << 2,
+    Sha2 = 1 << 3,
+    Sse42 = 1 << 32,
+    Avx2 = 1 << 33,
+    Bmi2 = 1 << 34,
+});
+
+string_enum!(Arch {
+    Aarch64 => "aarch64",
+    Armv7 => "armv7",
+    X86 => "i686",
+    X86_64 => "x86_64",
+    Riscv64 => "riscv64",
+});
+
+string_enum!(Profile {
+    Debug => "debug",
+    Release => "release",
+    Coverage => "coverage",
+    Fuzz => "fuzz",
+});
+
+string_enum!(Lto {
+    Off => "none",
+    Thin => "thin",
+    Full => "full",
+});
+
+builder!(TargetSpec, TargetSpecBuilder {
+    arch: Arch = Arch::Aarch64,
+    profile: Profile = Profile::Release,
+    lto: Lto = Lto::Thin,
+    features: CpuFeatures = CpuFeatures::empty(),
+    api_level: u32 = 21,
+    name: String = String::from("android"),
+});
+
+builder!(InstallSpec, InstallSpecBuilder {
+    path: String = String::from("/system/bin"),
+    permissions: Permissions = Permissions::Read | Permissions::Execute,
+    strip: bool = true,
+});
+
+impl TargetSpec {
+    pub fn triple(&self) -> String {
+        match self.arch {
+            Arch::Armv7 => format!("{}-linux-androideabi", self.arch),
+            arch => format!("{}-linux-android", arch),
+        }
+    }
+}
+
+pub fn workload(size: usize) -> String {
+    let mut specs = Vec::new();
+    for i in 0..size {
+        let arch = Arch::try_from(i % Arch::ALL.len()).unwrap();
+        let profile = Profile::try_from(i % Profile::ALL.len()).unwrap();
+        let mut features = CpuFeatures::empty();
+        if i % 2 == 0 {
+            features.insert(CpuFeatures::Neon | CpuFeatures::Aes);
+        } else {
+            features.insert(CpuFeatures::Sse42 | CpuFeatures::Avx2);
+            features.remove(CpuFeatures::Avx2);
+        }
+        specs.push(
+            TargetSpecBuilder::default()
+                .arch(arch)
+                .profile(profile)
+                .lto("full".parse::<Lto>().unwrap())
+                .features(features)
+                .api_level(21 + i as u32 % 12)
+                .name(format!("spec-{}", i))
+                .build(),
+        );
+    }
+
+    let install = InstallSpecBuilder::default().strip(false).build();
+    let triples = specs.iter().map(TargetSpec::triple).collect::<HashSet<_>>();
+    let expected = set!["aarch64-linux-android", "armv7-linux-androideabi", "i686-linux-android"];
+
+    format!(
+        "{:?} {:?} {} {} {:?}",
+        specs.last(),
+        install,
+        expected.iter().all(|triple| triples.contains(*triple)),
+        count!(a b c d e),
+        Permissions::all() & Permissions::Write,
+    )
+}
@@ -0,0 +1,395 @@
+// Copyright (C) 2021 The Android Open Source Project
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! A JSON tokenizer, parser and serializer built from enums and pattern
+//! matching, plus a small expression evaluator over the parsed values.
+
+use std::collections::BTreeMap;
+use std::error::Error;
+use std::fmt::{self, Display, Write};
+use std::iter::Peekable;
+use std::str::CharIndices;
+
+#[derive(Debug, Clone, PartialEq)]
+pub enum Value {
+    Null,
+    Bool(bool),
+    Number(f64),
+    String(String),
+    Array(Vec<Value>),
+    Object(BTreeMap<String, Value>),
+}
+
+#[derive(Debug, Clone, PartialEq)]
+enum Token {
+    LeftBrace,
+    RightBrace,
+    LeftBracket,
+    RightBracket,
+    Colon,
+    Comma,
+    Null,
+    True,
+    False,
+    Number(f64),
+    String(String),
+}
+
+#[derive(Debug, Clone, PartialEq)]
+pub struct ParseError {
+    pub offset: usize,
+    pub message: String,
+}
+
+impl Display for ParseError {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        write!(f, "at offset {}: {}", self.offset, self.message)
+    }
+}
+
+impl Error for ParseError {}
+
+type Result<T> = std::result::Result<T, ParseError>;
+
+struct Lexer<'a> {
+    input: &'a str,
+    chars: Peekable<CharIndices<'a>>,
+}
+
+impl<'a> Lexer<'a> {
+    fn new(input: &'a str) -> Self {
+        Lexer { input, chars: input.char_indices().peekable() }
+    }
+
+    fn error<T>(&self, offset: usize, message: impl Into<String>) -> Result<T> {
+        Err(ParseError { offset, message: message.into() })
+    }
+
+    fn keyword(&mut self, start: usize, word: &str, token: Token) -> Result<(usize, Token)> {
+        if self.input[start..].starts_with(word) {
+            for _ in 0..word.len() {
+                self.chars.next();
+            }
+            Ok((start, token))
+        } else {
+            self.error(start, "unknown keyword")
+        }
+    }
+
+    fn string(&mut self, start: usize) -> Result<(usize, Token)> {
+        self.chars.next();
+        let mut value = String::new();
+        loop {
+            match self.chars.next() {
+                None => return self.error(start, "unterminated string"),
+                Some((_, '"')) => return Ok((start, Token::String(value))),
+                Some((offset, '\\')) => match self.chars.next() {
+                    Some((_, '"')) => value.push('"'),
+                    Some((_, '\\')) => value.push('\\'),
+                    Some((_, '/')) => value.push('/'),
+                    Some((_, 'n')) => value.push('\n'),
+                    Some((_, 't')) => value.push('\t'),
+                    Some((_, 'r')) => value.push('\r'),
+                    Some((_, 'u')) => {
+                        let mut code = 0u32;
+                        for _ in 0..4 {
+                            match self.chars.next().and_then(|(_, c)| c.to_digit(16)) {
+                                Some(digit) => code = code * 16 + digit,
+                                None => return self.error(offset, "bad unicode escape"),
+                            }
+                        }
+                        value.push(std::char::from_u32(code).unwrap_or('\u{fffd}'));
+                    }
+                    _ => return self.error(offset, "bad escape"),
+                },
+                Some((_, c)) => value.push(c),
+            }
+        }
+    }
+
+    fn number(&mut self, start: usize) -> Result<(usize, Token)> {
+        let mut end = start;
+        while let Some(&(offset, c)) = self.chars.peek() {
+            if c.is_ascii_digit() || matches!(c, '-' | '+' | '.' | 'e' | 'E') {
+                end = offset + c.len_utf8();
+                self.chars.next();
+            } else {
+                break;
+            }
+        }
+        match self.input[start..end].parse() {
+            Ok(number) => Ok((start, Token::Number(number))),
+            Err(_) => self.error(start, "bad number"),
+        }
+    }
+
+    fn next_token(&mut self) -> Option<Result<(usize, Token)>> {
+        while let Some(&(offset, c)) = self.chars.peek() {
+            let simple = match c {
+                ' ' | '\t' | '\n' | '\r' => {
+                    self.chars.next();
+                    continue;
+                }
+                '{' => Some(Token::LeftBrace),
+                '}' => Some(Token::RightBrace),
+                '[' => Some(Token::LeftBracket),
+                ']' => Some(Token::RightBracket),
+                ':' => Some(Token::Colon),
+                ',' => Some(Token::Comma),
+                _ => None,
+            };
+            if let Some(token) = simple {
+                self.chars.next();
+                return Some(Ok((offset, token)));
+            }
+            return Some(match c {
+                'n' => self.keyword(offset, "null", Token::Null),
+                't' => self.keyword(offset, "true", Token::True),
+                'f' => self.keyword(offset, "false", Token::False),
+                '"' => self.string(offset),
+                '-' | '0'..='9' => self.number(offset),
+                _ => self.error(offset, format!("unexpected character {:?}", c)),
+            });
+        }
+        None
+    }
+}
+
+struct Parser<'a> {
+    lexer: Lexer<'a>,
+    lookahead: Option<(usize, Token)>,
+}
+
+impl<'a> Parser<'a> {
+    fn advance(&mut self) -> Result<Option<(usize, Token)>> {
+        let next = self.lexer.next_token().transpose()?;
+        Ok(std::mem::replace(&mut self.lookahead, next))
+    }
+
+    fn expect(&mut self, expected: Token) -> Result<()> {
+        match self.advance()? {
+            Some((_, ref token)) if *token == expected => Ok(()),
+            Some((offset, token)) => Err(ParseError {
+                offset,
+                message: format!("expected {:?}, found {:?}", expected, token),
+            }),
+            None => Err(ParseError { offset: self.lexer.input.len(), message: "unexpected end".into() }),
+        }
+    }
+
+    fn value(&mut self) -> Result<Value> {
+        let (offset, token) = match self.advance()? {
+            Some(next) => next,
+            None => return Err(ParseError { offset: self.lexer.input.len(), message: "unexpected end".into() }),
+        };
+        Ok(match token {
+            Token::Null => Value::Null,
+            Token::True => Value::Bool(true),
+            Token::False => Value::Bool(false),
+            Token::Number(number) => Value::Number(number),
+            Token::String(string) => Value::String(string),
+            Token::LeftBracket => {
+                let mut items = Vec::new();
+                if !matches!(self.lookahead, Some((_, Token::RightBracket))) {
+                    loop {
+                        items.push(self.value()?);
+                        if matches!(self.lookahead, Some((_, Token::Comma))) {
+                            self.advance()?;
+                        } else {
+                            break;
+                        }
+                    }
+                }
+                self.expect(Token::RightBracket)?;
+                Value::Array(items)
+            }
+            Token::LeftBrace => {
+                let mut members = BTreeMap::new();
+                if !matches!(self.lookahead, Some((_, Token::RightBrace))) {
+                    loop {
+                        let key = match self.advance()? {
+                            Some((_, Token::String(key))) => key,
+                            other => {
+                                return Err(ParseError {
+                                    offset: other.map_or(0, |(offset, _)| offset),
+                                    message: "expected a key".into(),
+                                })
+                            }
+                        };
+                        self.expect(Token::Colon)?;
+                        members.insert(key, self.value()?);
+                        if matches!(self.lookahead, Some((_, Token::Comma))) {
+                            self.advance()?;
+                        } else {
+                            break;
+                        }
+                    }
+                }
+                self.expect(Token::RightBrace)?;
+                Value::Object(members)
+            }
+            token => {
+                return Err(ParseError { offset, message: format!("unexpected {:?}", token) });
+            }
+        })
+    }
+}
+
+pub fn parse(input: &str) -> Result<Value> {
+    let mut parser = Parser { lexer: Lexer::new(input), lookahead: None };
+    parser.advance()?;
+    let value = parser.value()?;
+    match parser.lookahead {
+        None => Ok(value),
+        Some((offset, _)) => Err(ParseError { offset, message: "trailing input".into() }),
+    }
+}
+
+fn write_string(out: &mut String, value: &str) {
+    out.push('"');
+    for c in value.chars() {
+        match c {
+            '"' => out.push_str("\\\""),
+            '\\' => out.push_str("\\\\"),
+            '\n' => out.push_str("\\n"),
+            '\t' => out.push_str("\\t"),
+            c if (c as u32) < 0x20 => {
+                let _ = write!(out, "\\u{:04x}", c as u32);
+            }
+            c => out.push(c),
+        }
+    }
+    out.push('"');
+}
+
+impl Display for Value {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        let mut out = String::new();
+        match self {
+            Value::Null => out.push_str("null"),
+            Value::Bool(b) => out.push_str(if *b { "true" } else { "false" }),
+            Value::Number(n) => {
+                let _ = write!(out, "{}", n);
+            }
+            Value::String(s) => write_string(&mut out, s),
+            Value::Array(items) => {
+                out.push('[');
+                for (i, item) in items.iter().enumerate() {
+                    if i > 0 {
+                        out.push(',');
+                    }
+                    let _ = write!(out, "{}", item);
+                }
+                out.push(']');
+            }
+            Value::Object(members) => {
+                out.push('{');
+                for (i, (key, value)) in members.iter().enumerate() {
+                    if i > 0 {
+                        out.push(',');
+                    }
+                    write_string(&mut out, key);
+                    let _ = write!(out, ":{}", value);
+                }
+                out.push('}');
+            }
+        }
+        f.write_str(&out)
+    }
+}
+
+/// A path expression such as `.targets[2].name`.
+#[derive(Debug, Clone, PartialEq)]
+pub enum Step {
+    Field(String),
+    Index(usize),
+}
+
+pub fn parse_path(path: &str) -> Option<Vec<Step>> {
+    let mut steps = Vec::new();
+    let mut rest = path;
+    while !rest.is_empty() {
+        if let Some(field) = rest.strip_prefix('.') {
+            let end = field.find(|c| c == '.' || c == '[').unwrap_or(field.len());
+            steps.push(Step::Field(field[..end].to_string()));
+            rest = &field[end..];
+        } else if let Some(index) = rest.strip_prefix('[') {
+            let end = index.find(']')?;
+            steps.push(Step::Index(index[..end].parse().ok()?));
+            rest = &index[end + 1..];
+        } else {
+            return None;
+        }
+    }
+    Some(steps)
+}
+
+impl Value {
+    pub fn select(&self, steps: &[Step]) -> Option<&Value> {
+        steps.iter().try_fold(self, |value, step| match (value, step) {
+            (Value::Object(members), Step::Field(name)) => members.get(name),
+            (Value::Array(items), Step::Index(index)) => items.get(*index),
+            _ => None,
+        })
+    }
+
+    pub fn depth(&self) -> usize {
+        match self {
+            Value::Array(items) => 1 + items.iter().map(Value::depth).max().unwrap_or(0),
+            Value::Object(members) => 1 + members.values().map(Value::depth).max().unwrap_or(0),
+            _ => 0,
+        }
+    }
+
+    pub fn sum_numbers(&self) -> f64 {
+        match self {
+            Value::Number(n) => *n,
+            Value::Array(items) => items.iter().map(Value::sum_numbers).sum(),
+            Value::Object(members) => members.values().map(Value::sum_numbers).sum(),
+            _ => 0.0,
+        }
+    }
+}
+
+/// Builds a document, round-trips it through the serializer and parser and
+/// queries it.
+pub fn workload(size: usize) -> std::result::Result<String, Box<dyn Error>> {
+    let mut document = String::from("{\"targets\":[");
+    for i in 0..size {
+        if i > 0 {
+            document.push(',');
+        }
+        write!(
+            document,
+            "{{\"name\":\"target-{}\",\"weight\":{},\"tags\":[\"a\\n\",\"b\\u0041\"],\"nested\":{{\"on\":{}}}}}",
+            i,
+            i as f64 * 1.5,
+            i % 2 == 0
+        )?;
+    }
+    document.push_str("],\"version\":null}");
+
+    let value = parse(&document)?;
+    let reparsed = parse(&value.to_string())?;
+    assert_eq!(value, reparsed);
+
+    let path = parse_path(".targets[1].name").ok_or("bad path")?;
+    Ok(format!(
+        "{:?} depth={} sum={} error={}",
+        value.select(&path),
+        value.depth(),
+        value.sum_numbers(),
+        parse("{\"a\": [1, 2,, 3]}").unwrap_err()
+    ))
+}
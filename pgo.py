@@ -0,0 +1,151 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profile-guided optimization of rustc and LLVM.
+
+As in the upstream pgo.sh, LLVM and rustc are profiled in separate phases so
+that the instrumentation of one doesn't skew the profile of the other:
+  1. Build a stage 2 compiler with instrumented LLVM, compile the training
+     corpus for the Android targets with it and merge the LLVM profiles.
+  2. Rebuild the compiler with instrumented rustc and an LLVM optimized with
+     the profile from phase 1, then train and merge the rustc profiles.
+  3. Discard the instrumented build and let the real build use both profiles.
+
+The profiles are merged with the prebuilt llvm-profdata.  The training corpus
+is a directory of crates, each of which must build offline from its committed
+Cargo.lock.
+"""
+
+from pathlib import Path
+import shutil
+import sys
+import time
+from typing import NamedTuple
+
+import build_platform
+from paths import *
+from utils import run_and_exit_on_failure, run_quiet_and_exit_on_failure
+
+
+PGO_PROFILE_PATH:  Path = OUT_PATH / 'pgo'
+RUST_PROFRAW_PATH: Path = PGO_PROFILE_PATH / 'rustc-profraw'
+LLVM_PROFRAW_PATH: Path = PGO_PROFILE_PATH / 'llvm-profraw'
+RUST_PROFDATA_PATH: Path = PGO_PROFILE_PATH / 'rustc.profdata'
+LLVM_PROFDATA_PATH: Path = PGO_PROFILE_PATH / 'llvm.profdata'
+TRAINING_TARGET_PATH: Path = PGO_PROFILE_PATH / 'target'
+
+LLVM_PROFDATA_TOOL_PATH: Path = LLVM_PREBUILT_PATH / 'bin' / 'llvm-profdata'
+
+
+def stage2_rustc_path() -> Path:
+    return OUT_PATH_RUST_SOURCE / "build" / build_platform.triple() / "stage2" / "bin" / "rustc"
+
+
+def corpus_crates() -> list[Path]:
+    if not PGO_CORPUS_PATH.is_dir():
+        sys.exit(f"PGO training corpus not found at {PGO_CORPUS_PATH}")
+    crates = sorted(path.parent for path in PGO_CORPUS_PATH.glob("*/Cargo.toml"))
+    if not crates:
+        sys.exit(f"PGO training corpus at {PGO_CORPUS_PATH} contains no crates")
+    return crates
+
+
+class PgoPhase(NamedTuple):
+    name:             str
+    # Flags for x.py to build the instrumented compiler
+    instrument_flags: list[str]
+    raw_path:         Path
+    profdata_path:    Path
+    # Whether LLVM_PROFILE_FILE must direct the profiles to raw_path.  The
+    # rustc profile location is compiled in by --rust-profile-generate, but
+    # LLVM is instrumented by clang and is directed through the environment.
+    redirect_profiles: bool
+
+
+PGO_PHASES: list[PgoPhase] = [
+    PgoPhase("llvm", ["--llvm-profile-generate"],
+             LLVM_PROFRAW_PATH, LLVM_PROFDATA_PATH, True),
+    PgoPhase("rustc", [f"--rust-profile-generate={RUST_PROFRAW_PATH}", f"--llvm-profile-use={LLVM_PROFDATA_PATH}"],
+             RUST_PROFRAW_PATH, RUST_PROFDATA_PATH, False),
+]
+
+
+def profile_use_flags() -> list[str]:
+    """Returns the x.py flags for building the compiler with the merged
+    profiles."""
+    return [f"--rust-profile-use={RUST_PROFDATA_PATH}", f"--llvm-profile-use={LLVM_PROFDATA_PATH}"]
+
+
+def prepare() -> None:
+    if PGO_PROFILE_PATH.exists():
+        shutil.rmtree(PGO_PROFILE_PATH)
+    RUST_PROFRAW_PATH.mkdir(parents=True)
+    LLVM_PROFRAW_PATH.mkdir(parents=True)
+
+
+def run_training_workload(rustc: Path, env: dict[str, str], targets: list[str]) -> float:
+    """Compiles every crate in the training corpus for each target with the
+    given compiler and returns the time taken in seconds.
+
+    Only the libraries are built so that no target linker is needed.
+    """
+    training_env = dict(env)
+    training_env["RUSTC"] = rustc.as_posix()
+    training_env["CARGO_TARGET_DIR"] = TRAINING_TARGET_PATH.as_posix()
+    training_env.pop("RUSTFLAGS", None)
+
+    start = time.monotonic()
+    for crate in corpus_crates():
+        for target in targets:
+            # Cleaning first makes every run compile the whole crate graph.
+            if TRAINING_TARGET_PATH.exists():
+                shutil.rmtree(TRAINING_TARGET_PATH)
+            run_quiet_and_exit_on_failure(
+                [CARGO_PATH, "build", "--offline", "--locked", "--release", "--lib", "--target", target],
+                f"Failed to build training crate {crate.name} for {target}",
+                cwd=crate, env=training_env)
+
+    return time.monotonic() - start
+
+
+def train(phase: PgoPhase, env: dict[str, str], targets: list[str]) -> None:
+    """Runs the training workload with the instrumented stage 2 compiler."""
+    training_env = dict(env)
+    if phase.redirect_profiles:
+        training_env["LLVM_PROFILE_FILE"] = (phase.raw_path / f"{phase.name}-%p-%m.profraw").as_posix()
+
+    seconds = run_training_workload(stage2_rustc_path(), training_env, targets)
+    print(f"Collected {phase.name} profiles in {seconds:.1f}s")
+
+
+def merge_profiles(phase: PgoPhase) -> None:
+    raw_profiles = sorted(phase.raw_path.glob("*.profraw"))
+    if not raw_profiles:
+        sys.exit(f"No profiles were written to {phase.raw_path}")
+
+    run_and_exit_on_failure(
+        [LLVM_PROFDATA_TOOL_PATH, "merge", "-o", phase.profdata_path] + raw_profiles,
+        f"Failed to merge the profiles in {phase.raw_path}")
+    print("Merged {} profiles into {} ({:.1f} MiB)".format(
+        len(raw_profiles), phase.profdata_path.name, phase.profdata_path.stat().st_size / 2**20))
+
+
+def clean_instrumented_build() -> None:
+    """Removes the instrumented compiler and LLVM so that the bootstrap
+    system rebuilds them for the next phase or with the profiles."""
+    host_build_path = OUT_PATH_RUST_SOURCE / "build" / build_platform.triple()
+    if host_build_path.exists():
+        shutil.rmtree(host_build_path)
+    if TRAINING_TARGET_PATH.exists():
+        shutil.rmtree(TRAINING_TARGET_PATH)
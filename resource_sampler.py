@@ -0,0 +1,217 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Samples the resource usage of a process tree while it runs.
+
+Sampling reads /proc and is therefore only available on Linux.
+"""
+
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+
+import build_platform
+
+
+# Command names (as truncated in /proc/<pid>/stat) counted as compiler jobs
+COMPILER_PROCESS_NAMES: set[str] = {"rustc", "clang", "clang++", "ld.lld", "lld", "llvm-ar", "cc1", "cc1plus"}
+
+# Number of processes listed in the summary of peak memory users
+SUMMARY_TOP_PROCESSES: int = 10
+
+CLOCK_TICKS: int = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE:   int = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class ProcessStat(NamedTuple):
+    pid:      int
+    ppid:     int
+    comm:     str
+    # CPU time in clock ticks, including reaped children
+    cpu_time: int
+    rss:      int
+
+
+class ProcessPeak(NamedTuple):
+    pid:     int
+    comm:    str
+    rss:     int
+    cmdline: str
+
+
+def read_process_stat(pid: int) -> Optional[ProcessStat]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            contents = f.read()
+    except OSError:
+        return None
+
+    # The command name is parenthesized and may itself contain spaces.
+    comm_end = contents.rindex(")")
+    comm = contents[contents.index("(") + 1:comm_end]
+    fields = contents[comm_end + 2:].split()
+
+    # Field numbers from proc(5), offset by the pid and comm fields
+    ppid = int(fields[1])
+    cpu_time = sum(int(field) for field in fields[11:15])
+    rss = int(fields[21]) * PAGE_SIZE
+    return ProcessStat(pid, ppid, comm, cpu_time, rss)
+
+
+def read_cmdline(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode(errors="replace").strip()[:300]
+    except OSError:
+        return ""
+
+
+def read_disk_io(tree: list[ProcessStat]) -> tuple[int, int]:
+    """Returns the number of bytes the processes in tree have read from and
+    written to disk.  Like the CPU time, the counters of a process include
+    the children it has reaped."""
+    read_bytes = 0
+    write_bytes = 0
+    for stat in tree:
+        try:
+            with open(f"/proc/{stat.pid}/io") as f:
+                counters = dict(line.split(": ") for line in f.read().splitlines())
+        except OSError:
+            continue
+        read_bytes += int(counters.get("read_bytes", 0))
+        write_bytes += int(counters.get("write_bytes", 0))
+    return (read_bytes, write_bytes)
+
+
+def process_tree(root_pid: int) -> list[ProcessStat]:
+    stats: dict[int, ProcessStat] = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            stat = read_process_stat(int(entry))
+            if stat:
+                stats[stat.pid] = stat
+
+    children: dict[int, list[int]] = {}
+    for stat in stats.values():
+        children.setdefault(stat.ppid, []).append(stat.pid)
+
+    tree: list[ProcessStat] = []
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in stats:
+            tree.append(stats[pid])
+            pending.extend(children.get(pid, []))
+    return tree
+
+
+class ResourceSampler(threading.Thread):
+    """Records CPU, memory, disk and compiler process counts for the process
+    tree rooted at a pid, at a fixed interval, until stopped."""
+
+    def __init__(self, root_pid: int, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples: list[tuple[float, float, int, float, float, int, int]] = []
+        self.peaks: dict[int, ProcessPeak] = {}
+
+    def run(self) -> None:
+        start = time.monotonic()
+        last_time = start
+        last_cpu: Optional[int] = None
+        last_io: Optional[tuple[int, int]] = None
+
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            tree = process_tree(self.root_pid)
+            if not tree:
+                break
+
+            # Summing the CPU time of live processes, including the time of
+            # the children they have reaped, covers the whole tree.
+            cpu = sum(stat.cpu_time for stat in tree)
+            io = read_disk_io(tree)
+            elapsed = now - last_time
+
+            cores = (cpu - last_cpu) / CLOCK_TICKS / elapsed if last_cpu is not None else 0.0
+            # Counters drop when a process exits before its parent reaps it.
+            io_rates = ((max(io[0] - last_io[0], 0) / elapsed, max(io[1] - last_io[1], 0) / elapsed)
+                        if last_io is not None else (0.0, 0.0))
+            self.samples.append((
+                round(now - start, 2),
+                round(max(cores, 0.0), 2),
+                sum(stat.rss for stat in tree),
+                round(io_rates[0]),
+                round(io_rates[1]),
+                len(tree),
+                sum(1 for stat in tree if stat.comm in COMPILER_PROCESS_NAMES)))
+
+            for stat in tree:
+                peak = self.peaks.get(stat.pid)
+                if peak is None or stat.rss > peak.rss:
+                    cmdline = peak.cmdline if peak else read_cmdline(stat.pid)
+                    self.peaks[stat.pid] = ProcessPeak(stat.pid, stat.comm, stat.rss, cmdline)
+
+            last_time, last_cpu, last_io = now, cpu, io
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def summary(self) -> dict[str, Any]:
+        top = sorted(self.peaks.values(), key=lambda peak: peak.rss, reverse=True)[:SUMMARY_TOP_PROCESSES]
+        return {
+            "samples":            len(self.samples),
+            "interval_s":         self.interval,
+            "peak_cpu_cores":     max((s[1] for s in self.samples), default=0.0),
+            "peak_tree_rss":      max((s[2] for s in self.samples), default=0),
+            "peak_disk_read_bps": max((s[3] for s in self.samples), default=0),
+            "peak_disk_write_bps": max((s[4] for s in self.samples), default=0),
+            "peak_compilers":     max((s[6] for s in self.samples), default=0),
+            "top_processes_by_rss": [peak._asdict() for peak in top],
+        }
+
+    def save(self, series_path: Path, summary_path: Path) -> None:
+        with open(series_path, "w") as f:
+            f.write("time_s,cpu_cores,tree_rss,disk_read_bps,disk_write_bps,processes,compilers\n")
+            for sample in self.samples:
+                f.write(",".join(str(value) for value in sample) + "\n")
+
+        summary = self.summary()
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+        print("Peak usage: {:.1f} cores, {:.1f} GiB RSS, {} concurrent compiler processes".format(
+            summary["peak_cpu_cores"], summary["peak_tree_rss"] / 2**30, summary["peak_compilers"]))
+        for peak in summary["top_processes_by_rss"][:3]:
+            print(f"  {peak['rss'] / 2**30:.2f} GiB  {peak['comm']} (pid {peak['pid']})")
+
+
+def start_sampler(root_pid: int, interval: float) -> Optional[ResourceSampler]:
+    """Starts sampling the process tree under root_pid, or returns None if
+    sampling is disabled or unsupported."""
+    if interval <= 0:
+        return None
+    if not build_platform.is_linux():
+        print("Resource sampling is only supported on Linux")
+        return None
+
+    sampler = ResourceSampler(root_pid, interval)
+    sampler.start()
+    return sampler
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports how the size of a prebuilt toolchain changed from the previous one.
+
+Files are compared by their path relative to the version directory and
+grouped into categories.  Categories and files that grew by more than the
+threshold are flagged.
+"""
+
+import argparse
+import os
+from pathlib import Path
+import sys
+from typing import NamedTuple, Optional
+
+from paths import RUST_PREBUILT_PATH
+from utils import version_key
+
+
+DEFAULT_SIZE_THRESHOLD: float = 5.0
+
+# Growth of individual files below this many bytes is never flagged
+MIN_FLAGGED_GROWTH: int = 64 * 1024
+
+# Number of individual files listed with the largest growth
+TOP_CHANGES: int = 10
+
+
+class SizeChange(NamedTuple):
+    path:   str
+    before: int
+    after:  int
+
+    @property
+    def delta(self) -> int:
+        return self.after - self.before
+
+    def exceeds(self, threshold: float) -> bool:
+        if self.before == 0:
+            return self.after > 0
+        return self.delta * 100.0 / self.before > threshold
+
+
+def categorize(rel_path: str) -> str:
+    parts = rel_path.split("/")
+    if rel_path.startswith("src/stdlibs/"):
+        return "stdlib sources"
+    elif rel_path.endswith(".rlib"):
+        target = parts[parts.index("rustlib") + 1] if "rustlib" in parts else "unknown"
+        return f"rlibs ({target})"
+    elif ".so" in parts[-1] or parts[-1].endswith(".dylib"):
+        return "shared libraries"
+    elif parts[0] == "bin":
+        return "binaries"
+    else:
+        return "other"
+
+
+def file_sizes(root: Path) -> dict[str, int]:
+    sizes: dict[str, int] = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = Path(dirpath) / name
+            if not path.is_symlink():
+                sizes[path.relative_to(root).as_posix()] = path.stat().st_size
+    return sizes
+
+
+def previous_version_path(version_path: Path) -> Optional[Path]:
+    """Returns the newest sibling version directory that is older than
+    version_path."""
+    current_key = version_key(version_path.name)
+    older = [path for path in version_path.parent.iterdir()
+             if path.is_dir() and path.name[0].isdigit() and version_key(path.name) < current_key]
+    return max(older, key=lambda path: version_key(path.name)) if older else None
+
+
+def format_size(size: int) -> str:
+    return f"{size / 2**20:10.2f} MiB"
+
+
+def report(old_path: Path, new_path: Path, threshold: float) -> bool:
+    """Prints the size changes between two package directories and returns
+    True if anything grew by more than threshold percent."""
+    old_sizes = file_sizes(old_path)
+    new_sizes = file_sizes(new_path)
+
+    changes = [SizeChange(path, old_sizes.get(path, 0), new_sizes.get(path, 0))
+               for path in sorted(old_sizes.keys() | new_sizes.keys())]
+
+    categories: dict[str, list[SizeChange]] = {}
+    for change in changes:
+        categories.setdefault(categorize(change.path), []).append(change)
+
+    print(f"Size changes from {old_path.name} to {new_path.name}:")
+    flagged = False
+    for category in sorted(categories):
+        total = SizeChange(category,
+            sum(change.before for change in categories[category]),
+            sum(change.after for change in categories[category]))
+        exceeded = total.exceeds(threshold)
+        flagged = flagged or exceeded
+        print("  {:<40} {} -> {} ({:+.2f} MiB){}".format(
+            category, format_size(total.before), format_size(total.after),
+            total.delta / 2**20, "  <-- above threshold" if exceeded else ""))
+
+    total_before = sum(old_sizes.values())
+    total_after  = sum(new_sizes.values())
+    print("  {:<40} {} -> {} ({:+.2f} MiB)".format(
+        "total", format_size(total_before), format_size(total_after),
+        (total_after - total_before) / 2**20))
+
+    grown = [change for change in changes
+             if change.delta >= MIN_FLAGGED_GROWTH and change.exceeds(threshold)]
+    if grown:
+        flagged = True
+        print(f"Files that grew by more than {threshold:g}%:")
+        for change in sorted(grown, key=lambda change: change.delta, reverse=True)[:TOP_CHANGES]:
+            print("  {:+10.2f} MiB  {}".format(change.delta / 2**20, change.path))
+        if len(grown) > TOP_CHANGES:
+            print(f"  ... and {len(grown) - TOP_CHANGES} more")
+
+    return flagged
+
+
+def report_prebuilt(target: str, version: str, threshold: float) -> bool:
+    """Reports the size changes of a prebuilt against the previous version of
+    the same target.  Returns True if anything was flagged."""
+    version_path = RUST_PREBUILT_PATH / target / version
+    previous_path = previous_version_path(version_path)
+    if previous_path is None:
+        print(f"No previous version of {target} to compare sizes against")
+        return False
+    return report(previous_path, version_path, threshold)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("old", type=Path, help="Previous package directory")
+    parser.add_argument("new", type=Path, help="New package directory")
+    parser.add_argument("--size-threshold", type=float, default=DEFAULT_SIZE_THRESHOLD,
+                        help="Percentage of growth to flag")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    sys.exit(1 if report(args.old, args.new, args.size_threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,50 +17,553 @@
 Package to manage Rust source files when building a toolchain distributable.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
 from pathlib import Path
+import re
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+from typing import Any, NamedTuple, Optional
 
 import build_platform
-from utils import prepare_command, run_quiet_and_exit_on_failure, run_quiet
+import build_trace
+from paths import OUT_PATH_SNAPSHOTS
+from utils import GitRepo, hash_directory, hash_file, prepare_command, run_quiet_and_exit_on_failure, run_quiet
+
+def source_tree_hash(source_path: Path, subdir: str = "") -> str:
+    if (source_path / ".git").exists():
+        return GitRepo(source_path).tree_hash(subdir)
+    else:
+        return hash_directory(source_path / subdir)
+
+
+class PatchSnapshots:
+    """Copies of the source tree taken after each patch in the patch stack.
+
+    A snapshot is keyed by the hash of the pristine source tree and the hashes
+    of every patch applied so far, so a change to a patch only invalidates the
+    snapshots that follow it.  Snapshots are reflinked copies of the tree and
+    are disabled on file systems that don't support reflinks.
+    """
+
+    def __init__(self, snapshot_dir: Path, source_key: str, patch_list: list[Path]) -> None:
+        self.path = snapshot_dir
+        self.enabled = build_platform.is_linux()
+
+        # keys[i] identifies the tree after the first i patches are applied.
+        self.keys: list[str] = [source_key]
+        for patch in patch_list:
+            self.keys.append(hashlib.sha256(
+                (self.keys[-1] + hash_file(patch)).encode()).hexdigest())
+
+    def snapshot_path(self, index: int) -> Path:
+        return self.path / self.keys[index]
+
+    def latest(self) -> int:
+        """Returns the length of the longest patch prefix with a snapshot."""
+        for index in range(len(self.keys) - 1, 0, -1):
+            if self.snapshot_path(index).exists():
+                return index
+        return 0
+
+    def save(self, index: int, tree: Path) -> None:
+        if not self.enabled or self.snapshot_path(index).exists():
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path / (self.keys[index] + ".tmp")
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+
+        if run_quiet(f"cp -R --reflink=always {tree} {tmp_path}") != 0:
+            print("\nReflinks are not supported; disabling patch snapshots")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            self.enabled = False
+            return
+
+        tmp_path.rename(self.snapshot_path(index))
+
+    def prune(self) -> None:
+        """Removes every snapshot that doesn't belong to the current stack."""
+        if not self.path.exists():
+            return
+
+        for entry in self.path.iterdir():
+            if entry.name not in self.keys:
+                shutil.rmtree(entry)
+
+
+def apply_patches(code_dir: Path, patch_list: list[Path], no_patch_abort: bool = False,
+    snapshots: Optional[PatchSnapshots] = None, start: int = 0) -> None:
 
-def apply_patches(code_dir: Path, patch_dir: Path, no_patch_abort: bool = False) -> None:
-    patch_list    = sorted(patch_dir.glob("rustc-*"))
     count_padding = len(str(len(patch_list)))
 
-    for idx, filepath in enumerate(patch_list):
+    for idx, filepath in enumerate(patch_list[start:], start):
         print("\33[2K\rApplying patch ({cur:>{width}}/{total}): {name}".format(
                 cur=(idx + 1), width=count_padding, total=len(patch_list), name=filepath.name),
             end="")
 
         command_list: list[str] = prepare_command(f"patch -p1 -N -r - -i {filepath}")
-        result = subprocess.run(command_list, cwd=code_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with build_trace.span(f"patch {filepath.name}"):
+            result = subprocess.run(command_list, cwd=code_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        if result.returncode != 0:
+            if not no_patch_abort:
+                print(f"\nBuild failed when applying patch {filepath}")
+                print("If developing locally, try the --no-patch-abort flag")
+                print("\nOutput (stdout):")
+                print(result.stdout.decode('UTF-8'))
+                print("\nOutput (stderr):")
+                print(result.stderr.decode('UTF-8'))
+                print()
 
-        if result.returncode != 0 and not no_patch_abort:
-            print(f"\nBuild failed when applying patch {filepath}")
-            print("If developing locally, try the --no-patch-abort flag")
-            print("\nOutput (stdout):")
-            print(result.stdout.decode('UTF-8'))
-            print("\nOutput (stderr):")
-            print(result.stderr.decode('UTF-8'))
-            print()
+                sys.exit(result.returncode)
 
-            sys.exit(result.returncode)
+            # The tree no longer matches the snapshot keys.
+            snapshots = None
+
+        if snapshots:
+            with build_trace.span(f"snapshot {filepath.name}"):
+                snapshots.save(idx + 1, code_dir)
 
     # If all patches applied cleanly we need to advance to the next line in the
     # terminal
     print()
 
 
-def setup_files(input_dir: Path, output_dir: Path, patches_dir: Path, no_patch_abort: bool = False) -> None:
+#
+# Patch parsing
+#
+
+HUNK_HEADER_PATTERN: re.Pattern[str] = re.compile(r"^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+PATCH_FAILED_HUNK_PATTERN: re.Pattern[str] = re.compile(r"^Hunk #(\d+) FAILED at (\d+)")
+PATCH_FILE_PATTERN: re.Pattern[str] = re.compile(r"^(?:checking|patching) file '?(.*?)'?$")
+
+
+class FilePatch(NamedTuple):
+    """The portion of a patch that modifies a single file.  Paths have their
+    leading a/ and b/ components removed and are None for /dev/null."""
+    old_path: Optional[str]
+    new_path: Optional[str]
+    text: str
+
+    def paths(self) -> set[str]:
+        return {path for path in (self.old_path, self.new_path) if path}
+
+
+def strip_patch_path(header_path: str) -> Optional[str]:
+    # Timestamps in unified diff headers are separated by a tab.
+    path = header_path.split("\t")[0].strip()
+    if path == "/dev/null":
+        return None
+    return path.split("/", 1)[1] if "/" in path else path
+
+
+def parse_patch(patch_path: Path) -> list[FilePatch]:
+    """Splits a patch file into the per-file diffs it contains."""
+    with open(patch_path, errors="surrogateescape") as f:
+        lines = f.readlines()
+
+    file_patches: list[FilePatch] = []
+    section: list[str] = []
+    old_path: Optional[str] = None
+    new_path: Optional[str] = None
+    has_hunks = False
+
+    def finish_section() -> None:
+        if has_hunks or old_path or new_path:
+            file_patches.append(FilePatch(old_path, new_path, "".join(section)))
+
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+
+        starts_section = line.startswith("diff ") or (
+            line.startswith("--- ") and idx + 1 < len(lines) and
+            lines[idx + 1].startswith("+++ ") and has_hunks)
+        if starts_section:
+            finish_section()
+            section, old_path, new_path, has_hunks = [], None, None, False
+
+        if line.startswith("diff --git ") and not has_hunks:
+            # Fallback for diffs without ---/+++ headers (e.g. mode changes)
+            _, _, a_path, b_path = line.rstrip("\n").split(" ", 3)
+            old_path, new_path = strip_patch_path(a_path), strip_patch_path(b_path)
+        elif line.startswith("--- ") and not has_hunks:
+            old_path = strip_patch_path(line[4:])
+        elif line.startswith("+++ ") and not has_hunks:
+            new_path = strip_patch_path(line[4:])
+        elif line.startswith("new file mode"):
+            old_path = None
+        elif line.startswith("deleted file mode"):
+            new_path = None
+
+        match = HUNK_HEADER_PATTERN.match(line)
+        if match and (old_path or new_path):
+            has_hunks = True
+            old_remaining = int(match.group(1) or 1)
+            new_remaining = int(match.group(2) or 1)
+            section.append(line)
+            idx += 1
+
+            # Consume the hunk body so that its lines are never mistaken for
+            # headers.
+            while idx < len(lines) and (old_remaining > 0 or new_remaining > 0):
+                line = lines[idx]
+                if line.startswith("-"):
+                    old_remaining -= 1
+                elif line.startswith("+"):
+                    new_remaining -= 1
+                elif not line.startswith("\\"):
+                    old_remaining -= 1
+                    new_remaining -= 1
+                section.append(line)
+                idx += 1
+
+            if idx < len(lines) and lines[idx].startswith("\\"):
+                section.append(lines[idx])
+                idx += 1
+            continue
+
+        if (old_path or new_path) or line.startswith("diff "):
+            section.append(line)
+        idx += 1
+
+    finish_section()
+    return file_patches
+
+
+def patch_touched_files(patch_path: Path) -> set[str]:
+    """Returns the paths, relative to the source root, that a patch modifies,
+    creates or deletes."""
+    return set().union(*[file_patch.paths() for file_patch in parse_patch(patch_path)])
+
+#
+# Patch validation
+#
+
+class PatchCheckResult(NamedTuple):
+    patch: Path
+    files: list[str]
+    # Maps each file that failed to patch to a description of its failures
+    failures: dict[str, list[str]]
+    output: str
+
+
+def dry_run_patch(source_dir: Path, patch_list: list[Path], index: int) -> PatchCheckResult:
+    """Checks if patch_list[index] applies on top of the patches before it.
+
+    The check runs against a private view of the tree that only contains the
+    files touched by the patch, each brought up to date by replaying the
+    earlier patches' diffs for that file.
+    """
+    patch = patch_list[index]
+    files = patch_touched_files(patch)
+
+    with tempfile.TemporaryDirectory(prefix=f"{patch.name}-") as view_name:
+        view_dir = Path(view_name)
+
+        for rel_path in files:
+            src_path = source_dir / rel_path
+            if src_path.is_file():
+                (view_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(src_path, view_dir / rel_path)
+
+        for earlier_patch in patch_list[:index]:
+            for file_patch in parse_patch(earlier_patch):
+                if file_patch.paths() & files:
+                    subprocess.run(
+                        prepare_command("patch -p1 -N -r - -s -f"),
+                        cwd=view_dir, input=file_patch.text.encode(errors="surrogateescape"),
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        result = subprocess.run(
+            prepare_command(f"patch -p1 -N -r - -f --dry-run -i {patch}"),
+            cwd=view_dir, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    failures: dict[str, list[str]] = {}
+    current_file = "<unknown>"
+    for line in result.stdout.splitlines():
+        file_match = PATCH_FILE_PATTERN.match(line)
+        if file_match:
+            current_file = file_match.group(1)
+        elif PATCH_FAILED_HUNK_PATTERN.match(line) or "can't find file" in line or "Reversed" in line:
+            failures.setdefault(current_file, []).append(line.strip())
+
+    if result.returncode != 0 and not failures:
+        failures[current_file] = [f"patch exited with status {result.returncode}"]
+
+    return PatchCheckResult(patch, sorted(files), failures, result.stdout)
+
+
+def validate_patches(source_dir: Path, patches_dir: Path) -> bool:
+    """Dry-runs every patch in parallel and reports all failures at once.
+    Returns True if every patch applies cleanly."""
+    patch_list = sorted(patches_dir.glob("rustc-*"))
+
+    print(f"Validating {len(patch_list)} patches against {source_dir}")
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(
+            dry_run_patch,
+            [source_dir] * len(patch_list),
+            [patch_list] * len(patch_list),
+            range(len(patch_list))))
+
+    failed = [result for result in results if result.failures]
+    for result in failed:
+        print(f"\nPatch {result.patch.name} does not apply")
+        print(f"  Files: {', '.join(result.files)}")
+        for file_name, messages in result.failures.items():
+            print(f"  {file_name}:")
+            for message in messages:
+                print(f"    {message}")
+
+    print(f"\n{len(patch_list) - len(failed)}/{len(patch_list)} patches apply cleanly")
+    return not failed
+
+
+#
+# Tree synchronization
+#
+
+FILE_INDEX_VERSION: int = 1
+
+
+class FileIndex:
+    """A persistent cache of content hashes keyed by file metadata.
+
+    Entries map a path relative to a tree root to its size, modification time,
+    inode number and SHA-256 digest.  A file is only re-hashed when its
+    metadata no longer matches the recorded entry.
+    """
+
+    def __init__(self, index_path: Path) -> None:
+        self.path = index_path
+        self.trees: dict[str, dict[str, list[Any]]] = {}
+
+        if index_path.exists():
+            try:
+                with open(index_path) as f:
+                    contents = json.load(f)
+                if contents.get("version") == FILE_INDEX_VERSION:
+                    self.trees = contents["trees"]
+            except (OSError, ValueError):
+                print(f"Ignoring unreadable file index {index_path}")
+
+    def file_hash(self, tree: str, root: Path, rel_path: str, st: os.stat_result) -> str:
+        entries = self.trees.setdefault(tree, {})
+        entry = entries.get(rel_path)
+        if entry and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+            return str(entry[3])
+
+        digest = hash_file(root / rel_path)
+        self.record(tree, rel_path, st, digest)
+        return digest
+
+    def record(self, tree: str, rel_path: str, st: os.stat_result, digest: str) -> None:
+        self.trees.setdefault(tree, {})[rel_path] = [st.st_size, st.st_mtime_ns, st.st_ino, digest]
+
+    def retain(self, tree: str, rel_paths: set[str]) -> None:
+        entries = self.trees.setdefault(tree, {})
+        for rel_path in set(entries) - rel_paths:
+            del entries[rel_path]
+
+    def save(self) -> None:
+        tmp_path = self.path.parent / (self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": FILE_INDEX_VERSION, "trees": self.trees}, f)
+        tmp_path.replace(self.path)
+
+
+def scan_tree(root: Path) -> dict[str, os.DirEntry[str]]:
+    """Returns every entry below root keyed by its path relative to root.
+    Symlinks to directories are not followed."""
+    entries: dict[str, os.DirEntry[str]] = {}
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(root / rel_dir) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name)
+                entries[rel_path] = entry
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(rel_path)
+    return entries
+
+
+def remove_path(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def sync_tree(tmp_dir: Path, output_dir: Path, input_dir: Path, patched_files: set[str],
+    link_unpatched: bool = False) -> None:
+    """Makes output_dir identical to tmp_dir, touching only files that differ.
+
+    tmp_dir is a copy of input_dir with patches applied, so the content of any
+    file not in patched_files is known from the matching file in input_dir.
+    Hashes for input_dir and output_dir are cached in a persistent index,
+    which means that only new, patched or modified files are read.  Unchanged
+    files in output_dir keep their modification times.
+
+    If link_unpatched is set, new or changed files that weren't patched are
+    hardlinked from tmp_dir rather than copied, preserving a link farm.
+    """
+    index = FileIndex(output_dir.parent / (output_dir.name + ".index.json"))
+
+    tmp_entries = scan_tree(tmp_dir)
+    out_entries = scan_tree(output_dir)
+
+    # Remove anything that isn't in the new tree or has changed type.  Sorting
+    # in reverse removes children before their parents.
+    for rel_path in sorted(out_entries, reverse=True):
+        if rel_path not in out_entries:
+            continue
+
+        out_entry = out_entries[rel_path]
+        tmp_entry = tmp_entries.get(rel_path)
+        if (tmp_entry is None or
+            tmp_entry.is_symlink() != out_entry.is_symlink() or
+            tmp_entry.is_dir(follow_symlinks=False) != out_entry.is_dir(follow_symlinks=False)):
+
+            remove_path(output_dir / rel_path)
+            removed_prefix = rel_path + os.sep
+            for removed_path in [path for path in out_entries
+                                 if path == rel_path or path.startswith(removed_prefix)]:
+                del out_entries[removed_path]
+
+    updated = 0
+    source_paths: set[str] = set()
+    for rel_path in sorted(tmp_entries):
+        tmp_entry = tmp_entries[rel_path]
+        out_path  = output_dir / rel_path
+
+        if tmp_entry.is_symlink():
+            link_target = os.readlink(tmp_entry.path)
+            if rel_path not in out_entries or os.readlink(out_path) != link_target:
+                remove_path(out_path)
+                os.symlink(link_target, out_path)
+                updated += 1
+            continue
+
+        if tmp_entry.is_dir():
+            out_path.mkdir(exist_ok=True)
+            continue
+
+        src_path = input_dir / rel_path
+        from_source = (rel_path not in patched_files and
+                       src_path.is_file() and not src_path.is_symlink())
+        if from_source:
+            source_paths.add(rel_path)
+            expected_hash = index.file_hash("source", input_dir, rel_path, src_path.stat())
+        else:
+            expected_hash = hash_file(Path(tmp_entry.path))
+
+        tmp_mode = tmp_entry.stat().st_mode
+        if rel_path in out_entries:
+            out_stat = out_entries[rel_path].stat()
+            if index.file_hash("output", output_dir, rel_path, out_stat) == expected_hash:
+                if (out_stat.st_mode ^ tmp_mode) & 0o111:
+                    out_path.chmod(stat.S_IMODE(tmp_mode))
+                continue
+
+        # Write to a temporary name and rename so that an interrupted sync
+        # never leaves a truncated file behind.
+        staging_path = out_path.parent / (out_path.name + ".sync-tmp")
+        if staging_path.exists():
+            staging_path.unlink()
+        if link_unpatched and from_source and rel_path not in LINK_FARM_COPIED_FILES:
+            os.link(tmp_entry.path, staging_path)
+        else:
+            shutil.copyfile(tmp_entry.path, staging_path)
+            staging_path.chmod(stat.S_IMODE(tmp_mode))
+        staging_path.replace(out_path)
+        index.record("output", rel_path, out_path.stat(), expected_hash)
+        updated += 1
+
+    print(f"Updated {updated} of {len(tmp_entries)} files and directories")
+
+    index.retain("source", source_paths)
+    index.retain("output", {rel_path for rel_path, entry in tmp_entries.items() if entry.is_file(follow_symlinks=False)})
+    index.save()
+
+
+#
+# Link farms
+#
+
+# Files that the build rewrites in place and which are always copied in full.
+LINK_FARM_COPIED_FILES: set[str] = {"Cargo.lock"}
+
+
+def supports_reflinks(input_dir: Path, dest_dir: Path) -> bool:
+    """Checks if cp can reflink files from input_dir into dest_dir."""
+    # Darwin always clones with 'cp -c', which falls back to a copy itself.
+    if not build_platform.is_linux():
+        return True
+
+    probe_source = next((path for path in input_dir.iterdir() if path.is_file()), None)
+    if probe_source is None:
+        return True
+
+    probe_dest = dest_dir / ".reflink-probe"
+    result = run_quiet(f"cp --reflink=always {probe_source} {probe_dest}")
+    if probe_dest.exists():
+        probe_dest.unlink()
+    return result == 0
+
+
+def create_link_farm(input_dir: Path, output_dir: Path, copied_files: set[str]) -> None:
+    """Mirrors input_dir into output_dir using hardlinks.
+
+    The whole tree is linked by a single 'cp -al', after which the link of
+    every file in copied_files is broken by replacing it with a copy, so that
+    patching or rewriting it can't modify input_dir.
+    """
+    run_quiet_and_exit_on_failure(f"cp -al {input_dir} {output_dir}",
+        f"Failed to create link farm at {output_dir}")
+
+    for rel_path in sorted(copied_files):
+        dst_path = output_dir / rel_path
+        if dst_path.is_symlink() or not dst_path.is_file():
+            continue
+
+        staging_path = dst_path.parent / (dst_path.name + ".farm-tmp")
+        shutil.copyfile(dst_path, staging_path)
+        shutil.copymode(dst_path, staging_path)
+        staging_path.replace(dst_path)
+
+
+def setup_files(input_dir: Path, output_dir: Path, patches_dir: Path, no_patch_abort: bool = False,
+    link_farm: bool = False) -> None:
     """Copy source and apply patches in a performant and fault-tolerant manner.
 
     This function creates a copy-on-write mirror of the source directory and
     applies the patches contained in the patch directory.  If the patches apply
     cleanly then the mirror is renamed to the output directory.
+
+    When a snapshot of the tree exists for a prefix of the patch stack the
+    mirror is created from it and only the remaining patches are applied.
+
+    If link_farm is set and the file system doesn't support reflinks the
+    mirror is built as a hardlink farm instead of a full copy.  Only the files
+    touched by patches, and those the build rewrites, are copied; the build
+    must not modify any other file in place.
     """
 
+    patch_list = sorted(patches_dir.glob("rustc-*"))
+    snapshots  = PatchSnapshots(OUT_PATH_SNAPSHOTS, source_tree_hash(input_dir), patch_list)
+    start      = snapshots.latest()
+    copy_input = snapshots.snapshot_path(start) if start > 0 else input_dir
+
     # Calculate the name of the temporary directory and remove any stale files
     # if they exist.
     tmp_output_dir = output_dir.parent / (output_dir.name + '.tmp')
@@ -71,26 +574,40 @@ def setup_files(input_dir: Path, output_dir: Path, patches_dir: Path, no_patch_a
     if not tmp_output_dir.parent.exists():
         tmp_output_dir.parent.mkdir(parents=True)
 
-    print("Creating copy of Rust source")
+    patched_files = set().union(*[patch_touched_files(patch) for patch in patch_list])
+    use_link_farm = link_farm and not supports_reflinks(input_dir, tmp_output_dir.parent)
+    if use_link_farm:
+        source_desc = f"snapshot after {patch_list[start - 1].name}" if start > 0 else "Rust source"
+        print(f"Creating link farm of {source_desc}")
+        with build_trace.span("link farm"):
+            create_link_farm(copy_input, tmp_output_dir, patched_files | LINK_FARM_COPIED_FILES)
+    elif start > 0:
+        print(f"Creating copy of Rust source from snapshot after {patch_list[start - 1].name}")
+    else:
+        print("Creating copy of Rust source")
 
     # Use 'cp' instead of shutil.copytree.  The latter uses copystat and retains
-    # timestamps from the source.  We instead use rsync below to only update
-    # changed files into source_dir.  Using 'cp' will ensure all changed files
+    # timestamps from the source.  We instead use sync_tree below to only
+    # update changed files into source_dir.  Using 'cp' will ensure all changed files
     # get a newer timestamp than files in $source_dir.
     #
     # Note: Darwin builds don't copy symlinks with -r.  Use -R instead.
-    command_template = f"cp -Rf %s {input_dir} {tmp_output_dir}"
-    reflink          = '--reflink=auto' if build_platform.is_linux() else '-c'
-    try:
-        run_quiet(command_template % reflink, check=True)
-    except subprocess.CalledProcessError:
-        # Fallback to normal copy.
-        run_quiet_and_exit_on_failure(
-            command_template % "",
-            f"Failed to copy source to temporary output path {tmp_output_dir}")
+    if not use_link_farm:
+        command_template = f"cp -Rf %s {copy_input} {tmp_output_dir}"
+        reflink          = '--reflink=auto' if build_platform.is_linux() else '-c'
+        with build_trace.span("copy source"):
+            try:
+                run_quiet(command_template % reflink, check=True)
+            except subprocess.CalledProcessError:
+                # Fallback to normal copy.
+                run_quiet_and_exit_on_failure(
+                    command_template % "",
+                    f"Failed to copy source to temporary output path {tmp_output_dir}")
 
     # Patch source tree
-    apply_patches(tmp_output_dir, patches_dir, no_patch_abort=no_patch_abort)
+    apply_patches(tmp_output_dir, patch_list, no_patch_abort=no_patch_abort,
+        snapshots=snapshots, start=start)
+    snapshots.prune()
 
     # Copy tmp_output_dir to output_dir if they are different.  This avoids
     # invalidating prior build outputs.
@@ -99,16 +616,10 @@ def setup_files(input_dir: Path, output_dir: Path, patches_dir: Path, no_patch_a
         tmp_output_dir.rename(output_dir)
     else:
         print('Synchronizing temporary directory with existing output directory')
-        # Without a trailing '/' in $SRC, rsync copies $SRC to
-        # $DST/BASENAME($SRC) instead of $DST.
-        tmp_output_dir_w_trailing_slash = str(tmp_output_dir) + '/'
-
-        # rsync to update only changed files.  Use '-c' to use checksums to find
-        # if files have changed instead of only modification time and size -
-        # which could have inconsistencies.  Use '--delete' to ensure files not
-        # in tmp_source_dir are deleted from $source_dir.
-        run_quiet_and_exit_on_failure(
-            f"rsync -r --delete --links -c {tmp_output_dir_w_trailing_slash} {output_dir}",
-            f"Failed to synchronize temporary ({tmp_output_dir}) and persistant ({output_dir}) output directories")
+        # Only the files touched by patches can differ from the input
+        # directory, which lets the sync skip hashing everything else.
+        with build_trace.span("sync"):
+            sync_tree(tmp_output_dir, output_dir, input_dir, patched_files,
+                link_unpatched=use_link_farm)
 
         shutil.rmtree(tmp_output_dir)
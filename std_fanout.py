@@ -0,0 +1,250 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builds the standard libraries of the device targets in parallel.
+
+Once the host toolchain has been installed into the package, the standard
+library of each device target is an independent build.  Each one runs in its
+own build directory with a config.toml that uses the packaged compiler, and
+the resulting sysroot directories are merged back into the package.
+"""
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import sys
+from typing import NamedTuple, Optional
+
+import build_platform
+import build_trace
+import config
+from paths import *
+from utils import clone_file, hash_file, prepare_command
+
+
+AR_MAGIC:       bytes = b"!<arch>\n"
+AR_HEADER_SIZE: int   = 60
+
+RMETA_MEMBER_NAME: str = "lib.rmeta"
+
+# The metadata of every rlib starts with the version string of the compiler
+# that produced it, e.g. "rustc 1.62.0 (a8314ef7d 2022-06-27)".  The commit
+# hash is missing for compilers built without Git information.
+RUSTC_VERSION_PATTERN: re.Pattern[str] = re.compile(
+    r"rustc (?P<release>\d+\.\d+\.\d+(?:-[\w.]+)?)(?: \((?P<hash>[0-9a-f]+) \d{4}-\d{2}-\d{2}\))?")
+
+
+class StdBuildRunner(ABC):
+    """Runs the command for one standard library build.
+
+    Runners other than LocalRunner must execute the command on a host that
+    sees the workspace at the same path, e.g. through a shared file system.
+    """
+
+    @abstractmethod
+    def run(self, command: list[str], cwd: Path, env: dict[str, str], log_path: Path) -> int:
+        pass
+
+
+class LocalRunner(StdBuildRunner):
+    """Runs builds as child processes of this one."""
+
+    def run(self, command: list[str], cwd: Path, env: dict[str, str], log_path: Path) -> int:
+        with open(log_path, "w") as log_file:
+            return subprocess.run(prepare_command(command), cwd=cwd, env=env,
+                stdout=log_file, stderr=subprocess.STDOUT).returncode
+
+
+class CommandRunner(StdBuildRunner):
+    """Runs builds through a launcher command, e.g. a remote execution client.
+
+    The working directory is passed as the first argument after the launcher,
+    followed by the command.  The environment of the build is forwarded
+    through `env`.
+    """
+
+    def __init__(self, launcher: list[str]) -> None:
+        self.launcher = launcher
+
+    def run(self, command: list[str], cwd: Path, env: dict[str, str], log_path: Path) -> int:
+        forwarded_env = [f"{name}={env[name]}" for name in
+                         ["PATH", "LD_LIBRARY_PATH", "LIBRARY_PATH", "RUSTFLAGS", "HOST_CFLAGS"]
+                         if name in env]
+        remote_command = self.launcher + [cwd.as_posix(), "env"] + forwarded_env + command
+        with open(log_path, "w") as log_file:
+            return subprocess.run(prepare_command(remote_command),
+                stdout=log_file, stderr=subprocess.STDOUT).returncode
+
+
+class StdBuildResult(NamedTuple):
+    target:     str
+    returncode: int
+    log_path:   Path
+    # Directory holding lib/ for the target, as laid out under lib/rustlib/
+    rustlib_path: Path
+
+
+def make_runner(launcher: Optional[str]) -> StdBuildRunner:
+    return CommandRunner(launcher.split()) if launcher else LocalRunner()
+
+
+def compiler_hash(package_dir: Path) -> str:
+    """Returns a hash of the compiler binaries installed in package_dir."""
+    driver_libs = sorted((package_dir / "lib").glob("librustc_driver-*"))
+    if not driver_libs:
+        sys.exit(f"No rustc driver library found in {package_dir / 'lib'}")
+    return hash_file(package_dir / "bin" / "rustc") + ":" + hash_file(driver_libs[0])
+
+
+def read_ar_member(archive_path: Path, member_name: str) -> Optional[bytes]:
+    """Returns the contents of a member of an ar archive, or None if the
+    archive doesn't have it.  Both GNU and BSD member names are supported."""
+    with open(archive_path, "rb") as f:
+        if f.read(len(AR_MAGIC)) != AR_MAGIC:
+            return None
+
+        while len(header := f.read(AR_HEADER_SIZE)) == AR_HEADER_SIZE:
+            name = header[0:16].decode(errors="replace").rstrip()
+            size = int(header[48:58])
+            # Members are padded to an even offset.
+            padded_size = size + size % 2
+
+            if name.startswith("#1/"):
+                name_length = int(name[3:])
+                name = f.read(name_length).decode(errors="replace").rstrip("\0")
+                size -= name_length
+                padded_size -= name_length
+            else:
+                name = name.removesuffix("/")
+
+            if name == member_name:
+                return f.read(size)
+            f.seek(padded_size, os.SEEK_CUR)
+
+    return None
+
+
+def rlib_compiler_version(rlib_path: Path) -> Optional[str]:
+    """Returns the version string of the compiler recorded in an rlib's
+    metadata."""
+    metadata = read_ar_member(rlib_path, RMETA_MEMBER_NAME)
+    if metadata is None:
+        return None
+    match = RUSTC_VERSION_PATTERN.search(metadata.decode("latin-1"))
+    return match.group(0) if match else None
+
+
+def same_compiler(version: str, expected_version: str) -> bool:
+    """Checks if two compiler version strings name the same release and,
+    where the expected compiler has one, the same commit hash."""
+    match = RUSTC_VERSION_PATTERN.fullmatch(version)
+    expected = RUSTC_VERSION_PATTERN.fullmatch(expected_version)
+    assert expected is not None
+    return (match is not None and
+            match.group("release") == expected.group("release") and
+            match.group("hash") == expected.group("hash"))
+
+
+def build_std(runner: StdBuildRunner, target: str, env: dict[str, str], jobs: int) -> StdBuildResult:
+    build_dir = OUT_PATH_STD_BUILDS / target / "build"
+    log_path  = OUT_PATH_STD_BUILDS / target / "build.log"
+
+    command = [PYTHON_PATH, OUT_PATH_RUST_SOURCE / "x.py", "build",
+               "--config", config.std_config_path(target),
+               "--build-dir", build_dir,
+               "--stage", "0",
+               "--target", target,
+               "--jobs", str(jobs),
+               "library/std"]
+
+    print(f"Building std for {target} (log: {log_path})")
+    returncode = runner.run([str(arg) for arg in command], OUT_PATH_RUST_SOURCE, env, log_path)
+
+    rustlib_path = build_dir / build_platform.triple() / "stage0-sysroot" / "lib" / "rustlib" / target
+    return StdBuildResult(target, returncode, log_path, rustlib_path)
+
+
+def merge_std(result: StdBuildResult, package_dir: Path, expected_version: str) -> list[str]:
+    """Copies the standard library of a target into the package and returns
+    a list of problems found with it."""
+    rlibs = sorted((result.rustlib_path / "lib").glob("*.rlib"))
+    if not rlibs:
+        return [f"{result.target}: no rlibs in {result.rustlib_path}"]
+
+    errors: list[str] = []
+    for rlib in rlibs:
+        version = rlib_compiler_version(rlib)
+        if version is None or not same_compiler(version, expected_version):
+            errors.append(f"{result.target}: {rlib.name} was built by {version or 'an unknown compiler'}")
+    if errors:
+        return errors
+
+    dest_path = package_dir / "lib" / "rustlib" / result.target
+    if dest_path.exists():
+        shutil.rmtree(dest_path)
+    shutil.copytree(result.rustlib_path, dest_path, symlinks=True,
+        copy_function=functools.partial(clone_file, allow_hardlink=False))
+    return []
+
+
+def build_std_targets(targets: list[str], env: dict[str, str], workers: int,
+    launcher: Optional[str] = None) -> None:
+    """Builds the standard library of each target using up to `workers`
+    concurrent builds and merges the results into the package.  Exits if any
+    build fails or if the libraries weren't all built by the packaged
+    compiler."""
+    runner = make_runner(launcher)
+    workers = min(workers, len(targets))
+    jobs = max((os.cpu_count() or 1) // workers, 1) if isinstance(runner, LocalRunner) else os.cpu_count() or 1
+
+    package_hash = compiler_hash(OUT_PATH_PACKAGE)
+    expected_version = subprocess.check_output(
+        [OUT_PATH_PACKAGE / "bin" / "rustc", "--version"], env=env, text=True).strip()
+    expected_match = RUSTC_VERSION_PATTERN.fullmatch(expected_version)
+    if expected_match is None:
+        sys.exit(f"Unrecognized version of the packaged compiler: {expected_version}")
+    if expected_match.group("hash") is None:
+        print("The packaged compiler has no commit hash; only its release can be checked")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda target: build_trace.traced(f"std {target}", build_std)(runner, target, env, jobs),
+            targets))
+
+    failures = [result for result in results if result.returncode != 0]
+    for result in failures:
+        print(f"Standard library build for {result.target} failed with error "
+              f"{result.returncode}; see {result.log_path}")
+    if failures:
+        sys.exit(1)
+
+    # The packaged compiler must not have changed while the libraries were
+    # being built, or the rlibs could be mismatched with it.
+    if compiler_hash(OUT_PATH_PACKAGE) != package_hash:
+        sys.exit("The packaged compiler changed during the standard library builds")
+
+    errors: list[str] = []
+    with build_trace.span("std merge"):
+        for result in results:
+            errors.extend(merge_std(result, OUT_PATH_PACKAGE, expected_version))
+    if errors:
+        print("\n".join(errors))
+        sys.exit("Standard libraries were not built by the packaged compiler")
+
+    print(f"Merged standard libraries for: {', '.join(targets)}")
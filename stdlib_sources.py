@@ -0,0 +1,76 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Installs the standard library sources shipped with the toolchain."""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shutil
+from typing import NamedTuple
+
+from utils import clone_file
+
+
+# Some stdlib crates might include Android.mk or Android.bp files, which must
+# not end up in the platform tree.
+EXCLUDED_FILE_NAMES: set[str] = {"Android.mk", "Android.bp"}
+
+
+class InstallStats(NamedTuple):
+    files:   int
+    bytes:   int
+    methods: Counter[str]
+
+    def report(self) -> str:
+        methods = ", ".join(f"{method}: {count}" for method, count in sorted(self.methods.items()))
+        return f"{self.files} files, {self.bytes / 2**20:.1f} MiB ({methods})"
+
+
+def list_source_files(source_root: Path, rel_dir: str, dest_root: Path) -> list[tuple[Path, Path]]:
+    """Creates the directory structure for rel_dir under dest_root and returns
+    the (source, destination) pairs of the files to install."""
+    pairs: list[tuple[Path, Path]] = []
+    for root, dirs, files in os.walk(source_root / rel_dir, followlinks=True):
+        dest_dir = dest_root / Path(root).relative_to(source_root)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            if name not in EXCLUDED_FILE_NAMES:
+                pairs.append((Path(root) / name, dest_dir / name))
+    return pairs
+
+
+def install_file(pair: tuple[Path, Path]) -> tuple[str, int]:
+    src, dst = pair
+    # The installed sources must not share an inode with the source tree, or
+    # editing one would silently change the other.
+    return (clone_file(src, dst, allow_hardlink=False), src.stat().st_size)
+
+
+def install_sources(source_root: Path, dest_root: Path, rel_dirs: list[str]) -> InstallStats:
+    """Copies rel_dirs from source_root to dest_root, filtering out Android
+    build files.  Directories are scanned and files are cloned concurrently."""
+    shutil.rmtree(dest_root, ignore_errors=True)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        pair_lists = executor.map(
+            list_source_files, [source_root] * len(rel_dirs), rel_dirs, [dest_root] * len(rel_dirs))
+        pairs = [pair for pair_list in pair_lists for pair in pair_list]
+        results = list(executor.map(install_file, pairs))
+
+    return InstallStats(
+        len(results),
+        sum(size for _, size in results),
+        Counter(method for method, _ in results))
@@ -0,0 +1,113 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Strips debug information from the executables and shared objects in a package."""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import subprocess
+import sys
+from typing import NamedTuple, Optional
+
+from utils import prepare_command
+
+
+ELF_MAGIC: bytes = b"\x7fELF"
+MACHO_MAGICS: set[bytes] = {
+    b"\xfe\xed\xfa\xce", b"\xce\xfa\xed\xfe",  # 32-bit
+    b"\xfe\xed\xfa\xcf", b"\xcf\xfa\xed\xfe",  # 64-bit
+    b"\xca\xfe\xba\xbe",                       # Universal
+}
+
+# Anything under rustlib/ includes debug symbols that may be linked into user
+# code and metadata needed at build time.  Stripping .rlibs prevents building
+# Rust binaries.  The stdlib sources are shipped as-is, including any binary
+# test data they contain.
+STRIP_EXCLUDED_DIRS:     set[str] = {"rustlib", "stdlibs"}
+STRIP_EXCLUDED_SUFFIXES: set[str] = {".rlib"}
+
+
+class StripResult(NamedTuple):
+    path:        Path
+    size_before: int
+    size_after:  int
+    error:       Optional[str]
+
+
+def is_strippable(path: Path) -> bool:
+    """Returns True if path is an ELF or Mach-O object."""
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(4)
+    except OSError:
+        return False
+    return magic == ELF_MAGIC or magic in MACHO_MAGICS
+
+
+def find_strippable_files(package_dir: Path) -> list[Path]:
+    binaries: list[Path] = []
+    seen_inodes: set[int] = set()
+
+    for root, dirs, files in os.walk(package_dir):
+        dirs[:] = sorted(d for d in dirs if d not in STRIP_EXCLUDED_DIRS)
+        for name in sorted(files):
+            path = Path(root) / name
+            if path.is_symlink() or path.suffix in STRIP_EXCLUDED_SUFFIXES:
+                continue
+
+            # Hardlinked files only need to be stripped once.
+            inode = path.stat().st_ino
+            if inode in seen_inodes or not is_strippable(path):
+                continue
+
+            seen_inodes.add(inode)
+            binaries.append(path)
+
+    return binaries
+
+
+def strip_file(path: Path) -> StripResult:
+    size_before = path.stat().st_size
+    result = subprocess.run(prepare_command(["strip", "-S", path]),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    error = (result.stderr.strip() or "strip failed") if result.returncode != 0 else None
+    return StripResult(path, size_before, path.stat().st_size, error)
+
+
+def strip_package(package_dir: Path, report_path: Path) -> None:
+    """Strips every binary in package_dir concurrently and writes the size of
+    each file before and after stripping to report_path."""
+    binaries = find_strippable_files(package_dir)
+    print(f"Stripping {len(binaries)} binaries")
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = list(executor.map(strip_file, binaries))
+
+    with open(report_path, "w") as report:
+        report.write("before\tafter\tpath\n")
+        for result in results:
+            report.write(f"{result.size_before}\t{result.size_after}\t"
+                         f"{result.path.relative_to(package_dir)}\n")
+
+    failures = [result for result in results if result.error]
+    if failures:
+        for result in failures:
+            print(f"{result.path}: {result.error}")
+        sys.exit("Failed to strip debugging info from generated binaries")
+
+    total_before = sum(result.size_before for result in results)
+    total_after  = sum(result.size_after for result in results)
+    print("Stripped {:.1f} MiB of debug info ({:.1f} MiB -> {:.1f} MiB)".format(
+        (total_before - total_after) / 2**20, total_before / 2**20, total_after / 2**20))
@@ -0,0 +1,76 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+import shutil
+import tarfile
+from typing import Optional
+
+import pytest
+
+import archive
+
+
+def make_tree(root: Path, names: list[str], mtime: int) -> None:
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"contents of {name}\n")
+        os.utime(path, (mtime, mtime))
+    (root / "bin").mkdir(exist_ok=True)
+    tool = root / "bin" / "tool"
+    tool.write_text("#!/bin/sh\n")
+    tool.chmod(0o700)
+    (root / "bin" / "link").symlink_to("tool")
+
+
+@pytest.mark.parametrize("format_name,compressor", [
+    ("gz", "gzip"), ("pigz", "pigz"), ("zst", "zstd"), ("none", None)])
+def test_archives_are_reproducible(tmp_path: Path, format_name: str, compressor: Optional[str]) -> None:
+    if compressor and not shutil.which(compressor):
+        pytest.skip(f"{compressor} is not installed")
+    archive_format = archive.ARCHIVE_FORMATS[format_name]
+
+    # The same contents, created in a different order with different
+    # timestamps and permissions.
+    names = ["a.txt", "lib/b.rs", "lib/nested/c.rs"]
+    make_tree(tmp_path / "first", names, 1_000_000)
+    make_tree(tmp_path / "second", list(reversed(names)), 2_000_000)
+    (tmp_path / "second" / "a.txt").chmod(0o600)
+
+    first_archive = tmp_path / ("first" + archive_format.extension)
+    second_archive = tmp_path / ("second" + archive_format.extension)
+    archive.create_archive(tmp_path / "first", first_archive, archive_format)
+    archive.create_archive(tmp_path / "second", second_archive, archive_format)
+
+    assert first_archive.read_bytes() == second_archive.read_bytes()
+
+
+def test_archive_members_are_normalized(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1234")
+    make_tree(tmp_path / "tree", ["a.txt", "lib/b.rs"], 1_000_000)
+
+    archive_path = tmp_path / "tree.tar"
+    stats = archive.create_archive(tmp_path / "tree", archive_path, archive.ARCHIVE_FORMATS["none"])
+    assert stats.uncompressed_bytes == stats.compressed_bytes == archive_path.stat().st_size
+
+    with tarfile.open(archive_path) as tar:
+        members = {member.name: member for member in tar.getmembers()}
+
+    assert all(member.mtime == 1234 and member.uid == 0 and member.uname == "" for member in members.values())
+    assert members["a.txt"].mode == archive.ARCHIVE_FILE_MODE
+    assert members["bin/tool"].mode == archive.ARCHIVE_EXEC_MODE
+    assert members["lib"].mode == archive.ARCHIVE_DIR_MODE
+    assert members["bin/link"].issym() and members["bin/link"].linkname == "tool"
@@ -0,0 +1,54 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from benchmark import incomplete_beta, welch_t_test
+
+
+def test_incomplete_beta_known_values() -> None:
+    # For integer parameters I_x(a, b) is a binomial tail sum.
+    assert incomplete_beta(2, 3, 0.4) == pytest.approx(0.5248)
+    assert incomplete_beta(0.5, 0.5, 0.5) == pytest.approx(0.5)
+    assert incomplete_beta(1, 1, 0.3) == pytest.approx(0.3)
+    # Large x takes the symmetric branch of the continued fraction.
+    assert incomplete_beta(3, 2, 0.6) == pytest.approx(1 - incomplete_beta(2, 3, 0.4))
+    assert incomplete_beta(2, 3, 0.0) == 0.0
+    assert incomplete_beta(2, 3, 1.0) == 1.0
+
+
+# The worked examples of Welch's t-test from its Wikipedia article
+def test_welch_t_test_reference_examples() -> None:
+    a1 = [27.5, 21.0, 19.0, 23.6, 17.0, 17.9, 16.9, 20.1, 21.9, 22.6, 23.1, 19.6, 19.0, 21.7, 21.4]
+    a2 = [27.1, 22.0, 20.8, 23.4, 23.4, 23.5, 25.8, 22.0, 24.8, 20.2, 21.9, 22.1, 22.9, 20.5, 24.4]
+    assert welch_t_test(a1, a2) == pytest.approx(0.021, abs=5e-4)
+
+    a3 = [17.2, 20.9, 22.6, 18.1, 21.7, 21.4, 23.5, 24.2, 14.7, 21.8]
+    a4 = [21.5, 22.8, 21.0, 23.0, 21.6, 23.6, 22.5, 20.7, 23.4, 21.8,
+          20.7, 21.7, 21.5, 22.5, 23.6, 21.5, 22.5, 23.5, 21.5, 21.8]
+    assert welch_t_test(a3, a4) == pytest.approx(0.149, abs=5e-4)
+
+
+def test_welch_t_test_is_symmetric() -> None:
+    lhs = [1.0, 1.2, 0.9, 1.1]
+    rhs = [1.5, 1.4, 1.7, 1.6, 1.5]
+    assert welch_t_test(lhs, rhs) == pytest.approx(welch_t_test(rhs, lhs))
+    assert welch_t_test(lhs, rhs) < 0.05
+
+
+def test_welch_t_test_degenerate_samples() -> None:
+    assert welch_t_test([1.0], [2.0, 3.0]) == 1.0
+    assert welch_t_test([2.0, 2.0], [2.0, 2.0, 2.0]) == 1.0
+    assert welch_t_test([2.0, 2.0], [3.0, 3.0]) == 0.0
+    assert welch_t_test([1.0, 2.0, 3.0], [1.0, 2.0, 3.0]) == pytest.approx(1.0)
@@ -0,0 +1,76 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+from pathlib import Path
+import time
+
+import pytest
+
+from download_cache import DownloadCache
+
+
+FILE_SIZE: int = 1024
+
+
+@pytest.fixture
+def cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> DownloadCache:
+    # Every access gets a distinct, increasing time.
+    clock = itertools.count(1_000_000)
+    monkeypatch.setattr(time, "time", lambda: float(next(clock)))
+    # Room for three files
+    return DownloadCache(tmp_path / "downloads", max_size_gib=3.5 * FILE_SIZE / 2**30)
+
+
+def add(cache: DownloadCache, name: str, size: int = FILE_SIZE) -> Path:
+    cache.partial_path(name).write_bytes(name.encode().ljust(size, b"\0"))
+    return cache.add(name)
+
+
+def test_least_recently_used_files_are_evicted(cache: DownloadCache) -> None:
+    for name in ["a", "b", "c"]:
+        add(cache, name)
+    assert cache.lookup("a") is not None
+
+    add(cache, "d")
+    assert sorted(cache.entries) == ["a", "c", "d"]
+    assert not cache.path("b").exists()
+
+    add(cache, "e")
+    assert sorted(cache.entries) == ["a", "d", "e"]
+
+
+def test_new_file_larger_than_the_limit_is_kept(cache: DownloadCache) -> None:
+    add(cache, "a")
+    add(cache, "big", size=5 * FILE_SIZE)
+    assert sorted(cache.entries) == ["big"]
+    assert cache.lookup("big") is not None
+
+
+def test_index_persists_access_order(cache: DownloadCache) -> None:
+    for name in ["a", "b", "c"]:
+        add(cache, name)
+    cache.lookup("a")
+
+    reopened = DownloadCache(cache.root, cache.max_size_gib)
+    add(reopened, "d")
+    assert sorted(reopened.entries) == ["a", "c", "d"]
+
+
+def test_corrupt_file_is_discarded(cache: DownloadCache) -> None:
+    path = add(cache, "a")
+    path.write_bytes(b"x" * FILE_SIZE)
+    assert cache.lookup("a") is None
+    assert "a" not in cache.entries
+    assert not path.exists()
@@ -0,0 +1,113 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+from pathlib import Path
+import subprocess
+import tarfile
+
+import pytest
+
+from utils import GIT_REFERENCE_BRANCH, GitRepo
+
+
+Member = tuple[tarfile.TarInfo, bytes]
+
+
+def regular(name: str, contents: str, mode: int = 0o644) -> Member:
+    info = tarfile.TarInfo(name)
+    info.size = len(contents.encode())
+    info.mode = mode
+    return (info, contents.encode())
+
+
+def link(name: str, target: str, link_type: bytes) -> Member:
+    info = tarfile.TarInfo(name)
+    info.type = link_type
+    info.linkname = target
+    return (info, b"")
+
+
+def make_tar(members: list[Member]) -> io.BytesIO:
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        for info, data in members:
+            tar.addfile(info, io.BytesIO(data) if info.isreg() else None)
+    stream.seek(0)
+    return stream
+
+
+def git(repo: Path, *args: str) -> str:
+    return subprocess.run(["git", *args], cwd=repo, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+
+@pytest.fixture
+def repo(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> GitRepo:
+    for role in ["AUTHOR", "COMMITTER"]:
+        monkeypatch.setenv(f"GIT_{role}_NAME", "Test")
+        monkeypatch.setenv(f"GIT_{role}_EMAIL", "test@example.com")
+
+    path = tmp_path / "repo"
+    subprocess.run(["git", "init", "-q", "-b", GIT_REFERENCE_BRANCH, path], check=True)
+    (path / "stale.txt").write_text("removed by the import\n")
+    git(path, "add", "stale.txt")
+    git(path, "commit", "-q", "-m", "Initial commit")
+    git(path, "checkout", "-q", "-b", "import")
+    return GitRepo(path)
+
+
+def test_import_round_trip(repo: GitRepo) -> None:
+    tar = make_tar([
+        regular("rustc-src/README.md", "readme\n"),
+        regular("rustc-src/x.py", "#!/usr/bin/env python3\n", 0o755),
+        regular("rustc-src/src/lib.rs", "fn main() {}\n"),
+        link("rustc-src/src/copy.rs", "rustc-src/src/lib.rs", tarfile.LNKTYPE),
+        link("rustc-src/link", "src/lib.rs", tarfile.SYMTYPE),
+    ])
+    assert repo.import_tar(tar, "Importing rustc", strip_components=1)
+
+    files = repo.ls_tree("HEAD")
+    assert sorted(files) == [b"README.md", b"link", b"src/copy.rs", b"src/lib.rs", b"x.py"]
+    assert files[b"x.py"][0] == b"100755"
+    assert files[b"README.md"][0] == b"100644"
+    assert files[b"link"][0] == b"120000"
+    assert files[b"src/copy.rs"] == files[b"src/lib.rs"]
+
+    assert (repo.path / "src" / "lib.rs").read_text() == "fn main() {}\n"
+    assert (repo.path / "link").is_symlink()
+    assert not (repo.path / "stale.txt").exists()
+    assert git(repo.path, "log", "-1", "--format=%s").strip() == "Importing rustc"
+    assert git(repo.path, "status", "--porcelain") == ""
+
+
+def test_reimport_amends_and_detects_no_change(repo: GitRepo) -> None:
+    members = [regular("src/a.rs", "a\n"), regular("src/b.rs", "b\n")]
+    assert repo.import_tar(make_tar(members), "Importing rustc")
+    first_commit = repo.branch_target()
+
+    assert not repo.import_tar(make_tar(members), "Ignored")
+    assert repo.branch_target() == first_commit
+
+    assert repo.import_tar(make_tar(members[:1]), "Ignored")
+    assert sorted(repo.ls_tree("HEAD")) == [b"src/a.rs"]
+    # Later imports amend the first rather than stacking commits.
+    assert git(repo.path, "rev-list", "--count", "HEAD").strip() == "2"
+    assert git(repo.path, "log", "-1", "--format=%s").strip() == "Importing rustc"
+
+
+def test_hard_link_to_missing_member_fails(repo: GitRepo) -> None:
+    head = repo.branch_target()
+    with pytest.raises(SystemExit):
+        repo.import_tar(make_tar([link("src/copy.rs", "src/missing.rs", tarfile.LNKTYPE)]), "Importing rustc")
+    assert repo.branch_target() == head
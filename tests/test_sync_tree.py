@@ -0,0 +1,104 @@
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+import shutil
+
+import pytest
+
+from source_manager import create_link_farm, sync_tree
+
+
+def write_files(root: Path, files: dict[str, str]) -> None:
+    for name, contents in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(contents)
+
+
+def read_tree(root: Path) -> dict[str, str]:
+    return {
+        path.relative_to(root).as_posix(): (os.readlink(path) if path.is_symlink() else path.read_text())
+        for path in sorted(root.rglob("*")) if path.is_symlink() or path.is_file()}
+
+
+@pytest.fixture
+def trees(tmp_path: Path) -> tuple[Path, Path, Path]:
+    """Returns (input_dir, tmp_dir, output_dir) with output_dir holding the
+    result of a previous sync."""
+    input_dir = tmp_path / "input"
+    write_files(input_dir, {"keep.rs": "keep\n", "changed.rs": "old\n", "patched.rs": "original\n"})
+    tmp_dir = tmp_path / "tmp"
+    shutil.copytree(input_dir, tmp_dir)
+
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    sync_tree(tmp_dir, output_dir, input_dir, set())
+    return input_dir, tmp_dir, output_dir
+
+
+def test_sync_removes_stale_files(trees: tuple[Path, Path, Path]) -> None:
+    input_dir, tmp_dir, output_dir = trees
+    write_files(output_dir, {"stale.rs": "stale\n", "stale_dir/nested/file.rs": "stale\n"})
+    (output_dir / "stale_link").symlink_to("keep.rs")
+
+    sync_tree(tmp_dir, output_dir, input_dir, set())
+
+    assert read_tree(output_dir) == read_tree(tmp_dir)
+    assert not (output_dir / "stale_dir").exists()
+
+
+def test_sync_replaces_entries_that_changed_type(trees: tuple[Path, Path, Path]) -> None:
+    input_dir, tmp_dir, output_dir = trees
+    (tmp_dir / "keep.rs").unlink()
+    write_files(tmp_dir, {"keep.rs/inner.rs": "now a directory\n"})
+    (tmp_dir / "changed.rs").unlink()
+    (tmp_dir / "changed.rs").symlink_to("patched.rs")
+
+    sync_tree(tmp_dir, output_dir, input_dir, {"keep.rs/inner.rs", "changed.rs"})
+
+    assert read_tree(output_dir) == read_tree(tmp_dir)
+
+
+def test_sync_only_touches_changed_files(trees: tuple[Path, Path, Path]) -> None:
+    input_dir, tmp_dir, output_dir = trees
+    old_time = 1_000_000_000
+    for path in output_dir.iterdir():
+        os.utime(path, (old_time, old_time))
+
+    # Unpatched files are known from input_dir; patched ones are read.
+    write_files(input_dir, {"changed.rs": "new\n"})
+    write_files(tmp_dir, {"changed.rs": "new\n", "patched.rs": "patched\n", "added.rs": "added\n"})
+
+    sync_tree(tmp_dir, output_dir, input_dir, {"patched.rs", "added.rs"})
+
+    assert read_tree(output_dir) == read_tree(tmp_dir)
+    assert (output_dir / "keep.rs").stat().st_mtime == old_time
+    assert (output_dir / "changed.rs").stat().st_mtime != old_time
+    assert not list(output_dir.glob("*.sync-tmp"))
+
+
+def test_link_farm_copies_only_listed_files(tmp_path: Path) -> None:
+    input_dir = tmp_path / "input"
+    write_files(input_dir, {"linked.rs": "linked\n", "src/patched.rs": "patched\n"})
+    (input_dir / "link").symlink_to("linked.rs")
+
+    output_dir = tmp_path / "farm"
+    create_link_farm(input_dir, output_dir, {"src/patched.rs", "missing.rs"})
+
+    assert read_tree(output_dir) == read_tree(input_dir)
+    assert os.path.samefile(output_dir / "linked.rs", input_dir / "linked.rs")
+    assert not os.path.samefile(output_dir / "src/patched.rs", input_dir / "src/patched.rs")
+    assert (output_dir / "link").is_symlink()
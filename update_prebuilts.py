@@ -16,24 +16,35 @@
 
 """Fetch prebuilt archives and prepare a prebuilt commit"""
 
+from abc import ABC, abstractmethod
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import inspect
 from functools import cache
 from pathlib import Path
 import re
 import shutil
+import subprocess
 import sys
-from typing import Optional, Union
+import tempfile
+import threading
+import time
+from typing import Iterator, NamedTuple, Optional, Union
 
+import archive
 import build_platform
+import download_cache
+import size_report
 from paths import (
     DOWNLOADS_PATH,
     FETCH_ARTIFACT_PATH,
+    PARTIAL_PACKAGE_MARKER,
     RUST_PREBUILT_PATH
 )
 from utils import (
     GitRepo,
     replace_file_contents,
+    prepare_command,
     run_and_exit_on_failure,
     run_quiet,
     run_quiet_and_exit_on_failure,
@@ -46,19 +57,26 @@ ANDROID_BP: str = "Android.bp"
 
 BRANCH_NAME_TEMPLATE: str = "rust-update-prebuilts-%s"
 
-BUILD_SERVER_ARCHIVE_PATTERN: str = "rust-%s.tar.gz"
+BUILD_SERVER_ARCHIVE_PATTERN: str = "rust-%s%s"
 BUILD_SERVER_TARGET_DEFAULT:  str = "linux"
 BUILD_SERVER_TARGET_MAP: dict[str, str] = {
   "darwin-x86": "darwin_mac",
   "linux-x86":  "linux"}
 
-HOST_ARCHIVE_PATTERN: str = "rust-%s-%s.tar.gz"
+HOST_ARCHIVE_PATTERN: str = "rust-%s-%s%s"
 HOST_TARGET_DEFAULT:  str = "linux-x86"
 
 RLIB_NAME_PATTERN: re.Pattern[str] = re.compile("libstd-([a-zA-z\d]+)\.rlib")
 
 RUST_PREBUILT_REPO: GitRepo = GitRepo(RUST_PREBUILT_PATH)
 
+DEFAULT_FETCH_JOBS: int = 4
+
+# Seconds between progress reports while artifacts are being fetched
+FETCH_PROGRESS_INTERVAL: float = 5.0
+
+STREAM_CHUNK_SIZE: int = 1024 * 1024
+
 #
 # String operations
 #
@@ -102,25 +120,188 @@ def ensure_gcert_valid() -> None:
         run_and_exit_on_failure("gcert", "Failed to obtain authentication credentials")
 
 
-def fetch_build_server_artifact(target: str, build_id: int, build_server_name: str,
-    host_name: Optional[str] = None) -> Path:
+class FetchRequest(NamedTuple):
+    target:            str
+    build_id:          int
+    build_server_name: str
+    host_name:         str
 
-    host_name = host_name or build_server_name
-    DOWNLOADS_PATH.mkdir(exist_ok=True)
-    dest: Path = DOWNLOADS_PATH / host_name
 
-    if dest.exists():
-        print(f"Artifact {build_server_name} has already been downloaded as {host_name}")
+class FetchResult(NamedTuple):
+    request: FetchRequest
+    size:    int
+    seconds: float
+    error:   Optional[str]
 
-    else:
+
+class FetchError(Exception):
+    pass
+
+
+class ArtifactFetcher(ABC):
+    """Copies a build server artifact to a local path."""
+
+    def prepare(self) -> None:
+        """Called once before any artifacts are fetched."""
+        pass
+
+    @abstractmethod
+    def fetch(self, request: FetchRequest, dest: Path) -> Optional[str]:
+        """Fetches an artifact to dest and returns an error message on
+        failure."""
+        pass
+
+    @abstractmethod
+    def stream(self, request: FetchRequest) -> Iterator[bytes]:
+        """Yields the contents of an artifact as it is fetched.  Raises
+        FetchError once the stream ends if the fetch failed."""
+        pass
+
+
+class FetchArtifactFetcher(ArtifactFetcher):
+    """Fetches artifacts from the build server with fetch_artifact."""
+
+    def prepare(self) -> None:
         ensure_gcert_valid()
 
-        print(f"Downloading build server artifact {build_server_name} for target {target}")
-        run_and_exit_on_failure(
-            f"{FETCH_ARTIFACT_PATH} --target={target} --bid={build_id} {build_server_name} {dest}",
-            f"Failed to fetch build server artifact {build_server_name} for target {target}")
+    def fetch(self, request: FetchRequest, dest: Path) -> Optional[str]:
+        result = subprocess.run(
+            [FETCH_ARTIFACT_PATH, f"--target={request.target}", f"--bid={request.build_id}",
+             request.build_server_name, dest],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        return (result.stderr.strip() or "fetch_artifact failed") if result.returncode != 0 else None
+
+    def stream(self, request: FetchRequest) -> Iterator[bytes]:
+        # stderr goes to a file rather than a pipe, which fetch_artifact could
+        # fill and block on while stdout is being read.
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(
+                [FETCH_ARTIFACT_PATH, f"--target={request.target}", f"--bid={request.build_id}",
+                 request.build_server_name, "/dev/stdout"],
+                stdout=subprocess.PIPE, stderr=stderr_file)
+            assert process.stdout is not None
+            try:
+                while chunk := process.stdout.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                process.stdout.close()
+                if process.wait() != 0:
+                    stderr_file.seek(0)
+                    stderr = stderr_file.read().decode(errors="replace").strip()
+                    raise FetchError(stderr or "fetch_artifact failed")
+
+
+class LocalDirectoryFetcher(ArtifactFetcher):
+    """Fetches artifacts from a directory laid out as
+    <root>/<build id>/<build server target>/<artifact name>."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    def fetch(self, request: FetchRequest, dest: Path) -> Optional[str]:
+        src = self.root / str(request.build_id) / request.target / request.build_server_name
+        if not src.exists():
+            return f"{src} does not exist"
+        shutil.copyfile(src, dest)
+        return None
+
+    def stream(self, request: FetchRequest) -> Iterator[bytes]:
+        src = self.root / str(request.build_id) / request.target / request.build_server_name
+        if not src.exists():
+            raise FetchError(f"{src} does not exist")
+        with open(src, "rb") as f:
+            while chunk := f.read(STREAM_CHUNK_SIZE):
+                yield chunk
+
+
+def fetch_one(fetcher: ArtifactFetcher, dl_cache: download_cache.DownloadCache,
+    request: FetchRequest) -> FetchResult:
+
+    start = time.monotonic()
+    error = fetcher.fetch(request, dl_cache.partial_path(request.host_name))
+    seconds = time.monotonic() - start
+
+    if error:
+        dl_cache.discard_partial(request.host_name)
+        return FetchResult(request, 0, seconds, error)
+
+    path = dl_cache.add(request.host_name, request.build_id)
+    return FetchResult(request, path.stat().st_size, seconds, None)
+
+
+def partial_size(dl_cache: download_cache.DownloadCache, request: FetchRequest) -> int:
+    partial_path = dl_cache.partial_path(request.host_name)
+    try:
+        return partial_path.stat().st_size
+    except FileNotFoundError:
+        # Finished downloads have been moved into the cache.
+        path = dl_cache.path(request.host_name)
+        return path.stat().st_size if path.exists() else 0
+
+
+def report_fetch_progress(dl_cache: download_cache.DownloadCache, requests: list[FetchRequest],
+    done: threading.Event) -> None:
+
+    start = time.monotonic()
+    while not done.wait(FETCH_PROGRESS_INTERVAL):
+        sizes = {request.host_name: partial_size(dl_cache, request) for request in requests}
+        total = sum(sizes.values())
+        rate = total / 2**20 / (time.monotonic() - start)
+        progress = ", ".join(f"{name} {size / 2**20:.0f} MiB" for name, size in sizes.items())
+        print(f"  {progress} ({rate:.1f} MiB/s)")
+
+
+def fetch_build_server_artifacts(fetcher: ArtifactFetcher, dl_cache: download_cache.DownloadCache,
+    requests: list[FetchRequest], jobs: int) -> dict[str, Path]:
+    """Fetches artifacts concurrently and returns their paths keyed by host
+    name.  Artifacts that were downloaded before are reused once verified.
+    Every fetch is attempted before exiting if any of them failed."""
+    paths: dict[str, Path] = {}
+    pending: list[FetchRequest] = []
+    for request in requests:
+        cached_path = dl_cache.lookup(request.host_name)
+        if cached_path:
+            print(f"Artifact {request.build_server_name} has already been downloaded as {request.host_name}")
+            paths[request.host_name] = cached_path
+        else:
+            pending.append(request)
+
+    if pending:
+        fetcher.prepare()
+        for request in pending:
+            print(f"Downloading build server artifact {request.build_server_name} for target {request.target}")
+
+        done = threading.Event()
+        progress = threading.Thread(target=report_fetch_progress, args=(dl_cache, pending, done), daemon=True)
+        progress.start()
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(lambda request: fetch_one(fetcher, dl_cache, request), pending))
+        seconds = time.monotonic() - start
+
+        done.set()
+        progress.join()
 
-    return dest
+        for result in results:
+            if not result.error:
+                print("Fetched {} ({:.1f} MiB in {:.1f}s)".format(
+                    result.request.host_name, result.size / 2**20, result.seconds))
+
+        total = sum(result.size for result in results)
+        print("Fetched {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)".format(
+            total / 2**20, seconds, total / 2**20 / max(seconds, 0.001)))
+
+        failures = [result for result in results if result.error]
+        if failures:
+            for result in failures:
+                print(f"Failed to fetch build server artifact {result.request.build_server_name} "
+                      f"for target {result.request.target}: {result.error}")
+            sys.exit(f"Failed to fetch {len(failures)} of {len(pending)} artifacts")
+
+        paths.update({result.request.host_name: dl_cache.path(result.request.host_name) for result in results})
+
+    return paths
 
 #
 # Program logic
@@ -145,11 +326,37 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "-o", "--overwrite", dest="overwrite", action="store_true",
         help="Overwrite the target branch if it exists")
+    parser.add_argument(
+        "--archive-format", dest="archive_format", default=archive.DEFAULT_ARCHIVE_FORMAT,
+        choices=list(archive.ARCHIVE_FORMATS),
+        help="Format of the archives produced by the build server")
+    parser.add_argument(
+        "-j", "--fetch-jobs", dest="fetch_jobs", type=int, default=DEFAULT_FETCH_JOBS,
+        help="Number of artifacts to fetch concurrently")
+    parser.add_argument(
+        "--fetch-from", dest="fetch_from", metavar="DIR", type=Path,
+        help="Fetch artifacts from a local directory laid out as \
+        DIR/<build id>/<build server target>/<artifact> instead of the build server")
+    parser.add_argument(
+        "--stream", dest="stream", action="store_true",
+        help="Extract build server archives while they are downloaded, for all \
+        host targets in parallel")
+    parser.add_argument(
+        "--download-cache-size", dest="download_cache_size", type=float,
+        default=download_cache.DEFAULT_CACHE_SIZE_GIB,
+        help="Size limit of the download cache in GiB")
+    parser.add_argument(
+        "--size-threshold", dest="size_threshold", type=float,
+        default=size_report.DEFAULT_SIZE_THRESHOLD,
+        help="Flag files and categories that grew by more than this percentage \
+        relative to the previous version")
 
     return parser.parse_args()
 
 
-def prepare_prebuilt_artifact(ident: Union[int, Path]) -> tuple[dict[str, Path], Optional[Path]]:
+def prepare_prebuilt_artifact(ident: Union[int, Path], archive_format: archive.ArchiveFormat,
+    fetcher: ArtifactFetcher, dl_cache: download_cache.DownloadCache,
+    fetch_jobs: int) -> tuple[dict[str, Path], Optional[Path]]:
     """
     Returns a dictionary that maps target names to prebuilt artifact paths.  If
     the artifacts were downloaded from a build server the manifest for the
@@ -162,21 +369,53 @@ def prepare_prebuilt_artifact(ident: Union[int, Path]) -> tuple[dict[str, Path],
         else:
             sys.exit(f"Provided prebuilt archive does not exist: {ident.as_posix()}")
     else:
-        artifact_path_map: dict[str, Path] = {}
-
-        manifest_name:       str = f"manifest_{ident}.xml"
-        bs_archive_name:     str = BUILD_SERVER_ARCHIVE_PATTERN % ident
-        host_manifest_path: Path = fetch_build_server_artifact(BUILD_SERVER_TARGET_DEFAULT, ident, manifest_name)
+        manifest_name:   str = f"manifest_{ident}.xml"
+        bs_archive_name: str = BUILD_SERVER_ARCHIVE_PATTERN % (ident, archive_format.extension)
 
+        requests = [FetchRequest(BUILD_SERVER_TARGET_DEFAULT, ident, manifest_name, manifest_name)]
         for target, bs_target in BUILD_SERVER_TARGET_MAP.items():
-            artifact_path_map[target] = fetch_build_server_artifact(
-                bs_target, ident, bs_archive_name, HOST_ARCHIVE_PATTERN % (ident, target))
+            requests.append(FetchRequest(bs_target, ident, bs_archive_name,
+                HOST_ARCHIVE_PATTERN % (ident, target, archive_format.extension)))
+
+        fetched = fetch_build_server_artifacts(fetcher, dl_cache, requests, fetch_jobs)
+        host_manifest_path = fetched[manifest_name]
+        artifact_path_map: dict[str, Path] = {
+            target: fetched[HOST_ARCHIVE_PATTERN % (ident, target, archive_format.extension)]
+            for target in BUILD_SERVER_TARGET_MAP}
 
         # Print a newline to make the fetch/cache usage visually distinct
         print()
         return (artifact_path_map, host_manifest_path)
 
 
+def prepare_version_directory(target: str, version: str, overwrite: bool) -> Path:
+    target_and_version_path: Path = RUST_PREBUILT_PATH / target / version
+    if target_and_version_path.exists():
+        if overwrite:
+            # Empty out the existing directory so we can overwrite the contents
+            RUST_PREBUILT_REPO.rm(target_and_version_path / '*')
+        else:
+            print(f"Directory {target_and_version_path} already exists and the 'overwrite' option was not set")
+            exit(-1)
+    else:
+        target_and_version_path.mkdir()
+
+    return target_and_version_path
+
+
+def finish_version_directory(target: str, target_and_version_path: Path,
+    manifest_path: Optional[Path]) -> None:
+
+    if (target_and_version_path / PARTIAL_PACKAGE_MARKER).exists():
+        sys.exit(f"Prebuilt artifact for {target} was built for a subset of the targets "
+                 f"(see {PARTIAL_PACKAGE_MARKER}) and can't be used as a prebuilt")
+
+    if manifest_path and target == HOST_TARGET_DEFAULT:
+        shutil.copy(manifest_path, target_and_version_path)
+
+    RUST_PREBUILT_REPO.add(target_and_version_path)
+
+
 def unpack_prebuilt_artifacts(artifact_path_map: dict[str, Path], manifest_path: Optional[Path],
     version: str, overwrite: bool) -> None:
 
@@ -187,27 +426,112 @@ def unpack_prebuilt_artifacts(artifact_path_map: dict[str, Path], manifest_path:
     """
 
     for target, artifact_path in artifact_path_map.items():
-        target_and_version_path: Path = RUST_PREBUILT_PATH / target / version
-        if target_and_version_path.exists():
-            if overwrite:
-                # Empty out the existing directory so we can overwrite the contents
-                RUST_PREBUILT_REPO.rm(target_and_version_path / '*')
-            else:
-                print(f"Directory {target_and_version_path} already exists and the 'overwrite' option was not set")
-                exit(-1)
-        else:
-            target_and_version_path.mkdir()
+        target_and_version_path = prepare_version_directory(target, version, overwrite)
 
         print(f"Extracting archive {artifact_path.name} for {target}/{version}")
         run_quiet_and_exit_on_failure(
-            f"tar -xzf {artifact_path}",
+            archive.extract_command(artifact_path),
             f"Failed to extract prebuilt artifact for {target}/{version}",
             cwd=target_and_version_path)
 
-        if manifest_path and target == HOST_TARGET_DEFAULT:
-            shutil.copy(manifest_path, target_and_version_path)
-
-        RUST_PREBUILT_REPO.add(target_and_version_path)
+        finish_version_directory(target, target_and_version_path, manifest_path)
+
+
+def stream_artifact(fetcher: ArtifactFetcher, dl_cache: download_cache.DownloadCache,
+    request: FetchRequest, archive_format: archive.ArchiveFormat, dest_dir: Path) -> FetchResult:
+    """Extracts an artifact into dest_dir while it is being fetched, and
+    saves a copy to the downloads directory once it has been fetched
+    completely.  An artifact that was downloaded before is extracted from the
+    downloads directory instead."""
+    start = time.monotonic()
+
+    cached_path = dl_cache.lookup(request.host_name)
+    if cached_path:
+        print(f"Extracting previously downloaded {request.host_name}")
+        result = subprocess.run(prepare_command(archive.extract_command(cached_path)),
+            cwd=dest_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        return FetchResult(request, cached_path.stat().st_size, time.monotonic() - start,
+            (result.stderr.strip() or "tar failed") if result.returncode != 0 else None)
+
+    print(f"Streaming build server artifact {request.build_server_name} for target {request.target}")
+    partial_path = dl_cache.partial_path(request.host_name)
+    size = 0
+    error: Optional[str] = None
+    # tar's stderr goes to a file rather than a pipe, which tar could fill and
+    # block on while its stdin is being written.
+    with tempfile.TemporaryFile() as tar_stderr:
+        tar = subprocess.Popen(prepare_command(archive.stream_extract_command(archive_format)),
+            cwd=dest_dir, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=tar_stderr)
+        assert tar.stdin is not None
+
+        try:
+            with open(partial_path, "wb") as cache_file:
+                for chunk in fetcher.stream(request):
+                    cache_file.write(chunk)
+                    tar.stdin.write(chunk)
+                    size += len(chunk)
+        except FetchError as e:
+            error = str(e)
+        except BrokenPipeError:
+            # Even if tar succeeds, the rest of the artifact was never checked.
+            error = "tar exited before the artifact was fetched completely"
+        finally:
+            try:
+                tar.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        if tar.wait() != 0:
+            tar_stderr.seek(0)
+            tar_error = tar_stderr.read().decode(errors="replace").strip() or "tar failed"
+            error = f"{error}: {tar_error}" if error else tar_error
+
+    if error:
+        dl_cache.discard_partial(request.host_name)
+    else:
+        dl_cache.add(request.host_name, request.build_id)
+    return FetchResult(request, size, time.monotonic() - start, error)
+
+
+def stream_prebuilt_artifacts(ident: int, archive_format: archive.ArchiveFormat,
+    fetcher: ArtifactFetcher, dl_cache: download_cache.DownloadCache, version: str,
+    overwrite: bool) -> list[str]:
+    """Fetches and extracts the archive for every host target concurrently.
+    Returns the targets that were extracted."""
+    manifest_name = f"manifest_{ident}.xml"
+    manifest_path = fetch_build_server_artifacts(
+        fetcher, dl_cache, [FetchRequest(BUILD_SERVER_TARGET_DEFAULT, ident, manifest_name, manifest_name)], 1
+    )[manifest_name]
+
+    bs_archive_name = BUILD_SERVER_ARCHIVE_PATTERN % (ident, archive_format.extension)
+    jobs: list[tuple[str, FetchRequest, Path]] = []
+    for target, bs_target in BUILD_SERVER_TARGET_MAP.items():
+        request = FetchRequest(bs_target, ident, bs_archive_name,
+            HOST_ARCHIVE_PATTERN % (ident, target, archive_format.extension))
+        jobs.append((target, request, prepare_version_directory(target, version, overwrite)))
+
+    fetcher.prepare()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        results = list(executor.map(
+            lambda job: stream_artifact(fetcher, dl_cache, job[1], archive_format, job[2]), jobs))
+    seconds = time.monotonic() - start
+
+    total = sum(result.size for result in results)
+    print("Fetched and extracted {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)".format(
+        total / 2**20, seconds, total / 2**20 / max(seconds, 0.001)))
+
+    failures = [result for result in results if result.error]
+    if failures:
+        for result in failures:
+            print(f"Failed to stream build server artifact {result.request.build_server_name} "
+                  f"for target {result.request.target}: {result.error}")
+        sys.exit(f"Failed to fetch {len(failures)} of {len(jobs)} artifacts")
+
+    for target, _, dest_dir in jobs:
+        finish_version_directory(target, dest_dir, manifest_path)
+
+    return [target for target, _, _ in jobs]
 
 
 def update_root_build_file(version: str) -> None:
@@ -231,9 +555,27 @@ def main() -> None:
     branch_name: str = args.branch or make_branch_name(args.version, isinstance(args.prebuilt_ident, Path))
 
     print()
-    artifact_path_map, manifest_path = prepare_prebuilt_artifact(args.prebuilt_ident)
-    RUST_PREBUILT_REPO.create_or_checkout(branch_name, args.overwrite)
-    unpack_prebuilt_artifacts(artifact_path_map, manifest_path, args.version, args.overwrite)
+    fetcher = LocalDirectoryFetcher(args.fetch_from) if args.fetch_from else FetchArtifactFetcher()
+    archive_format = archive.ARCHIVE_FORMATS[args.archive_format]
+    dl_cache = download_cache.DownloadCache(DOWNLOADS_PATH, args.download_cache_size)
+    if args.stream and not isinstance(args.prebuilt_ident, Path):
+        RUST_PREBUILT_REPO.create_or_checkout(branch_name, args.overwrite)
+        targets = stream_prebuilt_artifacts(
+            args.prebuilt_ident, archive_format, fetcher, dl_cache, args.version, args.overwrite)
+    else:
+        artifact_path_map, manifest_path = prepare_prebuilt_artifact(
+            args.prebuilt_ident, archive_format, fetcher, dl_cache, args.fetch_jobs)
+        RUST_PREBUILT_REPO.create_or_checkout(branch_name, args.overwrite)
+        unpack_prebuilt_artifacts(artifact_path_map, manifest_path, args.version, args.overwrite)
+        targets = list(artifact_path_map)
+
+    print()
+    flagged = [target for target in targets
+               if size_report.report_prebuilt(target, args.version, args.size_threshold)]
+    if flagged:
+        print(f"WARNING: size growth above {args.size_threshold:g}% for {', '.join(flagged)}")
+    print()
+
     update_build_files(args.version, isinstance(args.prebuilt_ident, Path))
     commit_message = make_commit_message(args.version, args.prebuilt_ident, args.issue)
     RUST_PREBUILT_REPO.amend_or_commit(commit_message)
@@ -16,17 +16,29 @@
 
 
 import argparse
+import fcntl
+import hashlib
+import os
 from pathlib import Path
 import re
 import shlex
 import shutil
 import sys
 import subprocess
-from typing import Any, TextIO, Union
+import tarfile
+from typing import Any, IO, Optional, TextIO, Union
 
 
 GIT_REFERENCE_BRANCH = "aosp/master"
 
+# Scratch ref that git fast-import writes imported commits to
+GIT_IMPORT_REF = "refs/fast-import/import"
+
+HASH_CHUNK_SIZE: int = 1024 * 1024
+
+# ioctl request used to clone a file's extents on Linux (see ioctl_ficlone(2))
+FICLONE: int = 0x40049409
+
 SUBPROCESS_RUN_QUIET_DEFAULTS: dict[str, object] = {
     'stdout': subprocess.DEVNULL,
     'stderr': subprocess.DEVNULL,
@@ -44,6 +56,11 @@ def version_string_type(arg_string: str) -> str:
     else:
         raise argparse.ArgumentTypeError("Version string is not properly formatted")
 
+
+def version_key(version: str) -> list[int]:
+    """Returns a key that sorts version strings numerically."""
+    return [int(part) if part.isdigit() else 0 for part in version.split(".")]
+
 #
 # Subprocess helpers
 #
@@ -74,6 +91,15 @@ def run_and_exit_on_failure(command: Union[str, list[Any]], error_message: str,
     return result
 
 
+def run_for_bytes_and_exit_on_failure(command: Union[str, list[Any]], error_message: str, **kwargs: Any) -> bytes:
+    """Runs a failable command and returns its standard output as bytes"""
+    result = subprocess.run(prepare_command(command), stdout=subprocess.PIPE, **kwargs)
+    if result.returncode != 0:
+        sys.exit(error_message)
+
+    return bytes(result.stdout)
+
+
 def run_quiet_and_exit_on_failure(command: Union[str, list[Any]], error_message: str, *args: Any, **kwargs: Any) -> int:
     """Runs a failable command with stdout and stderr directed to /dev/null"""
     return run_and_exit_on_failure(command, error_message, *args, **(kwargs | SUBPROCESS_RUN_QUIET_DEFAULTS)).returncode
@@ -127,7 +153,8 @@ class GitRepo:
                 (branch_name, self.path),
             cwd=self.path,
             stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL).stdout.rstrip()
+            stderr=subprocess.DEVNULL,
+            text=True).stdout.rstrip()
 
     def checkout(self, branch_name: str) -> None:
         run_quiet_and_exit_on_failure(
@@ -157,6 +184,47 @@ class GitRepo:
             repo_start(self.path, branch_name)
             return True
 
+    def tree_hash(self, subdir: str = "") -> str:
+        """Returns a digest identifying the contents of the working tree, or
+        of the subdirectory subdir of it.
+
+        For a clean checkout this is the hash of the HEAD tree object.  Local
+        modifications and untracked files are folded into the digest so that
+        uncommitted changes still produce a distinct value.
+        """
+        pathspec = ["--", subdir] if subdir else []
+        head_tree = run_and_exit_on_failure(
+            ["git", "rev-parse", f"HEAD:{subdir}" if subdir else "HEAD^{tree}"],
+            "Failed to get HEAD tree for Git repo %s" % self.path,
+            cwd=self.path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True).stdout.strip()
+
+        status = run_for_bytes_and_exit_on_failure(
+            ["git", "status", "--porcelain", "-z", "--untracked-files=all"] + pathspec,
+            "Failed to get status of Git repo %s" % self.path,
+            cwd=self.path,
+            stderr=subprocess.DEVNULL)
+
+        if not status:
+            return head_tree
+
+        digest = hashlib.sha256(head_tree.encode())
+        digest.update(run_for_bytes_and_exit_on_failure(
+            ["git", "diff", "HEAD", "--binary"] + pathspec,
+            "Failed to compute diff for Git repo %s" % self.path,
+            cwd=self.path,
+            stderr=subprocess.DEVNULL))
+
+        for entry in status.split(b"\0"):
+            if entry.startswith(b"?? "):
+                untracked = self.path / os.fsdecode(entry[3:])
+                digest.update(entry)
+                digest.update(hash_file(untracked).encode())
+
+        return digest.hexdigest()
+
     def diff(self) -> bool:
         retcode = run_quiet("git diff --cached --quiet", cwd=self.path)
 
@@ -168,6 +236,131 @@ class GitRepo:
             "Failed to compute diff for Git repo %s" % self.path
             exit(-1)
 
+    def output(self, command: Union[str, list[Any]], error_message: str) -> str:
+        return run_and_exit_on_failure(command, error_message, cwd=self.path,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.rstrip()
+
+    def ls_tree(self, commit: str) -> dict[bytes, tuple[bytes, bytes]]:
+        """Returns the mode and object name of every file in a commit, keyed by
+        path."""
+        listing = run_for_bytes_and_exit_on_failure(
+            ["git", "ls-tree", "-r", "-z", "--full-tree", commit],
+            "Failed to list the files of commit %s in Git repo %s" % (commit, self.path),
+            cwd=self.path,
+            stderr=subprocess.DEVNULL)
+
+        files: dict[bytes, tuple[bytes, bytes]] = {}
+        for entry in listing.split(b"\0"):
+            if entry:
+                info, path = entry.split(b"\t", 1)
+                mode, _, name = info.split()
+                files[path] = (mode, name)
+        return files
+
+    def import_tar(self, tar_stream: IO[bytes], commit_message: str, strip_components: int = 0) -> bool:
+        """Replaces the files of the current branch with the contents of a tar
+        stream.  As with amend_or_commit, the branch's previous commit is
+        amended if it isn't the reference branch.  Returns False if no files
+        changed.
+
+        The commit is built with git fast-import instead of through the index.
+        Members are hashed as they are read and only those that differ from
+        the previous import are sent to Git; the working tree is checked out
+        once the commit exists.
+        """
+        head = self.branch_target()
+        amend = head != self.branch_target(GIT_REFERENCE_BRANCH)
+        parent = self.branch_target("HEAD^") if amend else head
+        if amend:
+            commit_message = self.output(["git", "log", "-1", "--format=%B", head],
+                "Failed to read the previous commit message for Git repo %s" % self.path)
+
+        object_format = self.output("git rev-parse --show-object-format",
+            "Failed to get object format of Git repo %s" % self.path)
+        author = self.output("git var GIT_AUTHOR_IDENT",
+            "Failed to get author identity for Git repo %s" % self.path)
+        committer = self.output("git var GIT_COMMITTER_IDENT",
+            "Failed to get committer identity for Git repo %s" % self.path)
+
+        previous_files = self.ls_tree(head)
+        files: dict[bytes, tuple[bytes, bytes]] = {}
+        changed = 0
+
+        fast_import = subprocess.Popen(
+            prepare_command(["git", "fast-import", "--quiet", "--force", "--done"]),
+            cwd=self.path, stdin=subprocess.PIPE)
+        assert fast_import.stdin is not None
+        stream = fast_import.stdin
+
+        with tarfile.open(fileobj=tar_stream, mode="r|") as tar:
+            for info in tar:
+                path = strip_path(os.fsencode(info.name), strip_components)
+                if path is None:
+                    continue
+
+                if info.islnk():
+                    # A streamed archive can only link to an earlier member.
+                    target = strip_path(os.fsencode(info.linkname), strip_components)
+                    if target not in files:
+                        # Killing fast-import discards everything sent so far.
+                        fast_import.kill()
+                        fast_import.wait()
+                        sys.exit("Hard link %s refers to %s, which isn't an earlier file in the archive" %
+                            (info.name, info.linkname))
+                    files[path] = files[target]
+                    continue
+                elif info.issym():
+                    mode = b"120000"
+                    data = os.fsencode(info.linkname)
+                elif info.isreg():
+                    mode = b"100755" if info.mode & 0o111 else b"100644"
+                    contents = tar.extractfile(info)
+                    assert contents is not None
+                    data = contents.read()
+                else:
+                    continue
+
+                digest = hashlib.new(object_format)
+                digest.update(b"blob %d\0" % len(data))
+                digest.update(data)
+                name = digest.hexdigest().encode()
+
+                if previous_files.get(path, (None, None))[1] != name:
+                    stream.write(b"blob\ndata %d\n" % len(data))
+                    stream.write(data)
+                    stream.write(b"\n")
+                    changed += 1
+                files[path] = (mode, name)
+
+        message = commit_message.encode()
+        stream.write(b"commit %s\n" % GIT_IMPORT_REF.encode())
+        stream.write(b"author %s\ncommitter %s\n" % (author.encode(), committer.encode()))
+        stream.write(b"data %d\n%s\n" % (len(message), message))
+        stream.write(b"from %s\ndeleteall\n" % parent.encode())
+        for path, (mode, name) in files.items():
+            stream.write(b"M %s %s %s\n" % (mode, name, quote_fast_import_path(path)))
+        stream.write(b"\ndone\n")
+        stream.close()
+
+        if fast_import.wait() != 0:
+            sys.exit("Failed to import files into Git repo %s" % self.path)
+
+        print(f"Imported {len(files)} files, {changed} of them changed or new")
+        try:
+            if (self.branch_target(GIT_IMPORT_REF + "^{tree}") ==
+                self.branch_target("HEAD^{tree}")):
+
+                print("No files updated")
+                return False
+
+            print("Amending previous commit" if amend else "Committing new files")
+            run_quiet_and_exit_on_failure(
+                ["git", "reset", "--hard", GIT_IMPORT_REF],
+                "Failed to check out imported files in Git repo %s" % self.path,
+                cwd=self.path)
+            return True
+        finally:
+            run_quiet(["git", "update-ref", "-d", GIT_IMPORT_REF], cwd=self.path)
 
     def rm(self, pattern: Union[str, Path]) -> None:
         run_quiet_and_exit_on_failure(
@@ -176,6 +369,19 @@ class GitRepo:
                 (pattern, self.path),
             cwd=self.path)
 
+
+def strip_path(path: bytes, strip_components: int) -> Optional[bytes]:
+    """Removes leading components from an archive member name, as tar's
+    --strip-components does.  Returns None if nothing is left."""
+    parts = [part for part in path.split(b"/") if part and part != b"."]
+    return b"/".join(parts[strip_components:]) or None
+
+
+def quote_fast_import_path(path: bytes) -> bytes:
+    if path.startswith(b'"') or b"\n" in path:
+        return b'"' + path.replace(b"\\", b"\\\\").replace(b'"', b'\\"').replace(b"\n", b"\\n") + b'"'
+    return path
+
 #
 # Repo helper
 #
@@ -190,6 +396,57 @@ def repo_start(path: Path, branch_name: str) -> None:
 # File helpers
 #
 
+def hash_file(path: Path) -> str:
+    """Returns the SHA-256 digest of a file's contents.  Symlinks are hashed by
+    their target rather than followed."""
+    digest = hashlib.sha256()
+    if path.is_symlink():
+        digest.update(os.readlink(path).encode())
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_directory(path: Path) -> str:
+    """Returns a SHA-256 digest covering the names and contents of every file
+    below path."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files + [d for d in dirs if os.path.islink(os.path.join(root, d))]):
+            file_path = Path(root) / name
+            digest.update(file_path.relative_to(path).as_posix().encode())
+            digest.update(hash_file(file_path).encode())
+    return digest.hexdigest()
+
+
+def clone_file(src: Path, dst: Path, allow_hardlink: bool = True) -> str:
+    """Creates dst with the contents of src as cheaply as possible.
+
+    A reflink is attempted first, then (if allowed) a hardlink, before falling
+    back to a full copy.  Returns the method that was used.
+    """
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+        return "reflink"
+    except OSError:
+        dst.unlink(missing_ok=True)
+
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
 def replace_file_contents(f: TextIO, new_contents: str) -> None:
     f.seek(0)
     f.write(new_contents)
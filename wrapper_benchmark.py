@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2021 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the per-invocation overhead of the compiler wrappers.
+
+The host C and C++ wrappers are generated in both modes and each is used to
+syntax-check an empty file repeatedly.  The same check is timed against clang
+invoked directly with the wrapper's flags, which is the baseline the overhead
+is reported against.
+"""
+
+import argparse
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Union
+
+import build_platform
+import config
+from paths import *
+
+
+DEFAULT_ITERATIONS: int = 200
+
+
+def time_command(command: list[str], iterations: int, env: dict[str, str]) -> list[float]:
+    # One untimed run warms the page cache.
+    subprocess.run(command, check=True, env=env)
+
+    times: list[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, env=env)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name: str, times: list[float], baseline: float) -> None:
+    median = statistics.median(times)
+    print("{:<24} median {:7.2f} ms  mean {:7.2f} ms  overhead {:+7.2f} ms".format(
+        name, median * 1000, statistics.mean(times) * 1000, (median - baseline) * 1000))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="Timed invocations per wrapper")
+    parser.add_argument("--target", default=build_platform.triple(),
+                        help="Host target to generate wrappers for")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if not build_platform.is_linux():
+        sys.exit("Configuration file wrappers are only supported on Linux")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path = Path(tmp)
+        script_path = tmp_path / "script"
+        config_path = tmp_path / "config"
+        script_path.mkdir()
+        config_path.mkdir()
+
+        source_c = tmp_path / "empty.c"
+        source_c.touch()
+        source_cxx = tmp_path / "empty.cpp"
+        source_cxx.touch()
+
+        config.host_config(args.target, "", "", wrappers_path=script_path)
+        config.host_config(args.target, "", "",
+            driver_configs=config.ClangDriverConfigs(config_path))
+
+        check_flags = ["-fsyntax-only"]
+        runs: list[tuple[str, list[Union[str, Path]]]] = [
+            ("clang (direct)",     [CC_PATH, f"--target={args.target}", "-fPIC", *check_flags, source_c]),
+            ("cc script",          [script_path / f"clang-{args.target}", *check_flags, source_c]),
+            ("cc config",          [config_path / f"{args.target}-clang", *check_flags, source_c]),
+            ("clang++ (direct)",   [CXX_PATH, f"--target={args.target}", "-stdlib=libc++",
+                                    f"-I{CXXSTD_PATH}", "-fPIC", *check_flags, source_cxx]),
+            ("cxx script",         [script_path / f"clang++-{args.target}", *check_flags, source_cxx]),
+            ("cxx config",         [config_path / f"{args.target}-clang++", *check_flags, source_cxx]),
+        ]
+
+        # The config wrappers are links to the clang binary outside of the
+        # prebuilt, so its rpath no longer finds libc++.  The build sets
+        # LD_LIBRARY_PATH for the same reason; every run gets it for fairness.
+        env = dict(os.environ)
+        env["LD_LIBRARY_PATH"] = LLVM_CXX_RUNTIME_PATH.as_posix()
+
+        print(f"Timing {args.iterations} invocations of each compiler")
+        baseline = 0.0
+        for name, command in runs:
+            times = time_command([str(arg) for arg in command], args.iterations, env)
+            if name.endswith("(direct)"):
+                baseline = statistics.median(times)
+            report(name, times, baseline)
+
+
+if __name__ == "__main__":
+    main()